@@ -3,6 +3,9 @@
 # SIM component for SIM simulator
 
 from infrastructure.aws import *
+from infrastructure.timer import TimerService
+from collections import deque
+import math, random, sys
 from util.helper import sort
 
 
@@ -121,50 +124,172 @@ class SimMessage(AWSKinesisPayload):
 
 class SimHeartbeatMessage(SimMessage):
 
-    def __init__(self, timestamp, sender):
+    def __init__(self, timestamp, sender, interval = None):
         super(SimHeartbeatMessage, self).__init__(timestamp, sender, 'heartbeat')
+        ## Time until the sender's next heartbeat, if it announces it
+        self.interval = interval
 
-class KinesisBasedSimPersistencyStrategy(SimPersistencyStrategy):
+class SimAggregatedHeartbeatMessage(SimHeartbeatMessage):
+
+    def __init__(self, timestamp, sender, members, interval = None):
+        super(SimAggregatedHeartbeatMessage, self).__init__(timestamp, sender, interval)
+        ## Instance ids of the healthy SIMs of the sender's region
+        self.members = members
+
+class SimLocalHeartbeatMessage(AWSMessage):
+
+    def __init__(self, sender, receiver, timestamp):
+        super(SimLocalHeartbeatMessage, self).__init__(sender, receiver, ('local heartbeat', timestamp))
+
+class HeartbeatTrackingSimPersistencyStrategy(SimPersistencyStrategy):
+    """Keeps track of the last heartbeat per region and the SIM status
+
+    A region goes in sync when a heartbeat refreshes it and out of sync
+    once an expiry timer finds its last heartbeat older than
+    maxHeartbeatAge, so status reads don't scan the regions."""
+
+    def __init__(self):
+        ## Regions currently in sync and their pending expiry timers
+        self.attachedRegionNames = set()
+        self.regionsInSync = set()
+        self.expiryTimers = {}
+        self.statusTransitions = 0
+
+    def attachRemoteRegions(self, regions):
+        for region in regions:
+            if region != self.sim.region:
+                self.attachRemoteRegion(region)
+
+    def attachRegion(self, region):
+        self.sim.attachedRegions.append(region)
+        self.attachedRegionNames.add(region.regionName)
+        if region.regionName in self.sim.lastHeartbeat:
+            self.refreshRegion(region.regionName)
+
+    def recordHeartbeat(self, regionName, timestamp):
+        if regionName not in self.sim.lastHeartbeat:
+            self.sim.lastHeartbeat[regionName] = (-1, -1)
+        if timestamp > self.sim.lastHeartbeat[regionName][0]:
+            self.sim.lastHeartbeat[regionName] = (timestamp, self.sim.env.now)
+            self.refreshRegion(regionName)
+
+    def refreshRegion(self, regionName):
+        ## Called whenever the last heartbeat of a region moved forward
+        deadline = self.sim.lastHeartbeat[regionName][0] + self.sim.maxHeartbeatAge
+        if deadline < self.sim.env.now:
+            return
+
+        if regionName not in self.regionsInSync:
+            if regionName not in self.attachedRegionNames:
+                return
+            self.regionsInSync.add(regionName)
+            self.sim.regionsInSync += 1
+            self.statusChanged(regionName, True)
+
+        if regionName not in self.expiryTimers:
+            self.scheduleExpiry(regionName, deadline)
+
+    def scheduleExpiry(self, regionName, deadline):
+        timers = TimerService.forEnvironment(self.sim.env)
+        self.expiryTimers[regionName] = timers.scheduleOnce(deadline - self.sim.env.now, lambda: self.expireRegion(regionName))
+
+    def expireRegion(self, regionName):
+        ## Heartbeats received since the timer was set only move the deadline
+        deadline = self.sim.lastHeartbeat[regionName][0] + self.sim.maxHeartbeatAge
+        if deadline > self.sim.env.now:
+            self.scheduleExpiry(regionName, deadline)
+            return
+
+        del self.expiryTimers[regionName]
+        self.regionsInSync.discard(regionName)
+        self.sim.regionsInSync -= 1
+        self.statusChanged(regionName, False)
+
+    def statusChanged(self, regionName, inSync):
+        self.statusTransitions += 1
+
+    def getSystemStatus(self):
+        regionsInSync = self.sim.regionsInSync
+
+        if regionsInSync == len(self.sim.attachedRegions):
+            status = 'IN SYNC (%i/%i)' % (regionsInSync, len(self.sim.attachedRegions))
+        else:
+            status = 'OUT OF SYNC (%i/%i)' % (regionsInSync, len(self.sim.attachedRegions))
+
+        return status
+
+    def printInfo(self, p):
+        p.printHeader("***********  SIM INFO: ", end = '')
+        p.printBold("%s - %s" % (self.sim.region.regionName, self.sim.serviceName), end = ' ')
+        p.printHeader("")
+        p.print("Current simulation time: ", end = '')
+        p.printBold("%i" % self.sim.env.now)
+
+        status = self.getSystemStatus()
+
+        p.printBold("+ Status: ", end = '')
+        if status.startswith('IN SYNC'):
+            p.printOK(status)
+        else:
+            p.printError(status)
+
+        p.printBold("+ Heartbeats: ", end = '')
+
+        for identifier in sort(self.sim.lastHeartbeat):
+            if not identifier.startswith(self.sim.region.regionName):
+                sent = self.sim.lastHeartbeat[identifier][0]
+                received = self.sim.lastHeartbeat[identifier][1]
+                age = self.sim.env.now - self.sim.lastHeartbeat[identifier][0]
+                if age > self.sim.maxHeartbeatAge:
+                    p.printWarning("!![%s: %i (%i - Age: %i)]!!\t" % (identifier, sent, received, age), end = ' ')
+                else:
+                    p.printOKB(" [%s: %i (%i - Age: %i)]  \t" % (identifier, sent, received, age), end = ' ')
+
+        p.print()
+        p.print()
+
+class KinesisBasedSimPersistencyStrategy(HeartbeatTrackingSimPersistencyStrategy):
 
     KINESIS_STREAM = "sim_control"
 
-    def __init__(self, kinesis):
+    def __init__(self, kinesis, coalescingWindow = 0, compaction = False):
+        super(KinesisBasedSimPersistencyStrategy, self).__init__()
         self.kinesis = kinesis
+        self.compactionKey = None
+        if compaction:
+            # Only the latest heartbeat of each SIM is of interest
+            self.compactionKey = lambda event: event.sender
+
         try:
-            kinesis.createStream(self.KINESIS_STREAM)
+            kinesis.createStream(self.KINESIS_STREAM, coalescingWindow, self.compactionKey)
         except AWSKinesisStreamExistsError:
             pass
 
+        ## Next unseen sequence number per (local or remote) Kinesis
         self.kinesisPosition = {} 
-        self.kinesisPosition['Kinesis'] = -1
+        self.kinesisPosition['Kinesis'] = 0
 
     def setSIM(self, sim):
         super(KinesisBasedSimPersistencyStrategy, self).setSIM(sim)
         self.kinesis.subscribe(self.KINESIS_STREAM, self.sim)
 
-    def attachRemoteRegions(self, regions):
-        for region in regions:
-            if region != self.sim.region:
-                self.attachRemoteRegion(region)
-
     def attachRemoteRegion(self, region):
         remoteKinesis = self.subscribeRegion(region)
-        self.sim.attachedRegions.append(region)
-        self.kinesisPosition[remoteKinesis.serviceName] = -1
+        self.kinesisPosition[remoteKinesis.serviceName] = 0
+        self.attachRegion(region)
 
     def subscribeRegion(self, region):
-        remoteKinesis = self.sim.region.getServiceByName("RemoteKinesis_%s" % region.regionName)
-        remoteKinesis.subscribe(self.KINESIS_STREAM, self.sim)
+        remoteKinesis = self.sim.region.getRemoteKinesis(region.regionId)
+        remoteKinesis.subscribe(self.KINESIS_STREAM, self.sim, self.compactionKey)
         return remoteKinesis
 
     def startBehaviour(self):
-        ## Periodically send heartbeats
-        self.sim.env.process(self.heartbeatBehaviour())
+        self.heartbeatBehaviour()
 
     def heartbeatBehaviour(self):
-        yield self.sim.env.timeout(self.sim.update_interval)
-        self.sendHeartbeatMessage()
-        self.sim.env.process(self.heartbeatBehaviour())
+        ## Periodically send heartbeats
+        timers = TimerService.forEnvironment(self.sim.env)
+        self.heartbeatTimer = timers.schedulePeriodic(self.sim.update_interval, self.sendHeartbeatMessage)
 
     def sendHeartbeatMessage(self):
         message = SimHeartbeatMessage(self.sim.env.now, self.sim.getAWSIdentifier())
@@ -183,17 +308,12 @@ class KinesisBasedSimPersistencyStrategy(SimPersistencyStrategy):
         if kinesis.region != self.sim.region:
             raise Exception("Kinesis region mismatch - something went horribly wrong")
 
+        # Only process records past the cursor
         position = self.kinesisPosition[message.sender.receiverName]
-        streamData = kinesis.consume(self.KINESIS_STREAM)
-
-        for event in streamData:
-            if event.timestamp >= self.kinesisPosition[message.sender.receiverName]:
-                # Only process unseen events
-                self.handleEvent(kinesis.serviceName, message.sender.regionName, event)
-                if position < event.timestamp:
-                    position = event.timestamp 
+        for sequence, event in kinesis.iterate(self.KINESIS_STREAM, position):
+            self.handleEvent(kinesis.serviceName, message.sender.regionName, event)
 
-        self.kinesisPosition[message.sender.receiverName] = position
+        self.kinesisPosition[message.sender.receiverName] = kinesis.getNextSequence(self.KINESIS_STREAM)
 
     def handleEvent(self, kinesisName, sourceRegion, event):
         if isinstance(event, SimHeartbeatMessage):
@@ -201,10 +321,7 @@ class KinesisBasedSimPersistencyStrategy(SimPersistencyStrategy):
 
             if event.sender.regionName != self.sim.region.regionName and not kinesisName.startswith('Remote'):
                 raise Exception('Consumed remote event from local kinesis')
-            if identifier not in self.sim.lastHeartbeat:
-                self.sim.lastHeartbeat[identifier] = (-1, -1)
-            if event.timestamp > self.sim.lastHeartbeat[identifier][0]:
-                self.sim.lastHeartbeat[identifier] = (event.timestamp, self.sim.env.now)
+            self.recordHeartbeat(identifier, event.timestamp)
         else:
             raise Exception("Unknown event")
 
@@ -214,63 +331,272 @@ class KinesisBasedSimPersistencyStrategy(SimPersistencyStrategy):
         else:
             pass # Discard message
 
-    def getSystemStatus(self):
-        status = 'OUT OF SYNC'
+class SimGossipMessage(AWSMessage):
 
-        regionsInSync = 0
-        for region in self.sim.attachedRegions:
-            if region.regionName in self.sim.lastHeartbeat:
-                heartbeat = self.sim.lastHeartbeat[region.regionName]
-                if heartbeat[0] + self.sim.maxHeartbeatAge >= self.sim.env.now:
-                    regionsInSync += 1
+    def __init__(self, sender, receiver, kind, heartbeats):
+        payload = (kind, heartbeats)
+        super(SimGossipMessage, self).__init__(sender, receiver, payload)
 
-        if regionsInSync == len(self.sim.attachedRegions):
-            status = 'IN SYNC (%i/%i)' % (regionsInSync, len(self.sim.attachedRegions))
-        else:
-            status = 'OUT OF SYNC (%i/%i)' % (regionsInSync, len(self.sim.attachedRegions))
+class GossipBasedSimPersistencyStrategy(HeartbeatTrackingSimPersistencyStrategy):
+    """Spreads heartbeats by push-pull gossip directly between SIM services
 
-        self.sim.regionsInSync = regionsInSync
-        return status
+    Every update interval the SIM refreshes the heartbeat of its own region
+    and pushes its heartbeat table to fanout random SIMs in other regions.
+    Those merge it and reply with the entries the pushing SIM has older
+    versions of or lacks."""
 
-    def printInfo(self, p):
-        p.printHeader("***********  SIM INFO: ", end = '')
-        p.printBold("%s - %s" % (self.sim.region.regionName, self.sim.serviceName), end = ' ')
-        p.printHeader("")
-        p.print("Current simulation time: ", end = '')
-        p.printBold("%i" % self.sim.env.now)
+    def __init__(self, fanout = 2, seed = None):
+        super(GossipBasedSimPersistencyStrategy, self).__init__()
+        self.fanout = fanout
+        self.random = random.Random(seed)
+        self.peers = []
+        self.messagesSent = 0
 
-        status = self.getSystemStatus()
+    def attachRemoteRegion(self, region):
+        self.subscribeRegion(region)
+        self.attachRegion(region)
 
-        p.printBold("+ Status: ", end = '')
-        if status.startswith('IN SYNC'):
-            p.printOK(status)
+    def subscribeRegion(self, region):
+        ## Gossip with every SIM of the region
+        for service in region.services.values():
+            if isinstance(service, Sim) and service.getAWSIdentifier() not in self.peers:
+                self.peers.append(service.getAWSIdentifier())
+
+    def startBehaviour(self):
+        self.heartbeatBehaviour()
+
+    def heartbeatBehaviour(self):
+        timers = TimerService.forEnvironment(self.sim.env)
+        self.heartbeatTimer = timers.schedulePeriodic(self.sim.update_interval, self.sendHeartbeatMessage)
+
+    def sendHeartbeatMessage(self):
+        self.recordHeartbeat(self.sim.region.regionName, self.sim.env.now)
+        heartbeats = self.getHeartbeats()
+
+        for peer in self.random.sample(self.peers, min(self.fanout, len(self.peers))):
+            self.sendGossip(peer, 'gossip push', heartbeats)
+
+    def getHeartbeats(self):
+        return {regionName: heartbeat[0] for regionName, heartbeat in self.sim.lastHeartbeat.items()}
+
+    def sendGossip(self, peer, kind, heartbeats):
+        self.messagesSent += 1
+        self.sim.region.send(SimGossipMessage(self.sim.getAWSIdentifier(), peer, kind, heartbeats))
+
+    def handleGossip(self, message):
+        kind, heartbeats = message.payload
+
+        for regionName, timestamp in heartbeats.items():
+            self.recordHeartbeat(regionName, timestamp)
+
+        if kind == 'gossip push':
+            ## Pull part - answer with everything the pushing SIM is behind on
+            newer = {}
+            for regionName, heartbeat in self.sim.lastHeartbeat.items():
+                if heartbeat[0] > heartbeats.get(regionName, -1):
+                    newer[regionName] = heartbeat[0]
+            if newer:
+                self.sendGossip(message.sender, 'gossip pull', newer)
+
+    def receive(self, message):
+        if isinstance(message, SimGossipMessage):
+            self.handleGossip(message)
         else:
-            p.printError(status)
+            pass # Discard message
 
-        p.printBold("+ Heartbeats: ", end = '')
+class HeartbeatArrivalWindow(object):
+    """Sliding window over the heartbeats received from one SIM
+
+    Keeps running sums so mean, deviation and the phi-accrual suspicion
+    level of the inter-arrival times are O(1). Comparing the gaps between
+    the sender's timestamps to the intervals it announced gives the share
+    of heartbeats lost on the way."""
+
+    def __init__(self, size = 50, minStdDeviation = 5):
+        self.samples = deque()
+        self.size = size
+        self.minStdDeviation = minStdDeviation
+        self.total = 0
+        self.squares = 0
+        self.gaps = 0
+        self.announced = 0
+        self.lastArrival = None
+        self.lastTimestamp = None
+        self.lastInterval = None
+        self.latency = None
+
+    def add(self, arrival, timestamp, interval = None):
+        if self.lastTimestamp is not None and timestamp <= self.lastTimestamp:
+            return
+
+        if self.lastArrival is not None:
+            sample = (arrival - self.lastArrival, timestamp - self.lastTimestamp, self.lastInterval or 0)
+            self.samples.append(sample)
+            self.update(sample, 1)
+            if len(self.samples) > self.size:
+                self.update(self.samples.popleft(), -1)
+
+        self.lastArrival = arrival
+        self.lastTimestamp = timestamp
+        self.lastInterval = interval
+
+        ## Exponentially weighted one way latency
+        if self.latency is None:
+            self.latency = arrival - timestamp
+        else:
+            self.latency = 0.9 * self.latency + 0.1 * (arrival - timestamp)
+
+    def update(self, sample, sign):
+        interArrival, gap, announced = sample
+        self.total += sign * interArrival
+        self.squares += sign * interArrival * interArrival
+        if announced:
+            self.gaps += sign * gap
+            self.announced += sign * announced
+
+    def mean(self):
+        return self.total / len(self.samples)
+
+    def stdDeviation(self):
+        variance = max(0, self.squares / len(self.samples) - self.mean() ** 2)
+        return max(math.sqrt(variance), self.minStdDeviation)
+
+    def loss(self):
+        if self.gaps <= 0:
+            return 0.0
+        return max(0.0, 1 - self.announced / self.gaps)
+
+    def phi(self, now):
+        """Suspicion level: -log10 of the probability that the next
+        heartbeat still arrives later than now"""
+        if not self.samples:
+            return 0.0
+
+        y = (now - self.lastArrival - self.mean()) / self.stdDeviation()
+        pLater = 0.5 * math.erfc(y / math.sqrt(2))
+        return -math.log10(max(pLater, sys.float_info.min))
+
+class AdaptiveKinesisBasedSimPersistencyStrategy(KinesisBasedSimPersistencyStrategy):
+    """Kinesis based strategy adapting its heartbeat interval to its paths
+
+    The heartbeats of every remote SIM go into a phi-accrual arrival window,
+    which also estimates latency and loss of the path from that SIM. The
+    SIM then sends its own heartbeats just often enough that, within
+    maxHeartbeatAge, all of them get lost with at most lossTarget
+    likelihood - but never more often than every update interval."""
+
+    lossTarget = 0.001
+    windowSize = 50
+
+    def __init__(self, kinesis, coalescingWindow = 0, compaction = False):
+        super(AdaptiveKinesisBasedSimPersistencyStrategy, self).__init__(kinesis, coalescingWindow, compaction)
+        self.arrivalWindows = {}
+        self.regionSenders = {}
+        self.heartbeatsSent = 0
 
-        for identifier in sort(self.sim.lastHeartbeat):
-            if not identifier.startswith(self.sim.region.regionName):
-                sent = self.sim.lastHeartbeat[identifier][0]
-                received = self.sim.lastHeartbeat[identifier][1]
-                age = self.sim.env.now - self.sim.lastHeartbeat[identifier][0]
-                if age > self.sim.maxHeartbeatAge:
-                    p.printWarning("!![%s: %i (%i - Age: %i)]!!\t" % (identifier, sent, received, age), end = ' ')
-                else:
-                    p.printOKB(" [%s: %i (%i - Age: %i)]  \t" % (identifier, sent, received, age), end = ' ')
+    def heartbeatBehaviour(self):
+        self.interval = self.sim.update_interval
+        timers = TimerService.forEnvironment(self.sim.env)
+        self.heartbeatTimer = timers.scheduleOnce(self.interval, self.sendHeartbeatMessage)
 
-        p.print()
-        p.print()
+    def sendHeartbeatMessage(self):
+        self.interval = self.getHeartbeatInterval()
+        self.heartbeatsSent += 1
+        message = SimHeartbeatMessage(self.sim.env.now, self.sim.getAWSIdentifier(), self.interval)
+        self.kinesis.publish(self.KINESIS_STREAM, message)
 
-class ResubscribingKinesisBasedSimPersistencyStrategy(KinesisBasedSimPersistencyStrategy):
-    resubscriptionInterval = 1000
+        timers = TimerService.forEnvironment(self.sim.env)
+        self.heartbeatTimer = timers.scheduleOnce(self.interval, self.sendHeartbeatMessage)
 
-    def resubscriptionBehaviour(self):
-        yield self.sim.env.timeout(self.resubscriptionInterval)
-        for region in self.sim.attachedRegions:
-            self.subscribeRegion(region)
-        self.sim.env.process(self.resubscriptionBehaviour())
+    def getHeartbeatInterval(self):
+        if not self.arrivalWindows:
+            return self.sim.update_interval
+
+        latency = max(window.latency for window in self.arrivalWindows.values())
+        loss = max(window.loss() for window in self.arrivalWindows.values())
+
+        ## Heartbeats within maxHeartbeatAge needed to get at least one through
+        attempts = 1
+        if loss > 0:
+            attempts = max(1, math.ceil(math.log(self.lossTarget) / math.log(min(loss, 0.99))))
+
+        interval = (self.sim.maxHeartbeatAge - latency) / (attempts + 1)
+        return max(self.sim.update_interval, min(int(interval), self.sim.maxHeartbeatAge // 2))
+
+    def handleEvent(self, kinesisName, sourceRegion, event):
+        super(AdaptiveKinesisBasedSimPersistencyStrategy, self).handleEvent(kinesisName, sourceRegion, event)
+
+        sender = event.sender
+        if sender.regionName == self.sim.region.regionName:
+            return
+
+        if sender not in self.arrivalWindows:
+            self.arrivalWindows[sender] = HeartbeatArrivalWindow(self.windowSize)
+            self.regionSenders.setdefault(sender.regionName, []).append(sender)
+        self.arrivalWindows[sender].add(self.sim.env.now, event.timestamp, event.interval)
+
+    def getSuspicionLevel(self, regionName):
+        """Phi of the least suspicious SIM of the region"""
+        if regionName not in self.regionSenders:
+            return 0.0
+        return min(self.arrivalWindows[sender].phi(self.sim.env.now) for sender in self.regionSenders[regionName])
+
+class LeaderAggregatedKinesisBasedSimPersistencyStrategy(KinesisBasedSimPersistencyStrategy):
+    """Kinesis based strategy publishing one heartbeat per region
+
+    The SIMs of a region exchange local heartbeats. The healthy SIM with
+    the lowest instance id is the leader and publishes a single aggregated
+    heartbeat listing all healthy instances. Once its local heartbeats stop
+    for leaderTimeout update intervals the next SIM takes over, so
+    cross-region load does not grow with the SIMs per region."""
+
+    leaderTimeout = 3
+
+    def __init__(self, kinesis, coalescingWindow = 0, compaction = False):
+        super(LeaderAggregatedKinesisBasedSimPersistencyStrategy, self).__init__(kinesis, coalescingWindow, compaction)
+        self.siblings = {}
+        self.localHeartbeats = {}
+        self.regionMembers = {}
+        self.heartbeatsPublished = 0
 
     def startBehaviour(self):
-        super(ResubscribingKinesisBasedSimPersistencyStrategy, self).startBehaviour()
-        self.sim.env.process(self.resubscriptionBehaviour())
+        ## All SIMs of the region exist by now - each starts out healthy
+        for service in self.sim.region.services.values():
+            if isinstance(service, Sim) and service is not self.sim:
+                self.siblings[service.getAWSIdentifier()] = service.instance_id
+                self.localHeartbeats[service.instance_id] = self.sim.env.now
+        super(LeaderAggregatedKinesisBasedSimPersistencyStrategy, self).startBehaviour()
+
+    def getHealthyMembers(self):
+        deadline = self.sim.env.now - self.leaderTimeout * self.sim.update_interval
+        members = [instance for instance, timestamp in self.localHeartbeats.items() if timestamp >= deadline]
+        members.append(self.sim.instance_id)
+        members.sort()
+        return members
+
+    def isLeader(self):
+        return self.getHealthyMembers()[0] == self.sim.instance_id
+
+    def sendHeartbeatMessage(self):
+        now = self.sim.env.now
+        sender = self.sim.getAWSIdentifier()
+        for sibling in self.siblings:
+            self.sim.region.send(SimLocalHeartbeatMessage(sender, sibling, now))
+
+        members = self.getHealthyMembers()
+        if members[0] == self.sim.instance_id:
+            self.heartbeatsPublished += 1
+            self.kinesis.publish(self.KINESIS_STREAM, SimAggregatedHeartbeatMessage(now, sender, members))
+
+    def handleEvent(self, kinesisName, sourceRegion, event):
+        super(LeaderAggregatedKinesisBasedSimPersistencyStrategy, self).handleEvent(kinesisName, sourceRegion, event)
+        if isinstance(event, SimAggregatedHeartbeatMessage):
+            self.regionMembers[event.sender.regionName] = event.members
+
+    def receive(self, message):
+        if isinstance(message, SimLocalHeartbeatMessage):
+            if message.sender in self.siblings:
+                instance = self.siblings[message.sender]
+                self.localHeartbeats[instance] = max(self.localHeartbeats[instance], message.payload[1])
+        else:
+            super(LeaderAggregatedKinesisBasedSimPersistencyStrategy, self).receive(message)
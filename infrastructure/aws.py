@@ -3,8 +3,13 @@
 # AWS components for SIM simulator
 
 from infrastructure.region import *
+from infrastructure.timer import TimerService
+from infrastructure import validation
 from util.helper import singleton
-import random
+from bisect import bisect_left
+from collections import OrderedDict
+from itertools import islice
+import mmap, os, pickle, random, struct, tempfile
 
 class AWSError(RegionError):
     pass
@@ -20,26 +25,29 @@ class AWSRegion(Region):
 
     def __init__(self, env, regionName):
         super(AWSRegion, self).__init__(env, regionName)
+        ## Proxies for the Kinesis of remote regions by region address
+        self.remoteKinesis = []
 
-    def notifyNetworkReceive(self, networkPath):
-        message = yield networkPath.receive()
-
+    @validation.checked(validation.INHERIT)
+    def networkReceive(self, message):
         if not isinstance(message, Message):
             raise AWSError("Message is not of type Message")
         else:
             self.localReceive(message)
 
-    def send(self, message):
+    @validation.checked(validation.INHERIT)
+    def send(self, message, onCongestion = None):
         if not isinstance(message, AWSMessage):
             raise AWSError("Message is not of type AWSMessage")
         else:
-            super(AWSRegion, self).send(message)
+            super(AWSRegion, self).send(message, onCongestion)
 
-    def sendToRegion(self, regionName, service, message):
+    @validation.checked(validation.INHERIT)
+    def sendToRegion(self, regionName, service, message, onCongestion = None):
         if not isinstance(message, AWSMessage):
             raise AWSError("Message is not of type AWSMessage")
         else:
-            super(AWSRegion, self).sendToRegion(regionName, service, message)
+            super(AWSRegion, self).sendToRegion(regionName, service, message, onCongestion)
 
     def registerService(self, service, serviceName):
         if not isinstance(service, AWSService):
@@ -47,6 +55,16 @@ class AWSRegion(Region):
         else:
             super(AWSRegion, self).registerService(service, serviceName)
 
+    def registerRemoteKinesis(self, remoteKinesis):
+        setTableEntry(self.remoteKinesis, remoteKinesis.remoteRegionId, remoteKinesis)
+
+    def getRemoteKinesis(self, regionId):
+        """Proxy for the Kinesis of the region with address regionId"""
+        remoteKinesis = getTableEntry(self.remoteKinesis, regionId)
+        if remoteKinesis is None:
+            raise AWSError("No remote Kinesis for region %s" % regionAddresses.name(regionId))
+        return remoteKinesis
+
 
 class AWSService(Service):
 
@@ -111,49 +129,446 @@ class AWSKinesisError(AWSError):
 class AWSKinesisStreamExistsError(AWSKinesisError):
     pass
 
+class AWSKinesisStream(object):
+    """Sequence numbered log of the records published to a Kinesis stream
+
+    Every appended record gets the next sequence number. Consumers remember
+    the sequence following the last record they have seen and only read
+    records from there on. Records are appended in timestamp order, so
+    expired records are always found at the head of the log.
+
+    A stream with a compactionKey is log compacted: once the log holds
+    twice as many records as there are keys, only the latest record per
+    key is retained. A consumer still finds the latest record of every key
+    updated after its position."""
+
+    def __init__(self, streamName, coalescingWindow = 0, compactionKey = None):
+        self.streamName = streamName
+        self.coalescingWindow = coalescingWindow
+        self.compactionKey = compactionKey
+        self.latest = {}
+        self.sequences = []
+        self.records = []
+        self.head = 0
+        self.nextSequence = 0
+        self.notificationsSent = 0
+        self.notificationsSaved = 0
+
+    def append(self, record, sequence = None):
+        """Append record, numbering it with the next sequence number unless
+        the sequence number is given (e.g. for replicated records)"""
+        if sequence is None:
+            sequence = self.nextSequence
+        self.sequences.append(sequence)
+        self.records.append(record)
+        self.nextSequence = sequence + 1
+
+        if self.compactionKey is not None:
+            self.latest[self.compactionKey(record)] = sequence
+            if len(self) > 2 * len(self.latest):
+                self.compact()
+
+        return sequence
+
+    def compact(self):
+        """Drop every record superseded by a later record with the same key"""
+        latest = self.latest
+        key = self.compactionKey
+        kept = [i for i in range(self.head, len(self.records)) if latest[key(self.records[i])] == self.sequences[i]]
+        self.sequences = [self.sequences[i] for i in kept]
+        self.records = [self.records[i] for i in kept]
+        self.head = 0
+
+    def position(self, fromSequence):
+        if fromSequence <= 0:
+            return self.head
+        return bisect_left(self.sequences, fromSequence, self.head)
+
+    def read(self, fromSequence = 0):
+        return self.records[self.position(fromSequence):]
+
+    def iterate(self, fromSequence = 0):
+        for i in range(self.position(fromSequence), len(self.records)):
+            yield self.sequences[i], self.records[i]
+
+    def first(self):
+        if self.head < len(self.records):
+            return self.records[self.head]
+        else:
+            return None
+
+    def firstTimestamp(self):
+        record = self.first()
+        if record is None:
+            return None
+        return record.timestamp
+
+    def expire(self, cutoff):
+        """Drop records from the head having a timestamp not after cutoff"""
+        records = self.records
+        head = start = self.head
+        while head < len(records) and records[head].timestamp <= cutoff:
+            if self.compactionKey is not None:
+                key = self.compactionKey(records[head])
+                if self.latest[key] == self.sequences[head]:
+                    del self.latest[key]
+            head += 1
+        self.head = head
+
+        # Release the dropped prefix once it makes up half of the log
+        if head > 0 and head * 2 >= len(records):
+            del records[:head]
+            del self.sequences[:head]
+            self.head = 0
+
+        return head - start
+
+    def __iter__(self):
+        return islice(self.records, self.head, None)
+
+    def __len__(self):
+        return len(self.records) - self.head
+
+    def __contains__(self, record):
+        return record in iter(self)
+
+    def close(self):
+        """Release the storage of the stream - nothing to do in memory"""
+        pass
+
+
+class AWSKinesisStreamSegment(object):
+    """Memory-mapped segment file of a disk backed Kinesis stream
+
+    Records are stored pickled in the data file. The index file holds one
+    fixed-width entry (offset, length, timestamp) per record, so the i-th
+    record of the segment has sequence number firstSequence + i. Once the
+    segment is full it is sealed: its writable maps and files are closed
+    and it is mapped read-only again while its records are read."""
+    INDEX_ENTRY = struct.Struct('<QId')
+
+    def __init__(self, path, firstSequence, maxRecords, maxBytes):
+        self.path = path
+        self.firstSequence = firstSequence
+        self.maxRecords = maxRecords
+        self.maxBytes = maxBytes
+        self.count = 0
+        self.size = 0
+        self.dataFile, self.data = self.mapFile(path + '.seg', maxBytes)
+        self.indexFile, self.index = self.mapFile(path + '.idx', maxRecords * self.INDEX_ENTRY.size)
+
+    def mapFile(self, fileName, size):
+        f = open(fileName, 'w+b')
+        f.truncate(size)
+        return f, mmap.mmap(f.fileno(), size)
+
+    def hasRoom(self, length):
+        return self.count < self.maxRecords and self.size + length <= self.maxBytes
+
+    def append(self, data, timestamp):
+        self.data[self.size:self.size + len(data)] = data
+        self.INDEX_ENTRY.pack_into(self.index, self.count * self.INDEX_ENTRY.size, self.size, len(data), timestamp)
+        self.size += len(data)
+        self.count += 1
+
+    def seal(self):
+        """Release the maps and files of the segment - no more records are appended"""
+        self.unmap()
+
+    def mapReadOnly(self):
+        """Map the files of a sealed segment for reading"""
+        self.dataFile = open(self.path + '.seg', 'rb')
+        self.data = mmap.mmap(self.dataFile.fileno(), 0, access = mmap.ACCESS_READ)
+        self.indexFile = open(self.path + '.idx', 'rb')
+        self.index = mmap.mmap(self.indexFile.fileno(), 0, access = mmap.ACCESS_READ)
+
+    def unmap(self):
+        if self.data is None:
+            return
+        for m, f in ((self.data, self.dataFile), (self.index, self.indexFile)):
+            m.close()
+            f.close()
+        self.data = self.index = None
+
+    def isMapped(self):
+        return self.data is not None
+
+    def entry(self, i):
+        return self.INDEX_ENTRY.unpack_from(self.index, i * self.INDEX_ENTRY.size)
+
+    def timestamp(self, i):
+        return self.entry(i)[2]
+
+    def read(self, i):
+        offset, length, timestamp = self.entry(i)
+        return pickle.loads(self.data[offset:offset + length])
+
+    def delete(self):
+        self.seal()
+        os.remove(self.path + '.seg')
+        os.remove(self.path + '.idx')
+
+
+class AWSKinesisDiskStream(AWSKinesisStream):
+    """Kinesis stream storing its records in memory-mapped segment files
+
+    Records are only unpickled when they are read. Sealed segments are
+    mapped read-only while read, at most maxOpenSegments of them at a time
+    in least recently read order. Expired records are
+    skipped by moving the first retained sequence number; a segment file
+    is deleted as soon as all of its records have expired. Replicated
+    records may skip sequence numbers, a gap starts a new segment.
+    Compaction is not supported."""
+    maxOpenSegments = 4
+
+    def __init__(self, streamName, coalescingWindow = 0, directory = None, segmentRecords = 4096, segmentBytes = 1 << 22):
+        super(AWSKinesisDiskStream, self).__init__(streamName, coalescingWindow)
+        self.directory = tempfile.mkdtemp(prefix = 'kinesis-%s-' % streamName, dir = directory)
+        self.segmentRecords = segmentRecords
+        self.segmentBytes = segmentBytes
+        self.segments = []
+        self.segmentStarts = []
+        self.openSegments = OrderedDict()
+        self.firstSequence = 0
+        self.retained = 0
+
+    def append(self, record, sequence = None):
+        if sequence is None:
+            sequence = self.nextSequence
+        elif sequence < self.nextSequence:
+            raise AWSKinesisError("Disk backed streams only support increasing sequence numbers")
+
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        if sequence > self.nextSequence or not self.segments or not self.segments[-1].hasRoom(len(data)):
+            self.addSegment(sequence, len(data))
+        self.segments[-1].append(data, record.timestamp)
+
+        if self.retained == 0:
+            self.firstSequence = sequence
+        self.retained += 1
+        self.nextSequence = sequence + 1
+        return sequence
+
+    def addSegment(self, firstSequence, length):
+        if self.segments:
+            self.segments[-1].seal()
+        path = os.path.join(self.directory, '%020i' % firstSequence)
+        segment = AWSKinesisStreamSegment(path, firstSequence, self.segmentRecords, max(self.segmentBytes, length))
+        self.segments.append(segment)
+        self.segmentStarts.append(segment.firstSequence)
+
+    def openSegment(self, segment):
+        """Map a sealed segment for reading, unmapping the least recently
+        read one beyond maxOpenSegments"""
+        if segment in self.openSegments:
+            self.openSegments.move_to_end(segment)
+        elif not segment.isMapped():
+            segment.mapReadOnly()
+            self.openSegments[segment] = True
+            if len(self.openSegments) > self.maxOpenSegments:
+                self.openSegments.popitem(last = False)[0].unmap()
+        return segment
+
+    def locate(self, sequence):
+        i = bisect_left(self.segmentStarts, sequence + 1) - 1
+        segment = self.openSegment(self.segments[i])
+        return segment, sequence - segment.firstSequence
+
+    def get(self, sequence):
+        segment, i = self.locate(sequence)
+        return segment.read(i)
+
+    def read(self, fromSequence = 0):
+        return [record for sequence, record in self.iterate(fromSequence)]
+
+    def iterate(self, fromSequence = 0):
+        start = max(fromSequence, self.firstSequence)
+        if not self.segments or start >= self.nextSequence:
+            return
+        first = max(0, bisect_left(self.segmentStarts, start + 1) - 1)
+        for segment in self.segments[first:]:
+            for i in range(max(0, start - segment.firstSequence), segment.count):
+                yield segment.firstSequence + i, self.openSegment(segment).read(i)
+
+    def first(self):
+        if self.retained > 0:
+            return self.get(self.firstSequence)
+        else:
+            return None
+
+    def firstTimestamp(self):
+        if self.retained > 0:
+            segment, i = self.locate(self.firstSequence)
+            return segment.timestamp(i)
+        else:
+            return None
+
+    def expire(self, cutoff):
+        expired = 0
+        while self.segments:
+            segment = self.segments[0]
+            i = self.firstSequence - segment.firstSequence
+            if i >= segment.count:
+                self.dropSegment()
+            elif self.openSegment(segment).timestamp(i) <= cutoff:
+                self.firstSequence += 1
+                expired += 1
+            else:
+                break
+
+        self.retained -= expired
+        if not self.segments:
+            self.firstSequence = self.nextSequence
+        return expired
+
+    def dropSegment(self):
+        segment = self.segments.pop(0)
+        self.openSegments.pop(segment, None)
+        segment.delete()
+        self.segmentStarts.pop(0)
+        ## Skip the gap up to the next segment
+        if self.segments:
+            self.firstSequence = max(self.firstSequence, self.segmentStarts[0])
+
+    def close(self):
+        """Delete all segment files of the stream"""
+        while self.segments:
+            self.dropSegment()
+        os.rmdir(self.directory)
+
+    def __iter__(self):
+        return (record for sequence, record in self.iterate())
+
+    def __len__(self):
+        return self.retained
+
+
 class AWSKinesis(AWSInfrastructureService):
+    """Kinesis service of a region
+
+    Remote subscribers are notified about new records and request them.
+    With pushReplication the new records are sent to remote subscribers
+    right away instead, saving the request/reply round trip. Streams
+    created with a coalescing window notify their subscribers at most once
+    per window, covering all records published during it. With a
+    storageDirectory streams are kept in memory-mapped files below it.
+
+    Subscribers may hold a lease instead of a permanent subscription. The
+    lease is renewed by resubscribing or by requesting stream deltas, and
+    lapsed subscriptions are dropped on the next notification."""
     serviceName = "Kinesis"
 
-    def __init__(self, region, env, ttl = 0):
+    def __init__(self, region, env, ttl = 0, pushReplication = False, storageDirectory = None):
         self.streams = {}
         self.subscriptions = {}
         self.env = env
         self.ttl = ttl 
+        self.pushReplication = pushReplication
+        self.storageDirectory = storageDirectory
+        self.pendingNotifications = {}
+        self.timers = TimerService.forEnvironment(env)
+        self.ttlTimer = None
+        self.remoteKinesisId = serviceAddresses.address('RemoteKinesis_%s' % region.regionName)
         super(AWSKinesis, self).__init__(region, self.serviceName)
         self.startBehaviour()
 
     def startBehaviour(self):
         if self.ttl > 0:
-            self.env.process(self.ttlBehaviour())
+            self.scheduleExpiry()
+
+    def scheduleExpiry(self):
+        """Set a timer for when the oldest record expires - if all streams
+        are empty, the next publish sets it"""
+        nextExpiry = self.getNextExpiry()
+        if nextExpiry is None:
+            self.ttlTimer = None
+        else:
+            self.ttlTimer = self.timers.scheduleOnce(max(0, nextExpiry - self.env.now), self.ttlBehaviour)
 
     def ttlBehaviour(self):
-        yield self.env.timeout(self.ttl)
         self.cleanupStreams()
-        yield self.env.process(self.ttlBehaviour())
+        self.scheduleExpiry()
+
+    def getNextExpiry(self):
+        nextExpiry = None
+        for stream in self.streams.values():
+            timestamp = stream.firstTimestamp()
+            if timestamp is not None and (nextExpiry is None or timestamp + self.ttl < nextExpiry):
+                nextExpiry = timestamp + self.ttl
+        return nextExpiry
 
     def cleanupStreams(self):
-        for streamName in self.streams:
-            stream = self.streams[streamName]
-            self.streams[streamName] = [x for x in stream if x.timestamp + self.ttl > self.env.now]
+        cutoff = self.env.now - self.ttl
+        for stream in self.streams.values():
+            stream.expire(cutoff)
 
-    def createStream(self, streamName):
+    def close(self):
+        """Release the storage of all streams, e.g. at the end of a run"""
+        for stream in self.streams.values():
+            stream.close()
+
+    def createStream(self, streamName, coalescingWindow = 0, compactionKey = None):
         if streamName in self.streams:
             raise AWSKinesisStreamExistsError("Stream (%s) already registered" % streamName)
+
+        if self.storageDirectory is None:
+            stream = AWSKinesisStream(streamName, coalescingWindow, compactionKey)
+        elif compactionKey is None:
+            stream = AWSKinesisDiskStream(streamName, coalescingWindow, self.storageDirectory)
         else:
-            self.streams[streamName] = []
-            self.subscriptions[streamName] = []
+            raise AWSKinesisError("Disk backed streams can not be compacted")
+
+        self.streams[streamName] = stream
+        self.subscriptions[streamName] = {}
 
     def publish(self, streamName, message):
-        if not isinstance(message, AWSKinesisPayload):
-            raise AWSKinesisError("Invalid message format")
+        self.putRecords(streamName, [message])
+
+    def putRecords(self, streamName, messages):
+        """Append a batch of records atomically and notify subscribers once"""
+        for message in messages:
+            if not isinstance(message, AWSKinesisPayload):
+                raise AWSKinesisError("Invalid message format")
+
+        self.verifyStreamExists(streamName)
+        if not messages:
+            return
+
+        stream = self.streams[streamName]
+        records = [(stream.append(message), message) for message in messages]
+        if self.ttl > 0 and self.ttlTimer is None:
+            self.scheduleExpiry()
+
+        if stream.coalescingWindow > 0:
+            self.coalesceNotification(streamName, records)
+        else:
+            self.notifySubscribers(streamName, records)
+
+    def coalesceNotification(self, streamName, records):
+        if streamName in self.pendingNotifications:
+            self.streams[streamName].notificationsSaved += len(self.subscriptions[streamName])
+        else:
+            self.pendingNotifications[streamName] = []
+            window = self.streams[streamName].coalescingWindow
+            self.timers.scheduleOnce(window, lambda: self.flushNotifications(streamName))
+        self.pendingNotifications[streamName].extend(records)
+
+    def flushNotifications(self, streamName):
+        self.notifySubscribers(streamName, self.pendingNotifications.pop(streamName))
 
+    def consume(self, streamName, fromSequence = 0):
+        """Return all records of the stream starting at sequence number fromSequence"""
         self.verifyStreamExists(streamName)
-        self.streams[streamName].append(message)
-        self.notifySubscribers(streamName)
+        return self.streams[streamName].read(fromSequence)
 
-    def consume(self, streamName):
+    def iterate(self, streamName, fromSequence = 0):
+        """Iterate over (sequence number, record) starting at fromSequence"""
         self.verifyStreamExists(streamName)
-        return list(self.streams[streamName])
+        return self.streams[streamName].iterate(fromSequence)
+
+    def getNextSequence(self, streamName):
+        self.verifyStreamExists(streamName)
+        return self.streams[streamName].nextSequence
 
     def subscribe(self, streamName, service):
        if not isinstance(service, AWSService):
@@ -162,24 +577,50 @@ class AWSKinesis(AWSInfrastructureService):
            identifier = service.getAWSIdentifier()
            self.subscribeIdentifier(streamName, identifier)
 
-    def subscribeIdentifier(self, streamName, identifier):
+    def subscribeIdentifier(self, streamName, identifier, lease = 0):
+        """Subscribe identifier - with a lease > 0 the subscription lapses
+        unless renewed within lease ticks"""
         if streamName not in self.subscriptions:
             raise AWSKinesisError("Stream (%s) does not exist" % streamName)
  
         self.verifyRemoteKinesis(identifier)
 
-        if identifier not in self.subscriptions[streamName]:
-            self.subscriptions[streamName].append(identifier)
+        if lease > 0:
+            self.subscriptions[streamName][identifier] = (lease, self.env.now + lease)
+        else:
+            self.subscriptions[streamName][identifier] = (0, None)
+
+    def renewLease(self, streamName, identifier):
+        subscription = self.subscriptions[streamName].get(identifier)
+        if subscription is not None and subscription[1] is not None and subscription[1] >= self.env.now:
+            self.subscriptions[streamName][identifier] = (subscription[0], self.env.now + subscription[0])
+
+    def dropLapsedSubscriptions(self, streamName):
+        subscriptions = self.subscriptions[streamName]
+        lapsed = [identifier for identifier, (lease, expiry) in subscriptions.items() if expiry is not None and expiry < self.env.now]
+        for identifier in lapsed:
+            del subscriptions[identifier]
+
+    def notifySubscribers(self, streamName, records = None):
+        """Notify subscribers about new records - in push mode remote
+        subscribers get the new (sequence, record) pairs directly"""
+        push = self.pushReplication and records is not None
+        nextSequence = self.streams[streamName].nextSequence
+        self.dropLapsedSubscriptions(streamName)
+        self.streams[streamName].notificationsSent += len(self.subscriptions[streamName])
 
-    def notifySubscribers(self, streamName):
         for subscriber in self.subscriptions[streamName]:
             sender = self.getAWSIdentifier() 
-            payload = AWSKinesisSubscriberNotification(sender, subscriber, streamName)
+            if push and subscriber.regionName != self.region.regionName:
+                payload = AWSKinesisStreamPush(sender, subscriber, streamName, records, nextSequence)
+            else:
+                payload = AWSKinesisSubscriberNotification(sender, subscriber, streamName)
             self.region.sendToRegion(subscriber.regionName, subscriber.receiverName, payload)
 
+    @validation.checked(validation.skip)
     def verifyRemoteKinesis(self, identifier):
-        if identifier.regionName != self.region.regionName:
-            if identifier.receiverName != 'RemoteKinesis_%s' % self.region.regionName:
+        if identifier.regionId != self.region.regionId:
+            if identifier.serviceId != self.remoteKinesisId:
                 raise AWSServiceNotLocalOrRemoteServiceError("Only proxy services can subscribe to remote Kinesis")
 
     def verifyStreamExists(self, streamName):
@@ -193,15 +634,24 @@ class AWSKinesis(AWSInfrastructureService):
             raise AWSKinesisError("Could not parse message")
 
         if message.payload[0] == 'subscribe':
-            self.subscribeIdentifier(message.payload[1], message.sender)
+            lease = message.payload[2] if len(message.payload) > 2 else 0
+            self.subscribeIdentifier(message.payload[1], message.sender, lease)
         elif message.payload[0] == 'create stream':
             self.createStream(message.payload[1])
         elif message.payload[0] == 'publish':
             self.publish(message.payload[1], message.payload[2])
+        elif message.payload[0] == 'put records':
+            self.putRecords(message.payload[1], message.payload[2])
         elif message.payload[0] == 'request stream content':
             content = self.consume(message.payload[1])
             reply = message.makeReply(('stream content', message.payload[1], content))
             self.region.send(reply)
+        elif message.payload[0] == 'request stream delta':
+            records = list(self.iterate(message.payload[1], message.payload[2]))
+            self.renewLease(message.payload[1], message.sender)
+            nextSequence = self.getNextSequence(message.payload[1])
+            reply = message.makeReply(('stream delta', message.payload[1], records, nextSequence))
+            self.region.send(reply)
         else:
             raise AWSKinesisError("Not implemented")
 
@@ -212,6 +662,8 @@ class AWSRemoteService(AWSService):
         self.remoteRegionName = remoteRegionName
         self.remoteServiceName = remoteServiceName
         self.serviceName = 'Remote%s_%s' % (remoteServiceName, remoteRegionName) 
+        self.remoteRegionId = regionAddresses.address(remoteRegionName)
+        self.remoteServiceId = serviceAddresses.address(remoteServiceName)
         super(AWSRemoteService, self).__init__(self.region, self.serviceName)
 
     def receive(self, message):
@@ -233,30 +685,141 @@ class AWSRemoteService(AWSService):
             raise AWSServiceNotLocalError("Service does not reside in same region") 
 
 class AWSRemoteKinesis(AWSRemoteService):
-
-    def __init__(self, localRegion, remoteRegionName):
+    """Local proxy for a Kinesis in another region
+
+    The proxy buffers the remote streams it is subscribed to. On every
+    notification it only requests the records following the last sequence
+    number it has seen and appends them to its buffer, which is trimmed
+    by the proxy's own TTL.
+
+    With a storageDirectory the buffers are disk backed streams, like the
+    streams of a Kinesis with one.
+
+    The proxy multiplexes subscriptions: it holds a single upstream
+    subscription per stream and fans notifications out to all local
+    subscribers, however many there are. Local subscribes to a stream the
+    proxy already holds a live upstream subscription for are only
+    registered locally. With a leaseDuration the upstream subscription is a
+    lease, which delta requests renew as a side effect; an explicit renewal
+    is only sent when the lease nears expiry. Permanent upstream
+    subscriptions are resent every resubscriptionInterval ticks (0 =
+    never), covering subscribe messages lost on the way."""
+
+    renewalMargin = 0.25 ## Renew when less than this fraction of the lease is left
+    defaultResubscriptionInterval = 1000
+
+    def __init__(self, localRegion, remoteRegionName, ttl = 0, leaseDuration = 0, storageDirectory = None, resubscriptionInterval = defaultResubscriptionInterval):
         self.localSubscriptions = {}
+        self.upstreamSubscriptions = {}
+        self.renewalTimers = {}
+        self.resubscriptionTimers = {}
+        self.resubscriptionInterval = resubscriptionInterval
         self.bufferedStreams = {}
+        self.streamPositions = {}
+        self.ttl = ttl
+        self.leaseDuration = leaseDuration
+        self.storageDirectory = storageDirectory
         super(AWSRemoteKinesis, self).__init__(localRegion, remoteRegionName, 'Kinesis')
+        localRegion.registerRemoteKinesis(self)
 
-    def subscribe(self, streamName, service):
+    def subscribe(self, streamName, service, compactionKey = None):
+        """Subscribe a local service - compactionKey compacts the local
+        buffer of the stream, like on a compacted Kinesis stream"""
         self.verifyLocalService(service)
 
         if streamName not in self.localSubscriptions:
-            self.localSubscriptions[streamName] = []
+            self.localSubscriptions[streamName] = {}
 
         if streamName not in self.bufferedStreams:
-            self.bufferedStreams[streamName] = []
+            self.bufferedStreams[streamName] = self.makeBuffer(streamName, compactionKey)
+            self.streamPositions[streamName] = 0
 
         if service not in self.localSubscriptions[streamName]:
-            self.localSubscriptions[streamName].append(service)
+            self.localSubscriptions[streamName][service] = service.getAWSIdentifier()
 
-        message = self.make_message(('subscribe', streamName)) 
+        self.subscribeUpstream(streamName)
+
+    def makeBuffer(self, streamName, compactionKey = None):
+        if self.storageDirectory is None:
+            return AWSKinesisStream(streamName, compactionKey = compactionKey)
+        elif compactionKey is None:
+            return AWSKinesisDiskStream(streamName, directory = self.storageDirectory)
+        else:
+            raise AWSError("Disk backed streams can not be compacted")
+
+    def close(self):
+        """Release the storage of all buffered streams, e.g. at the end of a run"""
+        for stream in self.bufferedStreams.values():
+            stream.close()
+
+    def subscribeUpstream(self, streamName):
+        if not self.hasUpstreamSubscription(streamName):
+            self.sendUpstreamSubscription(streamName)
+
+    def hasUpstreamSubscription(self, streamName):
+        """Whether the upstream subscription to the stream is live - a lease
+        is live until it lapses, a permanent subscription once it is sent"""
+        if streamName not in self.upstreamSubscriptions:
+            return False
+        elif self.leaseDuration > 0:
+            return self.upstreamSubscriptions[streamName] + self.leaseDuration > self.region.env.now
+        else:
+            return True
+
+    def sendUpstreamSubscription(self, streamName):
+        self.upstreamSubscriptions[streamName] = self.region.env.now
+        if self.leaseDuration > 0:
+            message = self.make_message(('subscribe', streamName, self.leaseDuration))
+            if streamName not in self.renewalTimers:
+                self.scheduleRenewal(streamName)
+        else:
+            message = self.make_message(('subscribe', streamName)) 
+            if self.resubscriptionInterval > 0 and streamName not in self.resubscriptionTimers:
+                timers = TimerService.forEnvironment(self.region.env)
+                self.resubscriptionTimers[streamName] = timers.schedulePeriodic(self.resubscriptionInterval,
+                        lambda: self.sendUpstreamSubscription(streamName))
         self.region.send(message)
 
-    def consume(self, streamName):
+    def getRenewalTime(self, streamName):
+        return self.upstreamSubscriptions[streamName] + self.leaseDuration * (1 - self.renewalMargin)
+
+    def scheduleRenewal(self, streamName):
+        timers = TimerService.forEnvironment(self.region.env)
+        delay = self.getRenewalTime(streamName) - self.region.env.now
+        self.renewalTimers[streamName] = timers.scheduleOnce(delay, lambda: self.renewLease(streamName))
+
+    def renewLease(self, streamName):
+        ## Delta requests sent since the timer was set have already renewed the lease
+        if self.getRenewalTime(streamName) > self.region.env.now:
+            self.scheduleRenewal(streamName)
+        else:
+            del self.renewalTimers[streamName]
+            self.sendUpstreamSubscription(streamName)
+
+    def requestDelta(self, streamName):
+        position = self.streamPositions.get(streamName, 0)
+        if self.leaseDuration > 0 and streamName in self.upstreamSubscriptions:
+            self.upstreamSubscriptions[streamName] = self.region.env.now
+        payload = self.make_message(('request stream delta', streamName, position))
+        self.region.send(payload)
+
+    def consume(self, streamName, fromSequence = 0):
         self.verifyStreamExists(streamName)
-        return list(self.bufferedStreams[streamName])
+        self.cleanupStream(streamName)
+        return self.bufferedStreams[streamName].read(fromSequence)
+
+    def iterate(self, streamName, fromSequence = 0):
+        self.verifyStreamExists(streamName)
+        self.cleanupStream(streamName)
+        return self.bufferedStreams[streamName].iterate(fromSequence)
+
+    def getNextSequence(self, streamName):
+        self.verifyStreamExists(streamName)
+        return self.bufferedStreams[streamName].nextSequence
+
+    def cleanupStream(self, streamName):
+        if self.ttl > 0:
+            self.bufferedStreams[streamName].expire(self.region.env.now - self.ttl)
 
     def publish(self, streamName, message):
         if not isinstance(message, AWSKinesisPayload):
@@ -265,6 +828,18 @@ class AWSRemoteKinesis(AWSRemoteService):
         payload = self.make_message(('publish', streamName, message)) 
         self.region.send(payload)
 
+    def putRecords(self, streamName, messages):
+        """Send a batch of records to the remote Kinesis as a single message"""
+        for message in messages:
+            if not isinstance(message, AWSKinesisPayload):
+                raise AWSError("Invalid message format")
+
+        if not messages:
+            return
+
+        payload = self.make_message(('put records', streamName, list(messages)))
+        self.region.send(payload)
+
     def createStream(self, streamName):
         payload = self.make_message(('create stream', streamName)) 
         self.region.send(payload)
@@ -273,33 +848,70 @@ class AWSRemoteKinesis(AWSRemoteService):
         self.checkMessageIntegrity(message)
 
         if message.payload[0] == 'notify':
-            payload = self.make_message(('request stream content', message.payload[1])) 
-            self.region.send(payload)
+            self.requestDelta(message.payload[1])
+        elif message.payload[0] == 'stream delta':
+            self.appendDelta(message.payload[1], message.payload[2], message.payload[3])
+            self.notifySubscribers(message.payload[1])
+        elif message.payload[0] == 'stream push':
+            self.receivePush(message.payload[1], message.payload[2], message.payload[3])
         elif message.payload[0] == 'stream content':
             streamName = message.payload[1]
-            self.bufferedStreams[streamName] = message.payload[2]
+            compactionKey = None
+            if streamName in self.bufferedStreams:
+                compactionKey = self.bufferedStreams[streamName].compactionKey
+                self.bufferedStreams[streamName].close()
+            stream = self.makeBuffer(streamName, compactionKey)
+            for record in message.payload[2]:
+                stream.append(record)
+            self.bufferedStreams[streamName] = stream
             self.notifySubscribers(streamName)
         else:
             raise AWSError('Could not parse message')
 
+    def appendDelta(self, streamName, records, nextSequence):
+        if streamName not in self.bufferedStreams:
+            self.bufferedStreams[streamName] = self.makeBuffer(streamName)
+
+        stream = self.bufferedStreams[streamName]
+        position = self.streamPositions.get(streamName, 0)
+
+        for sequence, record in records:
+            # Replies to concurrent requests overlap - skip records already seen
+            if sequence >= position:
+                stream.append(record, sequence)
+                position = sequence + 1
+
+        self.streamPositions[streamName] = max(position, nextSequence)
+        self.cleanupStream(streamName)
+
+    def receivePush(self, streamName, records, nextSequence):
+        position = self.streamPositions.get(streamName, 0)
+
+        if records and records[0][0] > position:
+            # Earlier records were lost or never seen - fetch everything from our position
+            self.requestDelta(streamName)
+        else:
+            self.appendDelta(streamName, records, nextSequence)
+            self.notifySubscribers(streamName)
+
     def notifySubscribers(self, streamName):
-        for subscriber in self.localSubscriptions[streamName]:
-            sender = self.getAWSIdentifier()
-            subscriberId = subscriber.getAWSIdentifier() 
+        sender = self.getAWSIdentifier()
+        for subscriberId in self.localSubscriptions[streamName].values():
             payload = AWSKinesisSubscriberNotification(sender, subscriberId, streamName)
             self.region.send(payload)
 
+    @validation.checked(validation.skip)
     def checkMessageIntegrity(self, message):
-        if message.sender.regionName != self.remoteRegionName:
+        if message.sender.regionId != self.remoteRegionId:
             raise AWSError('Remote region name mismatch')
 
-        if message.sender.receiverName != 'Kinesis':
+        if message.sender.serviceId != self.remoteServiceId:
             raise AWSError('Message does not come from Kinesis')
 
-        if message.receiver.regionName != self.region.regionName:
+        if message.receiver.regionId != self.region.regionId:
             raise AWSError('Local region name mismatch')
 
-        if message.receiver.receiverName != self.serviceName:
+        if message.receiver.serviceId != self.serviceId:
             raise AWSError('Service name mismatch')
 
         if type(message.payload) != type(tuple()):
@@ -323,7 +935,8 @@ class AWSIdentifierInstance(IdentifierBehaviour, AWSIdentifier):
     pass
 
 class AWSMessage(Message):
-    
+
+    @validation.checked(validation.INHERIT)
     def __init__(self, sender, receiver, payload):
         if not isinstance(sender, AWSIdentifier):
             raise AWSError("Type error: expected AWSIdentifier for sender")
@@ -344,6 +957,12 @@ class AWSKinesisSubscriberNotification(AWSKinesisMessage):
         self.streamName = streamName
         super(AWSKinesisSubscriberNotification, self).__init__(sender, receiver, payload)
 
+class AWSKinesisStreamPush(AWSKinesisMessage):
+
+    def __init__(self, sender, receiver, streamName, records, nextSequence):
+        payload = ("stream push", streamName, records, nextSequence)
+        super(AWSKinesisStreamPush, self).__init__(sender, receiver, payload)
+
 class AWSKinesisPayload(object):
     def __init__(self, timestamp, sender, payload):
         self.timestamp = timestamp
@@ -356,6 +975,12 @@ class AWSKinesisStreamContent(AWSKinesisMessage):
         payload = ("stream content", streamName, content)
         super(AWSKinesisStreamContent, self).__init__(sender, receiver, payload)
 
+class AWSKinesisStreamDelta(AWSKinesisMessage):
+
+    def __init__(self, sender, receiver, streamName, records, nextSequence):
+        payload = ("stream delta", streamName, records, nextSequence)
+        super(AWSKinesisStreamDelta, self).__init__(sender, receiver, payload)
+
 
 class AWSRoute53(object):
     """A class that represents the Route 53 functionality. Route 53 is supposed to be a global service, 
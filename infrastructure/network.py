@@ -3,7 +3,11 @@
 # Networking components for SIM simulator
 
 import simpy
+import heapq
 import random
+from collections import deque
+from infrastructure import networkmodels
+from infrastructure.region import MessageBundle
 
 class NetworkError(Exception):
     pass
@@ -14,16 +18,96 @@ class NetworkPathError(NetworkError):
 class SideAlreadyConnectedError(NetworkPathError):
     pass
 
+class DropPolicy(object):
+    """Decides whether a path with a bounded buffer accepts a message"""
+
+    def admit(self, networkPath):
+        raise NetworkPathError("Not implemented")
+
+class TailDropPolicy(DropPolicy):
+    """Drop new messages while the buffer is full"""
+
+    def admit(self, networkPath):
+        return networkPath.occupancy() < networkPath.capacity
+
+class RandomEarlyDropPolicy(DropPolicy):
+    """Drop new messages with a probability rising linearly from zero at
+    minThreshold of the capacity to one when the buffer is full
+
+    Drop decisions are drawn in blocks from a NumPy generator seeded with
+    seed, a randomGenerator is called once per decision instead."""
+
+    def __init__(self, minThreshold = 0.5, randomGenerator = None, seed = None):
+        self.minThreshold = minThreshold
+        if randomGenerator is None:
+            if networkmodels.numpy is not None:
+                randomGenerator = networkmodels.UniformSampler(seed).nextSample
+            else:
+                randomGenerator = random.Random(seed).random
+        self.randomGenerator = randomGenerator
+
+    def admit(self, networkPath):
+        start = self.minThreshold * networkPath.capacity
+        occupancy = networkPath.occupancy()
+        if occupancy < start:
+            return True
+        if occupancy >= networkPath.capacity:
+            return False
+        return self.randomGenerator() >= (occupancy - start) / (networkPath.capacity - start)
+
+class DropOldestPolicy(DropPolicy):
+    """Make room for new messages by dropping the one at the head of the
+    buffer - its sender's onCongestion callback is told about the drop"""
+
+    def admit(self, networkPath):
+        while networkPath.occupancy() >= networkPath.capacity:
+            networkPath.dropHead()
+        return True
+
 class NetworkPath(object):
-    """A standard, unidirectional network path, that connects two objects"""
+    """A standard, unidirectional network path, that connects two objects
+
+    By default messages in flight are kept in a FIFO queue and handed to the
+    right side's localReceive by one scheduled callback per arrival tick.
+    With queued = False every message is sent through its own process and
+    buffered in a simpy.Store, which the right side drains after being
+    notified via notifyNetworkReceive.
+
+    A latencyModel draws each message's latency, latency then only is the
+    nominal latency of the path. Messages overtaken by a faster one are
+    held back to keep FIFO order, unless reorder is set - in that case
+    messages in flight are kept in a heap ordered by arrival.
+
+    With a capacity at most that many messages are in flight, the
+    dropPolicy (tail drop by default) decides which ones are dropped.
+    Senders may pass an onCongestion callback to send, it is called with
+    the path, the payload and whether the payload was dropped when the
+    buffer is filled beyond congestionThreshold of its capacity."""
+
+    congestionThreshold = 0.8
+
+    def __init__(self, env, name = None, latency = 0, queued = True, latencyModel = None, reorder = False, capacity = None, dropPolicy = None):
+        if capacity is not None and not queued:
+            raise NetworkPathError("Only queued paths can be bounded")
+        if capacity is not None and capacity < 1:
+            raise NetworkPathError("Bounded paths need room for at least one message")
 
-    def __init__(self, env, name = None, latency = 0):
         self.env = env
         self.name = name 
         self.latency = latency
+        self.queued = queued
+        self.latencyModel = latencyModel
+        self.reorder = reorder
         self.leftSide = None
         self.rightSide = None
         self.buffer = simpy.Store(env)
+        self.inFlight = deque()
+        self.reordered = []
+        self.reorderedArrivals = set()
+        self.sent = 0
+        self.capacity = capacity
+        self.dropPolicy = dropPolicy or TailDropPolicy()
+        self.dropped = 0
 
     def connectLeftSide(self, leftSide):
         if self.leftSide != None:
@@ -37,28 +121,204 @@ class NetworkPath(object):
         else:
             self.rightSide = rightSide
 
-    def send(self, payload):
-        self.env.process(self.sendLatency(payload))
+    def send(self, payload, onCongestion = None):
+        if self.capacity is not None:
+            congested = self.occupancy() >= self.congestionThreshold * self.capacity
+            if not self.dropPolicy.admit(self):
+                self.dropped += 1
+                if onCongestion is not None:
+                    onCongestion(self, payload, True)
+                return
+            if congested and onCongestion is not None:
+                onCongestion(self, payload, False)
+
+        if self.queued:
+            self.enqueue(payload, onCongestion)
+        else:
+            self.env.process(self.sendLatency(payload))
+
+    def occupancy(self):
+        """Messages currently in flight on a queued path"""
+        return len(self.inFlight) + len(self.reordered)
+
+    def dropHead(self):
+        """Drop the message at the head of the buffer and tell its sender"""
+        self.dropped += 1
+        if self.reordered:
+            arrival, sent, payload, onCongestion = heapq.heappop(self.reordered)
+        else:
+            arrival, payload, onCongestion = self.inFlight.popleft()
+        if onCongestion is not None:
+            onCongestion(self, payload, True)
+
+    def nextLatency(self):
+        if self.latencyModel is None:
+            return self.latency
+        return self.latencyModel.nextLatency()
+
+    def departure(self, payload):
+        """Time the payload leaves the sending side"""
+        return self.env.now
+
+    def enqueue(self, payload, onCongestion = None):
+        """Put payload in flight - the sender's onCongestion callback is
+        kept with it in case it is dropped from the buffer later"""
+        now = self.env.now
+        delay = self.departure(payload) + self.nextLatency() - now
+        # Arrivals are kept as the time SimPy schedules them at, which may
+        # differ in the last bit from departure plus latency
+        arrival = now + delay
+
+        if self.reorder:
+            self.enqueueReordered(arrival, payload, onCongestion)
+            return
+
+        # Held back behind slower messages, arrivals are in send order. Only
+        # the first message of an arrival tick needs a scheduled delivery.
+        if self.inFlight and self.inFlight[-1][0] >= arrival:
+            arrival = self.inFlight[-1][0]
+        else:
+            self.env.timeout(delay).callbacks.append(self.deliver)
+
+        self.inFlight.append((arrival, payload, onCongestion))
+
+    def enqueueReordered(self, arrival, payload, onCongestion = None):
+        # The send counter breaks ties, keeping payloads out of comparisons
+        heapq.heappush(self.reordered, (arrival, self.sent, payload, onCongestion))
+        self.sent += 1
+
+        if arrival not in self.reorderedArrivals:
+            self.reorderedArrivals.add(arrival)
+            self.env.timeout(arrival - self.env.now).callbacks.append(self.deliverReordered)
+
+    def deliver(self, event = None):
+        inFlight = self.inFlight
+        now = self.env.now
+        while inFlight and inFlight[0][0] <= now:
+            self.rightSide.localReceive(inFlight.popleft()[1])
+
+    def deliverReordered(self, event = None):
+        reordered = self.reordered
+        now = self.env.now
+        self.reorderedArrivals.discard(now)
+        while reordered and reordered[0][0] <= now:
+            self.rightSide.localReceive(heapq.heappop(reordered)[2])
 
     def sendLatency(self, payload):
-        yield self.env.timeout(self.latency)
+        yield self.env.timeout(self.nextLatency())
 
         self.buffer.put(payload)
-        self.env.process(self.rightSide.notifyNetworkReceive(self))
+        self.rightSide.notifyNetworkReceive(self)
 
     def receive(self):
         return self.buffer.get()
 
+    def drain(self):
+        """Remove and return all messages waiting in the buffer"""
+        items = self.buffer.items
+        self.buffer.items = []
+        return items
+
+def estimateSize(payload, depth = 3):
+    """Rough size in bytes of a payload, following nested attributes and
+    containers depth levels deep"""
+    if payload is None or isinstance(payload, (bool, int, float)):
+        return 8
+    if isinstance(payload, (str, bytes)):
+        return len(payload)
+    if depth == 0:
+        return 8
+    if isinstance(payload, MessageBundle):
+        ## Bundled messages are sized as if they were sent on their own
+        return 16 + sum(estimateSize(message, depth) for message in payload.payload)
+    if isinstance(payload, dict):
+        return 16 + sum(estimateSize(k, depth - 1) + estimateSize(v, depth - 1) for k, v in payload.items())
+    if isinstance(payload, (tuple, list, set, deque)):
+        return 16 + sum(estimateSize(item, depth - 1) for item in payload)
+    if hasattr(payload, '__dict__'):
+        return 16 + sum(estimateSize(value, depth - 1) for value in vars(payload).values())
+    return 8
+
+class BandwidthLimitedNetworkPath(NetworkPath):
+    """NetworkPath with a link of bandwidth bytes per tick
+
+    Messages are serialized one after another, each taking its size (by
+    sizeEstimator) divided by bandwidth, and queue up while the link is
+    busy. The path keeps track of its queue depth and utilisation."""
+
+    def __init__(self, env, name = None, latency = 0, bandwidth = 1000, sizeEstimator = estimateSize, latencyModel = None, capacity = None, dropPolicy = None):
+        super(BandwidthLimitedNetworkPath, self).__init__(env, name, latency, True, latencyModel, False, capacity, dropPolicy)
+        self.bandwidth = bandwidth
+        self.sizeEstimator = sizeEstimator
+        self.busyUntil = env.now
+        self.busyTime = 0
+        self.bytesSent = 0
+        self.messagesSent = 0
+        self.transmissions = deque()
+        self.maxQueueDepth = 0
+        self.startTime = env.now
+
+    def departure(self, payload):
+        now = self.env.now
+        size = self.sizeEstimator(payload)
+        duration = size / self.bandwidth
+
+        start = max(now, self.busyUntil)
+        self.busyUntil = start + duration
+        self.busyTime += duration
+        self.bytesSent += size
+        self.messagesSent += 1
+
+        self.transmissions.append(self.busyUntil)
+        self.maxQueueDepth = max(self.maxQueueDepth, self.queueDepth())
+        return self.busyUntil
+
+    def queueDepth(self):
+        """Messages waiting for or in transmission"""
+        transmissions = self.transmissions
+        now = self.env.now
+        while transmissions and transmissions[0] <= now:
+            transmissions.popleft()
+        return len(transmissions)
+
+    def utilisation(self):
+        """Share of time the link was busy since the path was created"""
+        elapsed = self.env.now - self.startTime
+        if elapsed <= 0:
+            return 0.0
+        return (self.busyTime - max(0, self.busyUntil - self.env.now)) / elapsed
+
 class LossyNetworkPath(NetworkPath):
-    """Same as NetworkPath but randomly loses events"""
+    """Same as NetworkPath but randomly loses events
 
-    def __init__(self, env, name = None, latency = 0, lossProbability = 0, randomGenerator = random.random):
-        super(LossyNetworkPath, self).__init__(env, name, latency)
-        self.lossProbability = lossProbability
-        self.randomGenerator = randomGenerator
+    Losses are decided by a loss model, by default independent losses
+    drawn in blocks from a NumPy generator seeded with seed. Passing a
+    randomGenerator calls it once per message instead, which is also the
+    fallback without numpy."""
+
+    def __init__(self, env, name = None, latency = 0, lossProbability = 0, randomGenerator = None, queued = True, lossModel = None, seed = None, latencyModel = None, reorder = False, capacity = None, dropPolicy = None):
+        super(LossyNetworkPath, self).__init__(env, name, latency, queued, latencyModel, reorder, capacity, dropPolicy)
+
+        if lossModel is None:
+            if randomGenerator is None and networkmodels.numpy is not None:
+                lossModel = networkmodels.BernoulliLossModel(lossProbability, seed)
+            else:
+                lossModel = networkmodels.RandomGeneratorLossModel(lossProbability, randomGenerator or random.Random(seed).random)
+        self.lossModel = lossModel
+
+    @property
+    def lossProbability(self):
+        return self.lossModel.lossProbability
+
+    @lossProbability.setter
+    def lossProbability(self, lossProbability):
+        try:
+            self.lossModel.lossProbability = lossProbability
+        except AttributeError:
+            raise NetworkPathError("Loss probability of %s is fixed by its %s" % (self.name, type(self.lossModel).__name__))
 
-    def send(self, payload):
-        if self.randomGenerator() <= self.lossProbability:
+    def send(self, payload, onCongestion = None):
+        if self.lossModel.isLost():
             pass # Packet was lost
         else:
-            super(LossyNetworkPath, self).send(payload)
+            super(LossyNetworkPath, self).send(payload, onCongestion)
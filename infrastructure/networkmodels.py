@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+#
+# Loss and latency models for network paths of SIM simulator
+#
+# Models draw their random numbers in blocks from a per-model NumPy
+# generator, so deciding the fate of a single message is an index into a
+# precomputed list. Seeding a model makes its decisions reproducible.
+
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class NetworkModelError(Exception):
+    pass
+
+def makeGenerator(seed = None):
+    if numpy is None:
+        raise NetworkModelError("Network models need numpy")
+    return numpy.random.default_rng(seed)
+
+class BlockSampler(object):
+    """Hands out precomputed samples one by one, drawing a new block once
+    the current one is exhausted"""
+
+    def __init__(self, seed = None, blockSize = 4096):
+        self.generator = makeGenerator(seed)
+        self.blockSize = blockSize
+        self.block = []
+        self.index = 0
+
+    def drawBlock(self):
+        raise NetworkModelError("Not implemented")
+
+    def nextSample(self):
+        if self.index == len(self.block):
+            ## Python lists index faster than numpy arrays
+            self.block = self.drawBlock().tolist()
+            self.index = 0
+        sample = self.block[self.index]
+        self.index += 1
+        return sample
+
+class UniformSampler(BlockSampler):
+    """Uniform samples from [0, 1)"""
+
+    def drawBlock(self):
+        return self.generator.random(self.blockSize)
+
+
+class LossModel(object):
+
+    def isLost(self):
+        raise NetworkModelError("Not implemented")
+
+class RandomGeneratorLossModel(LossModel):
+    """Independent losses decided by calling randomGenerator per message"""
+
+    def __init__(self, lossProbability = 0, randomGenerator = random.random):
+        self.lossProbability = lossProbability
+        self.randomGenerator = randomGenerator
+
+    def isLost(self):
+        return self.randomGenerator() <= self.lossProbability
+
+class BernoulliLossModel(LossModel, BlockSampler):
+    """Independent losses - lossProbability may be changed at any time"""
+
+    def __init__(self, lossProbability = 0, seed = None, blockSize = 4096):
+        BlockSampler.__init__(self, seed, blockSize)
+        self.lossProbability = lossProbability
+
+    def drawBlock(self):
+        return self.generator.random(self.blockSize)
+
+    def isLost(self):
+        return self.nextSample() < self.lossProbability
+
+class GilbertElliottLossModel(LossModel, BlockSampler):
+    """Burst losses of a two state (good/bad) Markov chain
+
+    After each message the chain moves from good to bad with probability
+    goodToBad and back with badToGood. Messages are lost with lossGood or
+    lossBad depending on the state. The state sequence of a block is built
+    from geometrically distributed run lengths."""
+
+    def __init__(self, goodToBad, badToGood, lossGood = 0.0, lossBad = 1.0, seed = None, blockSize = 4096):
+        BlockSampler.__init__(self, seed, blockSize)
+        self.goodToBad = goodToBad
+        self.badToGood = badToGood
+        self.lossGood = lossGood
+        self.lossBad = lossBad
+        ## Current state and the messages left in its run, None once the
+        ## chain is in a state it never leaves
+        self.bad = False
+        self.remaining = self.runLength(False)
+
+    @property
+    def lossProbability(self):
+        """Long run share of lost messages"""
+        if self.goodToBad + self.badToGood == 0:
+            return self.lossBad if self.bad else self.lossGood
+        shareBad = self.goodToBad / (self.goodToBad + self.badToGood)
+        return shareBad * self.lossBad + (1 - shareBad) * self.lossGood
+
+    def leaveProbability(self, bad):
+        return self.badToGood if bad else self.goodToBad
+
+    def runLength(self, bad):
+        leave = self.leaveProbability(bad)
+        if leave <= 0:
+            return None
+        return int(self.generator.geometric(leave))
+
+    def drawStates(self):
+        states = numpy.empty(self.blockSize, dtype = bool)
+        filled = 0
+        while filled < self.blockSize:
+            space = self.blockSize - filled
+            if self.remaining is None or self.remaining >= space:
+                states[filled:] = self.bad
+                if self.remaining is not None:
+                    self.remaining -= space
+                break
+
+            states[filled:filled + self.remaining] = self.bad
+            filled += self.remaining
+            self.bad = not self.bad
+            filled = self.drawRuns(states, filled)
+        return states
+
+    def drawRuns(self, states, filled):
+        """Fill states with alternating runs starting with the current state,
+        at most up to the end of the block - the run crossing the end is
+        kept as the current run"""
+        leaveFirst = self.leaveProbability(self.bad)
+        leaveSecond = self.leaveProbability(not self.bad)
+        if leaveFirst <= 0 or leaveSecond <= 0:
+            ## Runs are long or final, the caller fills them one by one
+            self.remaining = self.runLength(self.bad)
+            return filled
+
+        space = self.blockSize - filled
+        pairs = int(space / (1 / leaveFirst + 1 / leaveSecond)) + 2
+        runs = numpy.empty(2 * pairs, dtype = numpy.int64)
+        runs[0::2] = self.generator.geometric(leaveFirst, pairs)
+        runs[1::2] = self.generator.geometric(leaveSecond, pairs)
+        runStates = numpy.empty(2 * pairs, dtype = bool)
+        runStates[0::2] = self.bad
+        runStates[1::2] = not self.bad
+
+        ends = numpy.cumsum(runs)
+        last = int(numpy.searchsorted(ends, space))
+        if last == runs.size:
+            ## All runs fit, the next one starts with the current state again
+            states[filled:filled + ends[-1]] = numpy.repeat(runStates, runs)
+            self.bad = not self.bad
+            self.remaining = 0
+            return filled + int(ends[-1])
+
+        self.remaining = int(ends[last]) - space
+        runs[last] -= self.remaining
+        states[filled:] = numpy.repeat(runStates[:last + 1], runs[:last + 1])
+        self.bad = bool(runStates[last])
+        return self.blockSize
+
+    def drawBlock(self):
+        states = self.drawStates()
+        lossProbabilities = numpy.where(states, self.lossBad, self.lossGood)
+        return self.generator.random(self.blockSize) < lossProbabilities
+
+    def isLost(self):
+        return self.nextSample()
+
+
+class LatencyModel(object):
+
+    def nextLatency(self):
+        raise NetworkModelError("Not implemented")
+
+    def mean(self):
+        raise NetworkModelError("Not implemented")
+
+class ConstantLatencyModel(LatencyModel):
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def nextLatency(self):
+        return self.latency
+
+    def mean(self):
+        return self.latency
+
+class ShiftedLognormalLatencyModel(LatencyModel, BlockSampler):
+    """Latency of shift plus a lognormal jitter with parameters mu and sigma"""
+
+    def __init__(self, shift, mu = 0.0, sigma = 1.0, seed = None, blockSize = 4096):
+        BlockSampler.__init__(self, seed, blockSize)
+        self.shift = shift
+        self.mu = mu
+        self.sigma = sigma
+
+    def drawBlock(self):
+        return self.shift + self.generator.lognormal(self.mu, self.sigma, self.blockSize)
+
+    def nextLatency(self):
+        return self.nextSample()
+
+    def mean(self):
+        return self.shift + numpy.exp(self.mu + self.sigma ** 2 / 2)
+
+class EmpiricalLatencyModel(LatencyModel, BlockSampler):
+    """Latencies drawn from a histogram of observed latencies and weights"""
+
+    def __init__(self, latencies, weights = None, seed = None, blockSize = 4096):
+        BlockSampler.__init__(self, seed, blockSize)
+        if not latencies:
+            raise NetworkModelError("Empirical latency model needs at least one latency")
+
+        self.latencies = numpy.asarray(latencies)
+        if weights is None:
+            weights = numpy.ones(len(latencies))
+        weights = numpy.asarray(weights, dtype = float)
+        self.probabilities = weights / weights.sum()
+
+    @classmethod
+    def fromFile(cls, path, seed = None, blockSize = 4096):
+        """Read a histogram file - one latency and optional weight per
+        line, blank lines and lines starting with # are skipped"""
+        latencies = []
+        weights = []
+        with open(path) as histogram:
+            for line in histogram:
+                fields = line.split()
+                if not fields or fields[0].startswith('#'):
+                    continue
+                latencies.append(float(fields[0]))
+                weights.append(float(fields[1]) if len(fields) > 1 else 1.0)
+        return cls(latencies, weights, seed, blockSize)
+
+    def drawBlock(self):
+        return self.generator.choice(self.latencies, self.blockSize, p = self.probabilities)
+
+    def nextLatency(self):
+        return self.nextSample()
+
+    def mean(self):
+        return float(numpy.dot(self.latencies, self.probabilities))
@@ -2,21 +2,72 @@
 #
 # Generic region functionality
 from util.helper import singleton
+from infrastructure import validation
+from collections import deque
 
 class RegionError(Exception):
     pass
 
+class AddressTable(object):
+    """Compact integer addresses handed out to names in order of first use"""
+
+    def __init__(self):
+        self.addresses = {}
+        self.names = []
+
+    def address(self, name):
+        address = self.addresses.get(name)
+        if address is None:
+            address = self.addresses[name] = len(self.names)
+            self.names.append(name)
+        return address
+
+    def name(self, address):
+        return self.names[address]
+
+## Regions and services are addressed by name - the same name always has
+## the same address, so identifiers get theirs without knowing the region
+regionAddresses = AddressTable()
+serviceAddresses = AddressTable()
+
+def setTableEntry(table, address, entry):
+    """Set entry of a routing table (list indexed by address), growing it
+    as needed"""
+    if address >= len(table):
+        table.extend([None] * (address + 1 - len(table)))
+    table[address] = entry
+
+def getTableEntry(table, address):
+    if address < len(table):
+        return table[address]
+    return None
+
 class Region(object):
+    """Region hosting services and connected to other regions by network paths
+
+    Services and connected regions are kept by name for lookups and by
+    address in routing tables, which message dispatch goes through."""
 
     def __init__(self, env, regionName):
         self.env = env
         self.regionName = regionName
+        self.regionId = regionAddresses.address(regionName)
         self.connectedRegions = {}
         self.services = {}
+        ## Routing tables: network path by region address, service by service address
+        self.routes = []
+        self.serviceTable = []
+        self.pendingPaths = deque()
+        self.inboundDispatcher = None
+        self.inboundWakeup = None
+        ## Egress bundling is off while egressWindow is None
+        self.egressWindow = None
+        self.egressBundles = {}
 
     def connectRegion(self, otherRegion, networkPath):
         if otherRegion.regionName not in self.connectedRegions:
             self.connectedRegions[otherRegion.regionName] = (otherRegion, networkPath)
+            setTableEntry(self.routes, otherRegion.regionId, networkPath)
             networkPath.connectLeftSide(self)
             networkPath.connectRightSide(otherRegion)
         else:
@@ -36,24 +87,77 @@ class Region(object):
             otherRegion = self.connectedRegions[otherRegionName][0]
             return self.getLatency(otherRegionName) + otherRegion.getLatency(self.regionName)
 
-    def send(self, message):
+    def trustedSend(self, message, onCongestion = None):
+        self.sendToRegion(message.receiver.regionName, message.receiver.receiverName, message, onCongestion)
+
+    @validation.checked(trustedSend)
+    def send(self, message, onCongestion = None):
         if not isinstance(message, Message):
             raise RegionError("Message is not of type Message")
         else:
-            self.sendToRegion(message.receiver.regionName, message.receiver.receiverName, message)
+            self.sendToRegion(message.receiver.regionName, message.receiver.receiverName, message, onCongestion)
 
-    def sendToRegion(self, regionName, service, message):
+    def trustedSendToRegion(self, regionName, service, message, onCongestion = None):
+        """Route message by the address of its receiver"""
+        regionId = message.receiver.regionId
+        if regionId == self.regionId:
+            self.localReceive(message)
+        else:
+            networkPath = self.routes[regionId]
+            if self.egressWindow is not None:
+                self.addToBundle(regionId, message, onCongestion)
+            else:
+                networkPath.send(message, onCongestion)
+
+    @validation.checked(trustedSendToRegion)
+    def sendToRegion(self, regionName, service, message, onCongestion = None):
+        """Send message to service in region - onCongestion is passed on
+        to the network path, which calls it when its buffer fills up"""
         if not isinstance(message, Message):
             raise RegionError("Message is not of type AWSMessage")
         elif regionName != message.receiver.regionName:
             raise RegionError("Receiver region in mesage does not match target region")
-        elif regionName == self.regionName:
-            self.localReceive(message)
-        elif regionName not in self.connectedRegions:
+        elif regionName != self.regionName and regionName not in self.connectedRegions:
             raise RegionError('No path to region %s' % regionName)
         else:
-            networkPath = self.connectedRegions[regionName][1]
-            networkPath.send(message)
+            self.trustedSendToRegion(regionName, service, message, onCongestion)
+
+    def enableEgressBundling(self, window = 0):
+        """Collect messages to each remote region for window ticks (0 means
+        the rest of the current tick) and ship them as one MessageBundle"""
+        self.egressWindow = window
+
+    def addToBundle(self, regionId, message, onCongestion):
+        pending = self.egressBundles.get(regionId)
+        if pending is None:
+            pending = self.egressBundles[regionId] = []
+            self.env.timeout(self.egressWindow).callbacks.append(lambda event: self.flushBundle(regionId))
+        pending.append((message, onCongestion))
+
+    def flushBundle(self, regionId):
+        pending = self.egressBundles.pop(regionId)
+        networkPath = self.routes[regionId]
+        if len(pending) == 1:
+            message, onCongestion = pending[0]
+            payload = message
+        else:
+            messages = [message for message, _ in pending]
+            payload = MessageBundle(Identifier(self.regionName, MessageBundle.RECEIVER),
+                                    Identifier(regionAddresses.name(regionId), MessageBundle.RECEIVER), messages)
+            onCongestion = self.bundleCongestionCallback(pending)
+
+        networkPath.send(payload, onCongestion)
+
+    def bundleCongestionCallback(self, pending):
+        """Congestion callback of a bundle, calling the callbacks of its messages"""
+        callbacks = [(message, onCongestion) for message, onCongestion in pending if onCongestion is not None]
+        if not callbacks:
+            return None
+
+        def onCongestion(path, payload, dropped):
+            for message, callback in callbacks:
+                callback(path, message, dropped)
+        return onCongestion
 
     def registerService(self, service, serviceName):
         if not isinstance(service, Service):
@@ -61,29 +165,49 @@ class Region(object):
 
         if serviceName not in self.services:
             self.services[serviceName] = service
+            setTableEntry(self.serviceTable, serviceAddresses.address(serviceName), service)
         else:
             raise RegionError("Service already registered")
 
     def notifyNetworkReceive(self, networkPath):
-        message = yield networkPath.receive()
-
+        """Called by a network path when messages are waiting in its buffer"""
+        self.pendingPaths.append(networkPath)
+
+        if self.inboundDispatcher is None:
+            self.inboundDispatcher = self.env.process(self.inboundBehaviour())
+        elif self.inboundWakeup is not None and not self.inboundWakeup.triggered:
+            self.inboundWakeup.succeed()
+
+    def inboundBehaviour(self):
+        """Long-lived dispatcher delivering messages of all incoming paths"""
+        while True:
+            while self.pendingPaths:
+                networkPath = self.pendingPaths.popleft()
+                for message in networkPath.drain():
+                    self.networkReceive(message)
+
+            self.inboundWakeup = self.env.event()
+            yield self.inboundWakeup
+
+    def trustedNetworkReceive(self, message):
+        self.localReceive(message)
+
+    @validation.checked(trustedNetworkReceive)
+    def networkReceive(self, message):
         if not isinstance(message, Message):
             raise RegionError("Message is not of type Message")
         else:
             self.localReceive(message)
 
-        receiver = message.receiver.receiverName
-        if receiver in self.services:
-            self.services[receiver].receive(message)
-        else:
-            raise RegionError("Service %s not registered" % receiver)
-
     def localReceive(self, message):
-        receiver = message.receiver.receiverName
-        if receiver in self.services:
-            self.services[receiver].receive(message)
+        service = getTableEntry(self.serviceTable, message.receiver.serviceId)
+        if service is not None:
+            service.receive(message)
+        elif isinstance(message, MessageBundle):
+            for bundled in message.payload:
+                self.localReceive(bundled)
         else:
-            raise RegionError("Service %s not registered" % receiver)
+            raise RegionError("Service %s not registered" % message.receiver.receiverName)
 
     def getServiceByName(self, serviceName):
         if serviceName in self.services:
@@ -99,6 +223,7 @@ class Service(object):
             raise RegionError("Type error: region needs to be of type AWSRegion")
         region.registerService(self, name)
         self.serviceName = name
+        self.serviceId = serviceAddresses.address(name)
         self.region = region
 
     def receive(self, message):
@@ -133,6 +258,12 @@ class IdentifierBehaviour(object):
     def __init__(self, regionName, receiverName):
         self.regionName = regionName
         self.receiverName = receiverName
+        self.regionId = regionAddresses.address(regionName)
+        self.serviceId = serviceAddresses.address(receiverName)
+
+    def __reduce__(self):
+        # Unpickle through the public identifier class to get the singleton back
+        return (self.__class__.__bases__[1], (self.regionName, self.receiverName))
 
 @singleton
 class IdentifierInstance(IdentifierBehaviour, Identifier):
@@ -140,7 +271,13 @@ class IdentifierInstance(IdentifierBehaviour, Identifier):
 
 
 class Message(object):
-    
+
+    def trustedInit(self, sender, receiver, payload):
+        self.sender = sender
+        self.receiver = receiver
+        self.payload = payload
+
+    @validation.checked(trustedInit)
     def __init__(self, sender, receiver, payload):
         if not isinstance(sender, Identifier):
             raise RegionError("Type error: expected Identifier for sender")
@@ -156,3 +293,10 @@ class Message(object):
         return self.__class__(self.receiver, self.sender, payload)
 
 
+class MessageBundle(Message):
+    """Messages from one region to another shipped together by egress
+    bundling - the payload is the list of messages in send order"""
+
+    RECEIVER = 'Region Egress'
+
+
@@ -0,0 +1,3 @@
+## The tests check errors raised by validation, whatever SIM_VALIDATION says
+from infrastructure import validation
+validation.setMode(validation.STRICT)
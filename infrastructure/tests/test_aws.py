@@ -5,6 +5,12 @@ from util.builder import awsbuilder, clientbuilder
 from infrastructure.tests.test_region import * 
 from infrastructure.region import *
 
+def mockRegion(regionName = 'test-region'):
+    region = Mock(AWSRegion)
+    region.regionName = regionName
+    region.regionId = regionAddresses.address(regionName)
+    return region
+
 class TestAWSRegion(TestRegion):
     CLASS = AWSRegion
     IdentifierCLASS = AWSIdentifier
@@ -39,13 +45,13 @@ class TestAWSKinesis(unittest.TestCase):
     
     def test_setup(self):
         """AWSKinesis can be correctly instantiated"""
-        r1 = Mock(AWSRegion)
+        r1 = mockRegion()
         kinesis = AWSKinesis(r1, Mock())
         r1.registerService.assert_called_with(kinesis, 'Kinesis')
 
     def test_givenAKinesisServiceWhenCreatingAStreamThenStreamIsCreated(self):
         """Given a kinesis - when creating a stream - then stream is created"""
-        r1 = Mock(AWSRegion)
+        r1 = mockRegion()
         kinesis = AWSKinesis(r1, Mock())
         kinesis.createStream('testStream')
         self.assertTrue('testStream' in kinesis.streams)
@@ -55,7 +61,7 @@ class TestAWSKinesis(unittest.TestCase):
         STREAM_NAME = 'testStream'
         TEST_MESSAGE = AWSKinesisPayload(0, Mock(), 'Test Message')
 
-        r1 = Mock(AWSRegion)
+        r1 = mockRegion()
         kinesis = AWSKinesis(r1, Mock())
         kinesis.createStream(STREAM_NAME)
         
@@ -69,7 +75,7 @@ class TestAWSKinesis(unittest.TestCase):
         TEST_MESSAGE1 = AWSKinesisPayload(0, Mock(), 'Test Message1')
         TEST_MESSAGE2 = AWSKinesisPayload(0, Mock(), 'Test Message2')
 
-        r1 = Mock(AWSRegion)
+        r1 = mockRegion()
         kinesis = AWSKinesis(r1, Mock())
         kinesis.createStream(STREAM_NAME1)
         kinesis.createStream(STREAM_NAME2)
@@ -83,12 +89,60 @@ class TestAWSKinesis(unittest.TestCase):
         self.assertFalse(TEST_MESSAGE1 in kinesis.consume(STREAM_NAME2))
         self.assertFalse(TEST_MESSAGE2 in kinesis.consume(STREAM_NAME1))
 
+    def test_givenAKinesisWithAStreamWhenConsumingFromASequenceNumberThenOnlyNewerRecordsAreReturned(self):
+        """Given a kinesis with a stream - when consuming from a sequence number - then only newer records are returned"""
+        STREAM_NAME = 'testStream'
+        MESSAGES = [AWSKinesisPayload(i, Mock(), i) for i in range(0, 5)]
+
+        r1 = mockRegion()
+        kinesis = AWSKinesis(r1, Mock())
+        kinesis.createStream(STREAM_NAME)
+
+        for message in MESSAGES[:3]:
+            kinesis.publish(STREAM_NAME, message)
+
+        position = kinesis.getNextSequence(STREAM_NAME)
+        self.assertEqual(position, 3)
+
+        for message in MESSAGES[3:]:
+            kinesis.publish(STREAM_NAME, message)
+
+        self.assertEqual(kinesis.consume(STREAM_NAME, position), MESSAGES[3:])
+        self.assertEqual(kinesis.consume(STREAM_NAME), MESSAGES)
+        self.assertEqual(list(kinesis.iterate(STREAM_NAME, position)), [(3, MESSAGES[3]), (4, MESSAGES[4])])
+        self.assertEqual(kinesis.consume(STREAM_NAME, kinesis.getNextSequence(STREAM_NAME)), [])
+
+    def test_givenACompactedKinesisStreamWhenPublishingManyRecordsPerKeyThenOnlyTheLatestRecordsAreRetained(self):
+        """Given a compacted kinesis stream - when publishing many records per key - then the stream stays bounded and consumers see the latest record per updated key"""
+        STREAM_NAME = 'testStream'
+        SENDERS = ['a', 'b', 'c']
+
+        r1 = mockRegion()
+        kinesis = AWSKinesis(r1, Mock())
+        kinesis.createStream(STREAM_NAME, compactionKey = lambda record: record.sender)
+
+        latest = {}
+        for i in range(0, 100):
+            record = AWSKinesisPayload(i, SENDERS[i % len(SENDERS)], i)
+            kinesis.publish(STREAM_NAME, record)
+            latest[record.sender] = record
+            self.assertLessEqual(len(kinesis.streams[STREAM_NAME]), 2 * len(SENDERS))
+
+        position = kinesis.getNextSequence(STREAM_NAME)
+        for i in range(0, 20):
+            kinesis.publish(STREAM_NAME, AWSKinesisPayload(100 + i, 'a', i))
+        latest['a'] = kinesis.consume(STREAM_NAME)[-1]
+
+        self.assertTrue(set(latest.values()) <= set(kinesis.consume(STREAM_NAME)))
+        self.assertEqual([record.sender for record in kinesis.consume(STREAM_NAME, position)][-1], 'a')
+        self.assertNotIn('b', [record.sender for record in kinesis.consume(STREAM_NAME, position)])
+
     def test_givenAKinesisServiceWithAregisteredStreamWhenTryingToCreateTheSameStreamAgainThenAnExceptionGetsThrown(self):
         """Given a kinesis with a registered stream - when trying to create the same stream again - then an exception gets thrown"""
         STREAM_NAME = 'testStream'
         TEST_MESSAGE = 'Test Message'
 
-        r1 = Mock(AWSRegion)
+        r1 = mockRegion()
         kinesis = AWSKinesis(r1, Mock())
         kinesis.createStream(STREAM_NAME)
         
@@ -101,12 +155,10 @@ class TestAWSKinesis(unittest.TestCase):
         '''Given a Kinesis having a stream - when a service, that is not a remote kinesis tries to subscribe - then a exception is thrown'''
         STREAM_NAME  = 'testStream'
         TEST_MESSAGE = 'Test Message'
-        TARGET_REGION = Mock(AWSRegion)
-        TARGET_REGION.regionName = 'target-region'
+        TARGET_REGION = mockRegion('target-region')
         TARGET_SERVICE = AWSService(TARGET_REGION, 'TEST-Service-1')
 
-        r1 = Mock(AWSRegion)
-        r1.regionName = "foo-region"
+        r1 = mockRegion("foo-region")
         r1.sendToRegion = Mock()
         kinesis = AWSKinesis(r1, Mock())
         kinesis.createStream(STREAM_NAME)
@@ -119,13 +171,11 @@ class TestAWSKinesis(unittest.TestCase):
 
     def test_givenAKinesisHavinAStreamWithASubscriberWhenPublishingToStreamThenSubscriberIsNotified(self):
         '''Given a Kinesis having a stream with a subscriber - when publishing to stream - then subscriber is notified'''
-        r1 = Mock(AWSRegion)
-        r1.regionName = "foo-region"
+        r1 = mockRegion("foo-region")
 
         STREAM_NAME  = 'testStream'
         TEST_MESSAGE = AWSKinesisPayload(0, Mock(), 'Test Message')
-        TARGET_REGION = Mock(AWSRegion)
-        TARGET_REGION.regionName = 'target-region'
+        TARGET_REGION = mockRegion('target-region')
         TARGET_SERVICE = AWSService(TARGET_REGION, 'RemoteKinesis_%s' % r1.regionName)
 
         r1.sendToRegion = Mock()
@@ -143,18 +193,14 @@ class TestAWSKinesis(unittest.TestCase):
         STREAM_NAME  = 'testStream'
         TEST_MESSAGE = AWSKinesisPayload(0, Mock(), 'Test Message')
         KINESIS_REGION = "foo-region"
-        TARGET_REGION1 = Mock(AWSRegion)
-        TARGET_REGION1.regionName = 'target-region1'
-        TARGET_REGION2 = Mock(AWSRegion)
-        TARGET_REGION2.regionName = 'target-region2'
-        TARGET_REGION3 = Mock(AWSRegion)
-        TARGET_REGION3.regionName = 'target-region3'
+        TARGET_REGION1 = mockRegion('target-region1')
+        TARGET_REGION2 = mockRegion('target-region2')
+        TARGET_REGION3 = mockRegion('target-region3')
         TARGET_SERVICE1 = AWSRemoteKinesis(TARGET_REGION1, KINESIS_REGION)
         TARGET_SERVICE2 = AWSRemoteKinesis(TARGET_REGION2, KINESIS_REGION)
         TARGET_SERVICE3 = AWSRemoteKinesis(TARGET_REGION3, KINESIS_REGION)
 
-        r1 = Mock(AWSRegion)
-        r1.regionName = KINESIS_REGION
+        r1 = mockRegion(KINESIS_REGION)
         r1.sendToRegion = Mock()
         kinesis = AWSKinesis(r1, Mock())
         kinesis.createStream(STREAM_NAME)
@@ -169,6 +215,74 @@ class TestAWSKinesis(unittest.TestCase):
         self.verifyNotifyArguments(TARGET_REGION2.regionName, TARGET_SERVICE2.serviceName, STREAM_NAME, arguments[1])
         self.verifyNotifyArguments(TARGET_REGION3.regionName, TARGET_SERVICE3.serviceName, STREAM_NAME, arguments[2])
 
+    def test_givenAKinesisInPushModeWithARemoteSubscriberWhenPublishingThenNewRecordIsPushed(self):
+        """Given a kinesis in push mode with a remote subscriber - when publishing - then the new record is pushed to the subscriber"""
+        STREAM_NAME  = 'testStream'
+        KINESIS_REGION = "foo-region"
+        TEST_MESSAGE = AWSKinesisPayload(0, Mock(), 'Test Message')
+        TARGET_REGION = mockRegion('target-region')
+        TARGET_SERVICE = AWSRemoteKinesis(TARGET_REGION, KINESIS_REGION)
+
+        r1 = mockRegion(KINESIS_REGION)
+        r1.sendToRegion = Mock()
+        kinesis = AWSKinesis(r1, Mock(), pushReplication = True)
+        kinesis.createStream(STREAM_NAME)
+        kinesis.subscribe(STREAM_NAME, TARGET_SERVICE) 
+        kinesis.publish(STREAM_NAME, TEST_MESSAGE)
+
+        arguments = r1.sendToRegion.call_args
+        self.assertEqual(arguments[0][0], TARGET_REGION.regionName)
+        self.assertTrue(isinstance(arguments[0][2], AWSKinesisStreamPush))
+        self.assertEqual(arguments[0][2].payload, ('stream push', STREAM_NAME, [(0, TEST_MESSAGE)], 1))
+
+    def test_givenAKinesisWithASubscriberWhenPuttingABatchOfRecordsThenAllRecordsAreAppendedAndSubscriberIsNotifiedOnce(self):
+        """Given a kinesis with a subscriber - when putting a batch of records - then all records are appended and the subscriber is notified once"""
+        STREAM_NAME  = 'testStream'
+        KINESIS_REGION = "foo-region"
+        MESSAGES = [AWSKinesisPayload(i, Mock(), i) for i in range(0, 10)]
+        TARGET_REGION = mockRegion('target-region')
+        TARGET_SERVICE = AWSRemoteKinesis(TARGET_REGION, KINESIS_REGION)
+
+        r1 = mockRegion(KINESIS_REGION)
+        r1.sendToRegion = Mock()
+        kinesis = AWSKinesis(r1, Mock())
+        kinesis.createStream(STREAM_NAME)
+        kinesis.subscribe(STREAM_NAME, TARGET_SERVICE) 
+        kinesis.putRecords(STREAM_NAME, MESSAGES)
+
+        self.assertEqual(kinesis.consume(STREAM_NAME), MESSAGES)
+        self.assertEqual(r1.sendToRegion.call_count, 1)
+        self.verifyNotifyArguments(TARGET_REGION.regionName, TARGET_SERVICE.serviceName, STREAM_NAME, r1.sendToRegion.call_args)
+
+    def test_givenAKinesisWithASubscriberWhenPuttingAnEmptyBatchThenTheSubscriberIsNotNotified(self):
+        """Given a kinesis with a subscriber - when putting an empty batch - then the subscriber is not notified"""
+        STREAM_NAME  = 'testStream'
+        KINESIS_REGION = "foo-region"
+        TARGET_SERVICE = AWSRemoteKinesis(mockRegion('target-region'), KINESIS_REGION)
+
+        r1 = mockRegion(KINESIS_REGION)
+        r1.sendToRegion = Mock()
+        kinesis = AWSKinesis(r1, Mock(), pushReplication = True)
+        kinesis.createStream(STREAM_NAME)
+        kinesis.subscribe(STREAM_NAME, TARGET_SERVICE)
+        kinesis.putRecords(STREAM_NAME, [])
+
+        self.assertEqual(kinesis.consume(STREAM_NAME), [])
+        r1.sendToRegion.assert_not_called()
+
+    def test_givenAKinesisWhenPuttingABatchContainingAnInvalidRecordThenNoRecordIsAppended(self):
+        """Given a kinesis - when putting a batch containing an invalid record - then no record is appended"""
+        STREAM_NAME  = 'testStream'
+
+        r1 = mockRegion()
+        kinesis = AWSKinesis(r1, Mock())
+        kinesis.createStream(STREAM_NAME)
+
+        with self.assertRaises(AWSKinesisError):
+            kinesis.putRecords(STREAM_NAME, [AWSKinesisPayload(0, Mock(), 0), 'invalid'])
+
+        self.assertEqual(kinesis.consume(STREAM_NAME), [])
+
     def verifyNotifyArguments(self, TARGET_REGION, TARGET_SERVICE, STREAM_NAME, arguments, typ = 'notify'):
         self.assertTrue(arguments[0][0] == TARGET_REGION)
         self.assertTrue(arguments[0][1] == TARGET_SERVICE)
@@ -184,8 +298,7 @@ class TestAWSKinesis(unittest.TestCase):
         REMOTE_REGION = 'remote-region'
         REMOTE_SERVICE = 'RemoteKinesis_%s' % KINESIS_REGION
 
-        r1 = Mock(AWSRegion)
-        r1.regionName = KINESIS_REGION
+        r1 = mockRegion(KINESIS_REGION)
         kinesis = AWSKinesis(r1, Mock())
         kinesis.createStream(STREAM_NAME)
 
@@ -205,8 +318,7 @@ class TestAWSKinesis(unittest.TestCase):
         REMOTE_REGION = 'remote-region'
         REMOTE_SERVICE = 'RemoteKinesis_%s' % KINESIS_REGION
 
-        r1 = Mock(AWSRegion)
-        r1.regionName = KINESIS_REGION
+        r1 = mockRegion(KINESIS_REGION)
         kinesis = AWSKinesis(r1, Mock())
 
         sender = AWSIdentifier(REMOTE_REGION, REMOTE_SERVICE)
@@ -227,8 +339,7 @@ class TestAWSKinesis(unittest.TestCase):
         REMOTE_SERVICE = 'RemoteKinesis_%s' % KINESIS_REGION
         PUBLISH_TEXT = AWSKinesisPayload(0, Mock(), 'a test message')
 
-        r1 = Mock(AWSRegion)
-        r1.regionName = KINESIS_REGION
+        r1 = mockRegion(KINESIS_REGION)
         kinesis = AWSKinesis(r1, Mock())
         kinesis.createStream(STREAM_NAME)
 
@@ -249,8 +360,7 @@ class TestAWSKinesis(unittest.TestCase):
         REMOTE_SERVICE = 'RemoteKinesis_%s' % KINESIS_REGION
         STREAM_CONTENT = [AWSKinesisPayload(0, Mock(), 1), AWSKinesisPayload(0, Mock(), 2), AWSKinesisPayload(0, Mock(), 3)]
 
-        r1 = Mock(AWSRegion)
-        r1.regionName = KINESIS_REGION
+        r1 = mockRegion(KINESIS_REGION)
         kinesis = AWSKinesis(r1, Mock())
         kinesis.createStream(STREAM_NAME)
 
@@ -272,6 +382,29 @@ class TestAWSKinesis(unittest.TestCase):
         self.assertEqual(arguments.sender, receiver)
         self.assertEqual(arguments.payload, ('stream content', STREAM_NAME, STREAM_CONTENT))
 
+    def test_givenAKinesisWhenReceivingARequestStreamDeltaMessageThenOnlyNewerRecordsAreSent(self):
+        """Given a kinesis - when receiving a request stream delta message - then only records from the requested sequence on are sent"""
+        STREAM_NAME = 'testStream'
+        KINESIS_REGION = 'foo-region'
+        REMOTE_REGION = 'remote-region'
+        REMOTE_SERVICE = 'RemoteKinesis_%s' % KINESIS_REGION
+        STREAM_CONTENT = [AWSKinesisPayload(0, Mock(), 1), AWSKinesisPayload(0, Mock(), 2), AWSKinesisPayload(0, Mock(), 3)]
+
+        r1 = mockRegion(KINESIS_REGION)
+        kinesis = AWSKinesis(r1, Mock())
+        kinesis.createStream(STREAM_NAME)
+
+        for content in STREAM_CONTENT:
+            kinesis.publish(STREAM_NAME, content)
+
+        sender = AWSIdentifier(REMOTE_REGION, REMOTE_SERVICE)
+        receiver = AWSIdentifier(KINESIS_REGION, 'Kinesis')
+        kinesis.receive(AWSMessage(sender, receiver, ('request stream delta', STREAM_NAME, 1)))
+
+        arguments = r1.send.call_args[0][0]
+        self.assertEqual(arguments.receiver, sender)
+        self.assertEqual(arguments.payload, ('stream delta', STREAM_NAME, [(1, STREAM_CONTENT[1]), (2, STREAM_CONTENT[2])], 3))
+
     def test_givenAKinesisWithATTLSetThenTTLBehaviourIsTriggered(self):
         """Given a kinesis - with a TTL set - then TTL behaviour is triggered"""
         STREAM_NAME = 'testStream'
@@ -279,22 +412,20 @@ class TestAWSKinesis(unittest.TestCase):
         TIMEOUT = 1
         SAMPLE_MESSAGE = AWSKinesisPayload(0, Mock(), 'test-message')
 
-        r1 = Mock(AWSRegion)
-        r1.regionName = KINESIS_REGION
+        r1 = mockRegion(KINESIS_REGION)
         env = Mock()
+        env.now = 0
         kinesis = AWSKinesis(r1, env, TIMEOUT)
         kinesis.createStream(STREAM_NAME)
         kinesis.publish(STREAM_NAME, SAMPLE_MESSAGE)
 
-        generator = kinesis.startBehaviour()
-        self.assertTrue(env.timeout.called_with(TIMEOUT))
+        env.timeout.assert_called_with(TIMEOUT)
+        self.assertEqual(kinesis.ttlTimer.at, TIMEOUT)
 
         self.assertTrue(SAMPLE_MESSAGE in kinesis.consume(STREAM_NAME))
-        generator = env.process.call_args[0][0]
         env.now = 30
-        next(generator)
-        next(generator)
-        self.kinesis = kinesis
+        kinesis.timers.fire(kinesis.ttlTimer.at)
+        self.assertIsNone(kinesis.ttlTimer)
         self.assertFalse(SAMPLE_MESSAGE in kinesis.consume(STREAM_NAME))
         
 
@@ -305,6 +436,89 @@ class TestAWSKinesis(unittest.TestCase):
  
 
 
+class TestAWSKinesisDiskStream(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = AWSKinesisDiskStream('testStream', segmentRecords = 4)
+
+    def tearDown(self):
+        self.stream.close()
+
+    def test_givenADiskStreamWhenAppendingRecordsThenRecordsCanBeReadFromASequenceNumber(self):
+        """Given a disk backed stream - when appending records - then records can be read back from a sequence number"""
+        sender = AWSIdentifier('test-region', 'SIM_0')
+        for i in range(0, 10):
+            self.stream.append(AWSKinesisPayload(i, sender, 'payload %i' % i))
+
+        self.assertEqual(len(self.stream), 10)
+        self.assertEqual(len(self.stream.segments), 3)
+        self.assertEqual([record.payload for record in self.stream.read(7)], ['payload 7', 'payload 8', 'payload 9'])
+        self.assertEqual([sequence for sequence, record in self.stream.iterate(8)], [8, 9])
+        self.assertTrue(self.stream.first().sender is sender)
+
+    def test_givenADiskStreamWhenExpiringRecordsThenFullyExpiredSegmentsAreDeleted(self):
+        """Given a disk backed stream - when expiring records - then records are hidden and fully expired segments are deleted"""
+        for i in range(0, 10):
+            self.stream.append(AWSKinesisPayload(i, None, i))
+        firstSegment = self.stream.segments[0]
+
+        self.assertEqual(self.stream.expire(2), 3)
+        self.assertEqual(self.stream.firstTimestamp(), 3)
+        self.assertEqual(len(self.stream.segments), 3)
+
+        self.assertEqual(self.stream.expire(5), 3)
+        self.assertEqual(len(self.stream.segments), 2)
+        self.assertFalse(os.path.exists(firstSegment.path + '.seg'))
+        self.assertEqual([record.payload for record in self.stream.read()], [6, 7, 8, 9])
+
+        self.stream.expire(9)
+        self.assertEqual(len(self.stream), 0)
+        self.assertEqual(len(self.stream.segments), 0)
+        self.assertEqual(self.stream.append(AWSKinesisPayload(10, None, 10)), 10)
+        self.assertEqual([record.payload for record in self.stream.read()], [10])
+
+
+    def test_givenADiskStreamWhenASegmentIsFullThenItsFilesAreClosedAndRecordsAreStillReadable(self):
+        """Given a disk backed stream - when a segment is full - then its files are closed and its records are still readable"""
+        for i in range(0, 6):
+            self.stream.append(AWSKinesisPayload(i, None, i))
+
+        self.assertTrue(self.stream.segments[0].dataFile.closed)
+        self.assertIsNone(self.stream.segments[0].data)
+        self.assertFalse(self.stream.segments[1].dataFile.closed)
+        self.assertEqual(self.stream.firstTimestamp(), 0)
+        self.assertEqual([record.payload for record in self.stream.read(2)], [2, 3, 4, 5])
+
+    def test_givenADiskStreamWithManySealedSegmentsWhenReadingThenOnlyTheRecentlyReadSegmentsStayMapped(self):
+        """Given a disk backed stream with many sealed segments - when reading - then only the recently read segments stay mapped"""
+        for i in range(0, 40):
+            self.stream.append(AWSKinesisPayload(i, None, i))
+
+        self.assertEqual([record.payload for record in self.stream.read()], list(range(40)))
+        self.assertEqual(self.stream.get(1).payload, 1)
+
+        sealed = self.stream.segments[:-1]
+        mapped = [segment for segment in sealed if segment.isMapped()]
+        self.assertEqual(len(mapped), self.stream.maxOpenSegments)
+        self.assertIn(sealed[0], mapped)
+        self.assertEqual(list(self.stream.openSegments), mapped[1:] + [sealed[0]])
+
+    def test_givenADiskStreamWhenAppendingReplicatedRecordsWithGapsThenSequenceNumbersAreKept(self):
+        """Given a disk backed stream - when appending replicated records with gaps - then their sequence numbers are kept"""
+        for sequence in (3, 4, 9, 10):
+            self.stream.append(AWSKinesisPayload(sequence, None, sequence), sequence)
+
+        self.assertEqual(len(self.stream), 4)
+        self.assertEqual(self.stream.nextSequence, 11)
+        self.assertEqual([sequence for sequence, record in self.stream.iterate(5)], [9, 10])
+
+        self.assertEqual(self.stream.expire(4), 2)
+        self.assertEqual(self.stream.firstTimestamp(), 9)
+        self.assertEqual([record.payload for record in self.stream.read()], [9, 10])
+        with self.assertRaises(AWSKinesisError):
+            self.stream.append(AWSKinesisPayload(5, None, 5), 5)
+
+
 class TestAWSIdentifier(unittest.TestCase):
 
     def test_setup(self):
@@ -419,6 +633,16 @@ class TestAWSRemoteKinesis(unittest.TestCase):
         self.assertTrue(r.serviceName == 'RemoteKinesis_%s' % r.remoteRegionName)
         self.assertTrue(r.remoteServiceName == 'Kinesis')
 
+    def test_givenARegionWithRemoteKinesisWhenLookingUpByRegionAddressThenTheProxyIsReturned(self):
+        """Given a region with remote kinesis - when looking up by region address - then the proxy of that region is returned"""
+        region = awsbuilder.b.buildRegion()
+        remoteRegion = awsbuilder.b.buildRegion(regionName = 'remote-region')
+        remoteKinesis = awsbuilder.b.buildRemoteKinesis(localRegion = region, remoteRegionName = 'remote-region')
+
+        self.assertIs(region.getRemoteKinesis(remoteRegion.regionId), remoteKinesis)
+        with self.assertRaises(AWSError):
+            region.getRemoteKinesis(region.regionId)
+
     def test_givenARemoteKinesisAndAServiceInAnotherRegionWhenServiceTriesToSubscribeToRemoteKinesisThenSubscribeIsRejected(self):
         """Given a remote kinesis and a services in another region - when subscribing - then subscribe is rejected"""
         STREAM_NAME = 'remote-stream'
@@ -461,6 +685,48 @@ class TestAWSRemoteKinesis(unittest.TestCase):
         self.assertTrue(STREAM_NAME in remoteKinesis.bufferedStreams)
         self.assertTrue(localService in remoteKinesis.localSubscriptions[STREAM_NAME])
 
+    def test_givenARemoteKinesisWhenManyLocalServicesSubscribeInTheSameTickThenOneUpstreamSubscriptionIsSentAndAllAreNotified(self):
+        """Given a remote kinesis - when many local services subscribe in the same tick - then one upstream subscription is sent and all are notified"""
+        STREAM_NAME = 'remote-stream'
+        REMOTE_REGION_NAME = 'remote-region'
+
+        region = awsbuilder.b.buildRegion()
+        region.sendToRegion = Mock()
+        region.send = Mock(wraps = region.send)
+
+        remoteKinesis = awsbuilder.b.buildRemoteKinesis(localRegion = region, remoteRegionName = REMOTE_REGION_NAME)
+        services = [AWSService(region, 'Service_%i' % i) for i in range(5)]
+
+        for service in services:
+            remoteKinesis.subscribe(STREAM_NAME, service)
+            remoteKinesis.subscribe(STREAM_NAME, service)
+
+        self.assertEqual(region.sendToRegion.call_count, 1)
+        self.assertEqual(len(remoteKinesis.localSubscriptions[STREAM_NAME]), 5)
+
+        region.send.reset_mock()
+        remoteKinesis.notifySubscribers(STREAM_NAME)
+
+        receivers = [call[0][0].receiver for call in region.send.call_args_list]
+        self.assertEqual(receivers, [service.getAWSIdentifier() for service in services])
+
+    def test_givenARemoteKinesisWhenLocalServicesSubscribeAtDifferentTicksThenOnlyItsOwnTimerResendsTheUpstreamSubscription(self):
+        """Given a remote kinesis - when local services subscribe at different ticks - then only its own timer resends the upstream subscription"""
+        STREAM_NAME = 'remote-stream'
+        env = simpy.Environment()
+        region = awsbuilder.b.buildRegion(env)
+        region.sendToRegion = Mock()
+
+        remoteKinesis = AWSRemoteKinesis(region, 'remote-region', resubscriptionInterval = 100)
+        services = [AWSService(region, 'Service_%i' % i) for i in range(5)]
+        for i, service in enumerate(services):
+            env.run(until = i * 30 + 1)
+            remoteKinesis.subscribe(STREAM_NAME, service)
+
+        self.assertEqual(region.sendToRegion.call_count, 2)
+        self.assertEqual([call[0][2].payload for call in region.sendToRegion.call_args_list], [('subscribe', STREAM_NAME)] * 2)
+        self.assertEqual(len(remoteKinesis.localSubscriptions[STREAM_NAME]), 5)
+
     def test_givenARemoteKinesisHavingBufferedContentWhenConsumingThenBufferedContentIsReturned(self):
         """Given a remote kinesis having buffered content - when consuming - then the buffered content is returned"""
         STREAM_NAME = 'remote-stream'
@@ -474,7 +740,8 @@ class TestAWSRemoteKinesis(unittest.TestCase):
         localService = awsbuilder.b.buildLocalService(localRegion = region)
 
         remoteKinesis.subscribe(STREAM_NAME, localService)
-        remoteKinesis.bufferedStreams[STREAM_NAME] = BUFFERED_CONTENT
+        for record in BUFFERED_CONTENT:
+            remoteKinesis.bufferedStreams[STREAM_NAME].append(record)
 
         content = remoteKinesis.consume(STREAM_NAME)
         self.assertEqual(content, BUFFERED_CONTENT)
@@ -499,6 +766,24 @@ class TestAWSRemoteKinesis(unittest.TestCase):
         self.assertEqual(arguments[0][1], 'Kinesis')
         self.assertEqual(arguments[0][2].payload, ('publish', STREAM_NAME, MESSAGE))
 
+    def test_givenARemoteKinesisWhenPuttingABatchOfRecordsThenOneMessageToOtherRegionIsSent(self):
+        """Given a remote kinesis - when putting a batch of records - then one message to the other region is sent"""
+        STREAM_NAME = 'remote-stream'
+        REMOTE_REGION_NAME = 'remote-region'
+        MESSAGES = [AWSKinesisPayload(i, Mock(), i) for i in range(0, 10)]
+
+        region = awsbuilder.b.buildRegion()
+        region.sendToRegion = Mock()
+
+        remoteKinesis = awsbuilder.b.buildRemoteKinesis(localRegion = region, remoteRegionName = REMOTE_REGION_NAME)
+        remoteKinesis.putRecords(STREAM_NAME, MESSAGES)
+
+        self.assertEqual(region.sendToRegion.call_count, 1)
+        arguments = region.sendToRegion.call_args
+        self.assertEqual(arguments[0][0], REMOTE_REGION_NAME)
+        self.assertEqual(arguments[0][1], 'Kinesis')
+        self.assertEqual(arguments[0][2].payload, ('put records', STREAM_NAME, MESSAGES))
+
     def test_givenARemoteKinesisWithSubscribersWhenNotifySubscribersIsCalledThenCorrectSubscribersAreNotified(self):
         """Given a remote kinesis with subscribers - when notify subscribers is called - then correct subscribers are notified"""
         STREAM_NAME = 'remote-stream'
@@ -527,8 +812,8 @@ class TestAWSRemoteKinesis(unittest.TestCase):
         self.assertTrue(isinstance(arguments[0][2], AWSKinesisSubscriberNotification))
         self.assertEqual(arguments[0][2].payload, ('notify', STREAM_NAME))
 
-    def test_givenARemoteKinesisWhenReceivingANotifyThenStreamContentIsRequested(self):
-        """Given a remote kinesis - when receiving a notification - then stream content is requested"""
+    def test_givenARemoteKinesisWhenReceivingANotifyThenStreamDeltaIsRequested(self):
+        """Given a remote kinesis - when receiving a notification - then the records after the last seen sequence are requested"""
         STREAM_NAME = 'remote-stream'
         OTHER_STREAM_NAME = 'other-stream'
         REMOTE_REGION_NAME = 'remote-region'
@@ -550,7 +835,7 @@ class TestAWSRemoteKinesis(unittest.TestCase):
         self.assertEqual(arguments[0][0], REMOTE_REGION_NAME)
         self.assertEqual(arguments[0][1], 'Kinesis')
         self.assertTrue(isinstance(arguments[0][2], AWSMessage))
-        self.assertEqual(arguments[0][2].payload, ('request stream content', STREAM_NAME))
+        self.assertEqual(arguments[0][2].payload, ('request stream delta', STREAM_NAME, 0))
 
     def test_givenARemoteKinesisWhenReceivingStreamContentThenStreamContentIsStoredInBufferAndSubscribersNotified(self):
         """Given a remote kinesis - when receiving stream content - then stream content is stored in buffer and subscribers are notified"""
@@ -574,10 +859,10 @@ class TestAWSRemoteKinesis(unittest.TestCase):
         message2 = AWSKinesisStreamContent(sender, receiver, STREAM_NAME, STREAM_CONTENT2)
 
         remoteKinesis.receive(message1)
-        self.assertEqual(remoteKinesis.bufferedStreams[STREAM_NAME], STREAM_CONTENT1)
+        self.assertEqual(list(remoteKinesis.bufferedStreams[STREAM_NAME]), STREAM_CONTENT1)
 
         remoteKinesis.receive(message2)
-        self.assertEqual(remoteKinesis.bufferedStreams[STREAM_NAME], STREAM_CONTENT2)
+        self.assertEqual(list(remoteKinesis.bufferedStreams[STREAM_NAME]), STREAM_CONTENT2)
 
         self.assertTrue(region.sendToRegion.called)
         args = region.sendToRegion.call_args
@@ -587,6 +872,58 @@ class TestAWSRemoteKinesis(unittest.TestCase):
         self.assertEqual(args[0][2].sender.receiverName, 'RemoteKinesis_%s' % REMOTE_REGION_NAME)
         self.assertEqual(args[0][2].sender.regionName, region.regionName)
 
+    def test_givenARemoteKinesisWhenReceivingOverlappingStreamDeltasThenNewRecordsAreAppendedOnce(self):
+        """Given a remote kinesis - when receiving overlapping stream deltas - then new records are appended once and the position advances"""
+        STREAM_NAME = 'remote-stream'
+        REMOTE_REGION_NAME = 'remote-region'
+
+        region = awsbuilder.b.buildRegion()
+        region.sendToRegion = Mock()
+
+        remoteKinesis = awsbuilder.b.buildRemoteKinesis(localRegion = region, remoteRegionName = REMOTE_REGION_NAME)
+        localService1 = awsbuilder.b.buildLocalService(localRegion = region, serviceName = 'localService1')
+        remoteKinesis.subscribe(STREAM_NAME, localService1)
+
+        receiver = AWSIdentifier(region.regionName, remoteKinesis.serviceName)
+        sender = AWSIdentifier(REMOTE_REGION_NAME, 'Kinesis')
+
+        remoteKinesis.receive(AWSKinesisStreamDelta(sender, receiver, STREAM_NAME, [(0, 'a'), (1, 'b')], 2))
+        remoteKinesis.receive(AWSKinesisStreamDelta(sender, receiver, STREAM_NAME, [(0, 'a'), (1, 'b'), (2, 'c')], 3))
+
+        self.assertEqual(remoteKinesis.consume(STREAM_NAME), ['a', 'b', 'c'])
+        self.assertEqual(remoteKinesis.consume(STREAM_NAME, 2), ['c'])
+        self.assertEqual(remoteKinesis.streamPositions[STREAM_NAME], 3)
+
+        region.sendToRegion = Mock()
+        remoteKinesis.receive(AWSKinesisSubscriberNotification(sender, receiver, STREAM_NAME))
+        self.assertEqual(region.sendToRegion.call_args[0][2].payload, ('request stream delta', STREAM_NAME, 3))
+
+    def test_givenARemoteKinesisWhenReceivingAPushWithAGapThenMissingRecordsAreRequested(self):
+        """Given a remote kinesis - when receiving a push that does not follow the last seen sequence - then the missing records are requested"""
+        STREAM_NAME = 'remote-stream'
+        REMOTE_REGION_NAME = 'remote-region'
+
+        region = awsbuilder.b.buildRegion()
+        region.sendToRegion = Mock()
+
+        remoteKinesis = awsbuilder.b.buildRemoteKinesis(localRegion = region, remoteRegionName = REMOTE_REGION_NAME)
+        localService1 = awsbuilder.b.buildLocalService(localRegion = region, serviceName = 'localService1')
+        remoteKinesis.subscribe(STREAM_NAME, localService1)
+
+        receiver = AWSIdentifier(region.regionName, remoteKinesis.serviceName)
+        sender = AWSIdentifier(REMOTE_REGION_NAME, 'Kinesis')
+
+        region.sendToRegion = Mock()
+        remoteKinesis.receive(AWSKinesisStreamPush(sender, receiver, STREAM_NAME, [(0, 'a')], 1))
+        self.assertEqual(remoteKinesis.consume(STREAM_NAME), ['a'])
+        self.assertEqual(region.sendToRegion.call_args[0][1], localService1.serviceName)
+
+        region.sendToRegion = Mock()
+        remoteKinesis.receive(AWSKinesisStreamPush(sender, receiver, STREAM_NAME, [(2, 'c')], 3))
+        self.assertEqual(remoteKinesis.consume(STREAM_NAME), ['a'])
+        self.assertEqual(region.sendToRegion.call_count, 1)
+        self.assertEqual(region.sendToRegion.call_args[0][2].payload, ('request stream delta', STREAM_NAME, 1))
+
 
 class TestAWSLoadBalancer(unittest.TestCase):
 
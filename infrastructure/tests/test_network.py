@@ -1,8 +1,10 @@
 import unittest
 from unittest.mock import Mock, MagicMock
 from infrastructure.network import *
+from infrastructure.networkmodels import EmpiricalLatencyModel
 from util.builder import awsbuilder
 import util.simpy
+import simpy
 
 class TestNetworkPath(unittest.TestCase):
 
@@ -32,11 +34,11 @@ class TestNetworkPath(unittest.TestCase):
         self.assertEqual(np.rightSide, RIGHT_SIDE)
         self.assertNotEqual(LEFT_SIDE, RIGHT_SIDE)
 
-    def buildNetworkPathAndConnectBothSides(self, LEFT_SIDE = Mock(), RIGHT_SIDE = Mock(), ENV = Mock()):
+    def buildNetworkPathAndConnectBothSides(self, LEFT_SIDE = Mock(), RIGHT_SIDE = Mock(), ENV = Mock(), queued = True):
         NAME = "my-network-path"
         LATENCY = 1234
 
-        np = self.CLASS(ENV, NAME, LATENCY)
+        np = self.CLASS(ENV, NAME, LATENCY, queued = queued)
 
         np.connectLeftSide(LEFT_SIDE)
         np.connectRightSide(RIGHT_SIDE)
@@ -64,7 +66,7 @@ class TestNetworkPath(unittest.TestCase):
         env = Mock()
         payload = 'test'
 
-        np = self.buildNetworkPathAndConnectBothSides(leftSide, rightSide, env)
+        np = self.buildNetworkPathAndConnectBothSides(leftSide, rightSide, env, queued = False)
 
         np.send(payload)
         self.assertTrue(env.process.called)
@@ -89,6 +91,73 @@ class TestNetworkPath(unittest.TestCase):
         np.buffer._do_get(event)
         self.assertEqual(payload, event._item)
 
+    def test_givenAQueuedNetworkPathWhenSendingMultipleMessagesThenTheyAreDeliveredInOrderAfterLatencyWithOneEventPerTick(self):
+        """Given a queued network path - when sending multiple messages - then they are delivered in order after latency with one event per tick"""
+        LATENCY = 10
+        env = simpy.Environment()
+        rightSide = Mock()
+
+        np = self.CLASS(env, 'my-network-path', LATENCY)
+        np.connectLeftSide(Mock())
+        np.connectRightSide(rightSide)
+
+        np.send('first')
+        np.send('second')
+        self.assertEqual(len(env._queue), 1)
+
+        env.run(until = LATENCY)
+        rightSide.localReceive.assert_not_called()
+
+        env.run(until = LATENCY + 1)
+        self.assertEqual([c[0][0] for c in rightSide.localReceive.call_args_list], ['first', 'second'])
+        self.assertFalse(rightSide.notifyNetworkReceive.called)
+        self.assertEqual(len(np.inFlight), 0)
+
+    def test_givenANetworkPathWithJitterWhenSendingManyMessagesThenTheyArriveInOrderNotBeforeTheirLatency(self):
+        """Given a network path with jitter - when sending many messages - then they arrive in order, not before their latency"""
+        env = simpy.Environment()
+        received = []
+        rightSide = Mock()
+        rightSide.localReceive = lambda payload: received.append((env.now, payload))
+
+        np = self.CLASS(env, 'my-network-path', 10, latencyModel = EmpiricalLatencyModel([5, 30], seed = 1))
+        np.connectLeftSide(Mock())
+        np.connectRightSide(rightSide)
+
+        for i in range(200):
+            env.run(until = i + 1)
+            np.send(i)
+
+        env.run(until = 300)
+
+        self.assertEqual([payload for now, payload in received], list(range(200)))
+        for now, payload in received:
+            self.assertGreaterEqual(now, payload + 1 + 5)
+
+    def test_givenAReorderingNetworkPathWithJitterWhenSendingManyMessagesThenTheyArriveByTheirOwnLatency(self):
+        """Given a reordering network path with jitter - when sending many messages - then they arrive by their own latency"""
+        env = simpy.Environment()
+        received = []
+        rightSide = Mock()
+        rightSide.localReceive = lambda payload: received.append((env.now, payload))
+
+        np = self.CLASS(env, 'my-network-path', 10, latencyModel = EmpiricalLatencyModel([5, 30], seed = 1), reorder = True)
+        np.connectLeftSide(Mock())
+        np.connectRightSide(rightSide)
+
+        for i in range(200):
+            env.run(until = i + 1)
+            np.send(i)
+
+        env.run(until = 300)
+
+        self.assertEqual(sorted(payload for now, payload in received), list(range(200)))
+        self.assertNotEqual([payload for now, payload in received], list(range(200)))
+        for now, payload in received:
+            self.assertIn(now - (payload + 1), (5, 30))
+        self.assertEqual(len(np.reordered), 0)
+        self.assertEqual(len(np.reorderedArrivals), 0)
+
 
 class TestLossyNetworkPath(TestNetworkPath):
     CLASS = LossyNetworkPath
@@ -107,14 +176,156 @@ class TestLossyNetworkPath(TestNetworkPath):
         successfulSends = 0
 
         for i in range(0, RUNS):
-            np.sendLatency = Mock()
+            np.enqueue = Mock()
             np.send('test')
-            if np.sendLatency.called:
+            if np.enqueue.called:
                 successfulSends += 1
 
         self.assertLess(PROBABILITY - ACCEPTABLE_DEVIATION, round(successfulSends/RUNS, 2))
         self.assertGreater(PROBABILITY + ACCEPTABLE_DEVIATION, round(successfulSends/RUNS, 2))
 
 
+class TestBandwidthLimitedNetworkPath(unittest.TestCase):
+
+    def test_givenABandwidthLimitedNetworkPathWhenSendingABurstThenMessagesAreSerializedOneAfterAnother(self):
+        """Given a bandwidth limited network path - when sending a burst - then messages are serialized one after another"""
+        env = simpy.Environment()
+        received = []
+        rightSide = Mock()
+        rightSide.localReceive = lambda payload: received.append((env.now, payload))
+
+        np = BandwidthLimitedNetworkPath(env, 'my-network-path', 5, bandwidth = 10, sizeEstimator = lambda payload: 100)
+        np.connectLeftSide(Mock())
+        np.connectRightSide(rightSide)
+
+        for payload in ['first', 'second', 'third']:
+            np.send(payload)
+
+        self.assertEqual(np.queueDepth(), 3)
+        env.run(until = 12)
+        self.assertEqual(np.queueDepth(), 2)
+
+        env.run(until = 60)
+        self.assertEqual(received, [(15, 'first'), (25, 'second'), (35, 'third')])
+        self.assertEqual(np.queueDepth(), 0)
+        self.assertEqual(np.maxQueueDepth, 3)
+        self.assertEqual(np.bytesSent, 300)
+        self.assertAlmostEqual(np.utilisation(), 0.5)
+
+    def test_givenAFractionalSerializationTimeWhenSendingThenTheMessageIsDelivered(self):
+        """Given a fractional serialization time - when sending - then the message is delivered"""
+        SEND_TIME = 0.29040787574867943
+        env = simpy.Environment()
+        received = []
+        rightSide = Mock()
+        rightSide.localReceive = lambda payload: received.append(payload)
+
+        np = BandwidthLimitedNetworkPath(env, 'my-network-path', 5, bandwidth = 1, sizeEstimator = lambda payload: 0.6650749988191051)
+        np.connectLeftSide(Mock())
+        np.connectRightSide(rightSide)
+
+        env.timeout(SEND_TIME).callbacks.append(lambda event: np.send('message'))
+        env.run(until = 20)
+
+        self.assertEqual(received, ['message'])
+
+    def test_givenAPayloadWhenEstimatingItsSizeThenNestedContentIsCounted(self):
+        """Given a payload - when estimating its size - then nested content is counted"""
+        small = ('notify', 'stream')
+        large = ('stream content', 'stream', ['x' * 100] * 10)
+
+        self.assertEqual(estimateSize('x' * 100), 100)
+        self.assertGreater(estimateSize(large), 1000)
+        self.assertLess(estimateSize(small), 100)
+
+
+class TestBoundedNetworkPath(unittest.TestCase):
+
+    def buildBoundedPath(self, env, received, dropPolicy = None):
+        rightSide = Mock()
+        rightSide.localReceive = lambda payload: received.append(payload)
+
+        np = NetworkPath(env, 'my-network-path', 10, capacity = 5, dropPolicy = dropPolicy)
+        np.connectLeftSide(Mock())
+        np.connectRightSide(rightSide)
+        return np
+
+    def test_givenABoundedPathWithTailDropWhenOverloadedThenNewMessagesAreDroppedAndSenderIsSignalled(self):
+        """Given a bounded path with tail drop - when overloaded - then new messages are dropped and the sender is signalled"""
+        env = simpy.Environment()
+        received = []
+        signals = []
+        np = self.buildBoundedPath(env, received)
+
+        for i in range(8):
+            np.send(i, lambda path, payload, dropped: signals.append((payload, dropped)))
+
+        env.run(until = 20)
+
+        self.assertEqual(received, [0, 1, 2, 3, 4])
+        self.assertEqual(np.dropped, 3)
+        self.assertEqual(signals, [(4, False), (5, True), (6, True), (7, True)])
+
+    def test_givenABoundedPathDroppingOldestWhenOverloadedThenTheNewestMessagesArrive(self):
+        """Given a bounded path dropping oldest - when overloaded - then the newest messages arrive"""
+        env = simpy.Environment()
+        received = []
+        signals = []
+        np = self.buildBoundedPath(env, received, DropOldestPolicy())
+
+        for i in range(8):
+            np.send(i, lambda path, payload, dropped: signals.append((payload, dropped)))
+            self.assertLessEqual(np.occupancy(), 5)
+
+        env.run(until = 20)
+
+        self.assertEqual(received, [3, 4, 5, 6, 7])
+        self.assertEqual(np.dropped, 3)
+        ## Evicted messages are reported to their own sender
+        self.assertEqual([signal for signal in signals if signal[1]], [(0, True), (1, True), (2, True)])
+
+    def test_givenABoundedPathWithRandomEarlyDropWhenFillingUpThenDropsStartAtTheThreshold(self):
+        """Given a bounded path with random early drop - when filling up - then drops start at the threshold"""
+        env = simpy.Environment()
+        received = []
+        np = self.buildBoundedPath(env, received, RandomEarlyDropPolicy(0.4, lambda: 0.5))
+
+        for i in range(8):
+            np.send(i)
+
+        env.run(until = 20)
+
+        ## Occupancy 2 -> drop probability 0, 3 -> 1/3, 4 -> 2/3 (dropped by 0.5), 5 -> full
+        self.assertEqual(received, [0, 1, 2, 3])
+        self.assertEqual(np.dropped, 4)
+
+    def test_givenTwoBoundedPathsWithRandomEarlyDropAndTheSameSeedWhenOverloadedThenTheSameMessagesAreDropped(self):
+        """Given two bounded paths with random early drop and the same seed - when overloaded - then the same messages are dropped"""
+        delivered = []
+        for i in range(2):
+            env = simpy.Environment()
+            received = []
+            np = self.buildBoundedPath(env, received, RandomEarlyDropPolicy(0.2, seed = 11))
+            for tick in range(50):
+                env.run(until = tick + 1)
+                np.send(tick)
+                np.send(-tick)
+            env.run(until = 70)
+            delivered.append(received)
+
+        self.assertEqual(delivered[0], delivered[1])
+        self.assertLess(len(delivered[0]), 100)
+
+    def test_givenAnUnqueuedPathWhenBoundingItThenItIsRejected(self):
+        """Given an unqueued path - when bounding it - then it is rejected"""
+        with self.assertRaises(NetworkPathError):
+            NetworkPath(Mock(), 'my-network-path', 10, queued = False, capacity = 5)
+
+    def test_givenACapacityOfZeroWhenBoundingAPathThenItIsRejected(self):
+        """Given a capacity of zero - when bounding a path - then it is rejected"""
+        with self.assertRaises(NetworkPathError):
+            NetworkPath(Mock(), 'my-network-path', 10, capacity = 0, dropPolicy = DropOldestPolicy())
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,134 @@
+import unittest
+import itertools
+import os
+import tempfile
+import tracemalloc
+from unittest.mock import Mock, MagicMock
+from infrastructure.network import *
+from infrastructure.networkmodels import *
+
+class TestLossModels(unittest.TestCase):
+
+    def test_givenTwoBernoulliLossModelsWithTheSameSeedWhenDecidingLossesThenDecisionsAreEqualAndMatchTheProbability(self):
+        """Given two bernoulli loss models with the same seed - when deciding losses - then decisions are equal and match the probability"""
+        RUNS = 20000
+
+        m1 = BernoulliLossModel(0.25, seed = 42, blockSize = 1000)
+        m2 = BernoulliLossModel(0.25, seed = 42, blockSize = 1000)
+
+        losses1 = [m1.isLost() for i in range(RUNS)]
+        losses2 = [m2.isLost() for i in range(RUNS)]
+
+        self.assertEqual(losses1, losses2)
+        self.assertAlmostEqual(sum(losses1) / RUNS, 0.25, delta = 0.02)
+
+    def test_givenABernoulliLossModelWhenChangingTheProbabilityThenFollowingDecisionsUseIt(self):
+        """Given a bernoulli loss model - when changing the probability - then following decisions use it"""
+        model = BernoulliLossModel(1.0, seed = 1)
+        self.assertTrue(all(model.isLost() for i in range(100)))
+
+        model.lossProbability = 0
+        self.assertFalse(any(model.isLost() for i in range(100)))
+
+    def test_givenAGilbertElliottLossModelWhenDecidingLossesThenLossesComeInBurstsAtTheStationaryRate(self):
+        """Given a gilbert elliott loss model - when deciding losses - then losses come in bursts at the stationary rate"""
+        RUNS = 200000
+
+        model = GilbertElliottLossModel(0.01, 0.2, seed = 7, blockSize = 1000)
+        losses = [model.isLost() for i in range(RUNS)]
+
+        self.assertAlmostEqual(sum(losses) / RUNS, model.lossProbability, delta = 0.01)
+        bursts = [len(list(group)) for lost, group in itertools.groupby(losses) if lost]
+        self.assertAlmostEqual(sum(bursts) / len(bursts), 1 / 0.2, delta = 0.5)
+
+    def test_givenAGilbertElliottLossModelWithoutRecoveryWhenDecidingLossesThenTheBadStateIsNeverLeft(self):
+        """Given a gilbert elliott loss model without recovery - when deciding losses over many blocks - then the bad state is never left"""
+        model = GilbertElliottLossModel(0.1, 0.0, seed = 2, blockSize = 50)
+        losses = [model.isLost() for i in range(1000)]
+
+        firstLoss = losses.index(True)
+        self.assertTrue(all(losses[firstLoss:]))
+        self.assertFalse(any(losses[:firstLoss]))
+
+    def test_givenAGilbertElliottLossModelWithRareTransitionsWhenDrawingBlocksThenOnlyTheBlockIsExpanded(self):
+        """Given a gilbert elliott loss model with rare transitions - when drawing blocks - then only the block of the current run is expanded"""
+        model = GilbertElliottLossModel(1e-8, 0.5, seed = 1, blockSize = 100)
+
+        tracemalloc.start()
+        blocks = [model.drawStates() for i in range(10)]
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        self.assertLess(peak, 100000)
+        self.assertFalse(any(block.any() for block in blocks))
+        self.assertEqual([block.size for block in blocks], [100] * 10)
+        self.assertGreater(model.remaining, 1000)
+
+    def test_givenTwoLossyNetworkPathsWithTheSameSeedWhenSendingThenTheSameMessagesGetLost(self):
+        """Given two lossy network paths with the same seed - when sending - then the same messages get lost"""
+        paths = [LossyNetworkPath(Mock(), 'path', 10, 0.5, seed = 3) for i in range(2)]
+
+        delivered = []
+        for path in paths:
+            path.enqueue = Mock()
+            for i in range(1000):
+                path.send(i)
+            delivered.append([c[0][0] for c in path.enqueue.call_args_list])
+
+        self.assertEqual(delivered[0], delivered[1])
+        self.assertLess(len(delivered[0]), 600)
+        self.assertGreater(len(delivered[0]), 400)
+
+    def test_givenALossyNetworkPathWithABurstLossModelWhenSendingThenTheModelDecides(self):
+        """Given a lossy network path with a burst loss model - when sending - then the model decides"""
+        model = GilbertElliottLossModel(0.0, 1.0, lossGood = 0.0, seed = 1, blockSize = 50)
+        path = LossyNetworkPath(Mock(), 'path', 10, lossModel = model)
+        path.enqueue = Mock()
+
+        for i in range(1000):
+            path.send(i)
+
+        self.assertEqual(path.enqueue.call_count, 1000)
+        self.assertEqual(path.lossProbability, 0.0)
+
+    def test_givenALossyNetworkPathWithABurstLossModelWhenChangingTheLossProbabilityThenChangeIsRejected(self):
+        """Given a lossy network path with a burst loss model - when changing the loss probability - then the change is rejected"""
+        path = LossyNetworkPath(Mock(), 'path', 10, lossModel = GilbertElliottLossModel(0.1, 0.5, seed = 1))
+
+        with self.assertRaises(NetworkPathError):
+            path.lossProbability = 0.9
+
+class TestLatencyModels(unittest.TestCase):
+
+    def test_givenAShiftedLognormalLatencyModelWhenSamplingThenLatenciesExceedTheShiftAndMatchTheMean(self):
+        """Given a shifted lognormal latency model - when sampling - then latencies exceed the shift and match the mean"""
+        RUNS = 50000
+
+        model = ShiftedLognormalLatencyModel(40, 1.0, 0.5, seed = 5, blockSize = 1000)
+        latencies = [model.nextLatency() for i in range(RUNS)]
+
+        self.assertGreater(min(latencies), 40)
+        self.assertAlmostEqual(sum(latencies) / RUNS, model.mean(), delta = 0.1)
+
+    def test_givenAHistogramFileWhenLoadingAnEmpiricalLatencyModelThenLatenciesFollowTheWeights(self):
+        """Given a histogram file - when loading an empirical latency model - then latencies follow the weights"""
+        RUNS = 20000
+
+        handle, path = tempfile.mkstemp()
+        with os.fdopen(handle, 'w') as histogram:
+            histogram.write("# latency weight\n10 3\n\n50 1\n")
+
+        try:
+            model = EmpiricalLatencyModel.fromFile(path, seed = 9)
+        finally:
+            os.remove(path)
+
+        latencies = [model.nextLatency() for i in range(RUNS)]
+
+        self.assertEqual(set(latencies), set([10, 50]))
+        self.assertAlmostEqual(latencies.count(10) / RUNS, 0.75, delta = 0.02)
+        self.assertEqual(model.mean(), 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
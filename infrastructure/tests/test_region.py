@@ -3,6 +3,7 @@ from unittest.mock import Mock, MagicMock
 from infrastructure.region import *
 from infrastructure.network import *
 from util.builder import awsbuilder
+import simpy
 
 class TestRegion(unittest.TestCase):
     CLASS = Region
@@ -48,7 +49,7 @@ class TestRegion(unittest.TestCase):
 
         r1.sendToRegion('region2', 'test', message)
 
-        r1ToR2.send.assert_called_with(message)
+        r1ToR2.send.assert_called_with(message, None)
 
     def test_givenTwoRegionsConnectedOverNetworkPathWhenSendingThenSendIsTriggerdOnConnection(self):
         """Given two regions connected over network path when sending - then send is triggered on connection"""
@@ -68,7 +69,50 @@ class TestRegion(unittest.TestCase):
 
         r1.sendToRegion('region2', 'test', message)
 
-        r1ToR2.send.assert_called_with(message)
+        r1ToR2.send.assert_called_with(message, None)
+
+    def test_givenTwoRegionsConnectedOverNetworkPathWhenSendingWithACongestionCallbackThenItIsPassedToTheConnection(self):
+        """Given two regions connected over network path - when sending with a congestion callback - then it is passed to the connection"""
+        env = Mock()
+        r1 = self.CLASS(env, regionName = 'region1')
+        r2 = self.CLASS(env, regionName = 'region2')
+
+        r1ToR2 = Mock()
+        r1.connectRegion(r2, r1ToR2)
+
+        sender = self.IdentifierCLASS('region1', 'Sender')
+        receiver = self.IdentifierCLASS('region2', 'Receiver')
+        message = self.MessageCLASS(sender, receiver, 'test')
+        onCongestion = Mock()
+
+        r1.send(message, onCongestion)
+
+        r1ToR2.send.assert_called_with(message, onCongestion)
+
+    def test_givenARegionWithAServiceWhenCreatingAnIdentifierThenItCarriesTheAddressesOfRegionAndService(self):
+        """Given a region with a service - when creating an identifier - then it carries the addresses of region and service"""
+        r1 = self.CLASS(Mock(), regionName = 'region1')
+        service = self.InfrastructureServiceCLASS(r1)
+
+        identifier = self.IdentifierCLASS('region1', service.serviceName)
+
+        self.assertEqual(identifier.regionId, r1.regionId)
+        self.assertEqual(identifier.serviceId, service.serviceId)
+        self.assertEqual(regionAddresses.name(r1.regionId), 'region1')
+        self.assertIs(r1.serviceTable[service.serviceId], service)
+
+    def test_givenConnectedRegionsWhenConnectingThenRoutesAreIndexedByRegionAddress(self):
+        """Given connected regions - when connecting - then routes are indexed by region address"""
+        env = Mock()
+        r1 = self.CLASS(env, regionName = 'region1')
+        r2 = self.CLASS(env, regionName = 'region2')
+        r3 = self.CLASS(env, regionName = 'region3')
+        r1ToR3 = Mock()
+
+        r1.connectRegion(r3, r1ToR3)
+
+        self.assertIs(r1.routes[r3.regionId], r1ToR3)
+        self.assertIsNone(getTableEntry(r1.routes, r2.regionId))
 
     def test_givenARegionWhenRegisteringAServiceThenServiceIsCorrectlyRegistered(self):
         """Given a region - when registering a service - then service is correctly registered"""
@@ -83,27 +127,50 @@ class TestRegion(unittest.TestCase):
 
     def test_givenARegionWithARegisteredServiceWhenCallingNotifyNetworkReceiveThenRegionCorrectlyDeliversMessageToService(self):
         """Given a region with a registered service - when calling notify network receive - then region correclty delivers message to service"""
-        env = Mock()
+        env = simpy.Environment()
         r1 = self.CLASS(env, regionName = 'region1')
         service = self.InfrastructureServiceCLASS(r1)
         service.receive = MagicMock()
 
-        np = Mock()
+        np = NetworkPath(env, 'to-region1', 0, queued = False)
         
         sender = Mock(self.IdentifierCLASS)
         receiver = self.IdentifierCLASS(r1.regionName, service.serviceName) 
         message = self.MessageCLASS(sender, receiver, 'testMessage')
 
-        np.receive = MagicMock(return_value=(message))
+        np.buffer.put(message)
+        r1.notifyNetworkReceive(np)
+        env.run(until = 1)
 
-        generator = r1.notifyNetworkReceive(np)
-        message = next(generator)
-        try:
-            generator.send(message)
-        except StopIteration:
-            pass
+        service.receive.assert_called_once_with(message)
 
-        service.receive.assert_called_with(message)
+    def test_givenARegionWithTwoIncomingPathsWhenMessagesArriveThenOneDispatcherDeliversEachMessageOnce(self):
+        """Given a region with two incoming paths - when messages arrive - then one dispatcher delivers each message once"""
+        env = simpy.Environment()
+        r1 = self.CLASS(env, regionName = 'region1')
+        service = self.InfrastructureServiceCLASS(r1)
+        service.receive = MagicMock()
+        receiver = self.IdentifierCLASS(r1.regionName, service.serviceName) 
+
+        np1 = NetworkPath(env, 'a-to-region1', 5, queued = False)
+        np2 = NetworkPath(env, 'b-to-region1', 7, queued = False)
+        np1.connectRightSide(r1)
+        np2.connectRightSide(r1)
+
+        messages = [self.MessageCLASS(Mock(self.IdentifierCLASS), receiver, i) for i in range(0, 4)]
+        np1.send(messages[0])
+        np1.send(messages[1])
+        np2.send(messages[2])
+
+        env.run(until = 6)
+        dispatcher = r1.inboundDispatcher
+        np2.send(messages[3])
+        env.run(until = 20)
+
+        self.assertEqual(dispatcher, r1.inboundDispatcher)
+        self.assertEqual(service.receive.call_count, len(messages))
+        for message in messages:
+            service.receive.assert_any_call(message)
 
     def test_givenARegionWithARegisteredServiceWhenTryingToSendToLocalRegionAndLocalServiceThenMessageIsLocallyDelivered(self):
         """Given a region with a registered service - when trying to send to local region and local service - then message is delivered locally"""
@@ -158,6 +225,77 @@ class TestRegion(unittest.TestCase):
         self.assertEqual(r1.getLatency(REGION_NAME2), LATENCY1)
         self.assertEqual(r2.getLatency(REGION_NAME1), LATENCY2)
 
+    def test_givenARegionWithEgressBundlingWhenSendingSeveralMessagesInOneTickThenTheyAreShippedAsOneBundleAndDeliveredInOrder(self):
+        """Given a region with egress bundling - when sending several messages in one tick - then they are shipped as one bundle and delivered in order"""
+        env = simpy.Environment()
+        r1 = self.CLASS(env, regionName = 'region1')
+        r2 = self.CLASS(env, regionName = 'region2')
+        service = self.InfrastructureServiceCLASS(r2)
+        service.receive = MagicMock()
+
+        np = NetworkPath(env, 'r1-to-r2', 5)
+        np.send = MagicMock(side_effect = np.send)
+        r1.connectRegion(r2, np)
+        r1.enableEgressBundling()
+
+        sender = self.IdentifierCLASS('region1', 'Sender')
+        receiver = self.IdentifierCLASS('region2', service.serviceName)
+        messages = [self.MessageCLASS(sender, receiver, i) for i in range(0, 3)]
+        for message in messages:
+            r1.send(message)
+
+        env.run(until = 10)
+
+        self.assertEqual(np.send.call_count, 1)
+        self.assertTrue(isinstance(np.send.call_args[0][0], MessageBundle))
+        self.assertEqual([c[0][0] for c in service.receive.call_args_list], messages)
+
+    def test_givenARegionWithAnEgressWindowWhenSendingOverTheWindowThenMessagesLeaveWhenTheWindowCloses(self):
+        """Given a region with an egress window - when sending over the window - then messages leave together when the window closes"""
+        env = simpy.Environment()
+        r1 = self.CLASS(env, regionName = 'region1')
+        r2 = self.CLASS(env, regionName = 'region2')
+        service = self.InfrastructureServiceCLASS(r2)
+        arrivals = []
+        service.receive = lambda message: arrivals.append((env.now, message.payload))
+
+        r1.connectRegion(r2, NetworkPath(env, 'r1-to-r2', 5))
+        r1.enableEgressBundling(4)
+
+        sender = self.IdentifierCLASS('region1', 'Sender')
+        receiver = self.IdentifierCLASS('region2', service.serviceName)
+        def sendLater(delay, payload):
+            yield env.timeout(delay)
+            r1.send(self.MessageCLASS(sender, receiver, payload))
+        env.process(sendLater(0, 'first'))
+        env.process(sendLater(3, 'second'))
+        env.process(sendLater(6, 'third'))
+
+        env.run(until = 20)
+
+        self.assertEqual(arrivals, [(9, 'first'), (9, 'second'), (15, 'third')])
+
+    def test_givenABundleWithCongestionCallbacksWhenThePathDropsItThenEachMessageCallbackIsCalled(self):
+        """Given a bundle with congestion callbacks - when the path drops it - then each message's callback is called"""
+        env = simpy.Environment()
+        r1 = self.CLASS(env, regionName = 'region1')
+        r2 = self.CLASS(env, regionName = 'region2')
+        np = NetworkPath(env, 'r1-to-r2', 5, capacity = 1)
+        r1.connectRegion(r2, np)
+        np.inFlight.append((5, None, None))
+        r1.enableEgressBundling()
+
+        sender = self.IdentifierCLASS('region1', 'Sender')
+        receiver = self.IdentifierCLASS('region2', 'Receiver')
+        messages = [self.MessageCLASS(sender, receiver, i) for i in range(0, 2)]
+        onCongestion = Mock()
+        r1.send(messages[0], onCongestion)
+        r1.send(messages[1])
+
+        env.run(until = 1)
+
+        onCongestion.assert_called_once_with(np, messages[0], True)
+
 
 
 class TestService(unittest.TestCase):
@@ -0,0 +1,79 @@
+import unittest
+from unittest.mock import Mock, MagicMock
+from infrastructure.timer import *
+import simpy, gc, weakref
+
+class TestTimerService(unittest.TestCase):
+
+    def test_setup(self):
+        """TimerService is shared per environment"""
+        env1 = simpy.Environment()
+        env2 = simpy.Environment()
+
+        self.assertTrue(TimerService.forEnvironment(env1) is TimerService.forEnvironment(env1))
+        self.assertFalse(TimerService.forEnvironment(env1) is TimerService.forEnvironment(env2))
+
+    def test_givenATimerServiceWhenSchedulingCallbacksForTheSameTickThenTheyFireFromOneEvent(self):
+        """Given a timer service - when scheduling callbacks for the same tick - then they fire from a single event"""
+        env = simpy.Environment()
+        timers = TimerService.forEnvironment(env)
+        callbacks = [Mock() for i in range(0, 10)]
+
+        for callback in callbacks:
+            timers.scheduleOnce(5, callback)
+
+        self.assertEqual(len(env._queue), 1)
+
+        env.run(until = 5)
+        for callback in callbacks:
+            callback.assert_not_called()
+
+        env.run(until = 6)
+        for callback in callbacks:
+            callback.assert_called_once_with()
+
+    def test_givenAPeriodicTimerWhenRunningThenCallbackFiresEveryIntervalUntilCancelled(self):
+        """Given a periodic timer - when running - then the callback fires every interval until it is cancelled"""
+        env = simpy.Environment()
+        timers = TimerService.forEnvironment(env)
+        ticks = []
+
+        timer = timers.schedulePeriodic(10, lambda: ticks.append(env.now))
+        env.run(until = 35)
+        self.assertEqual(ticks, [10, 20, 30])
+
+        timer.cancel()
+        env.run(until = 100)
+        self.assertEqual(ticks, [10, 20, 30])
+
+    def test_givenAOneShotTimerWhenCancelledBeforeItIsDueThenCallbackIsNotCalled(self):
+        """Given a one-shot timer - when cancelled before it is due - then the callback is not called"""
+        env = simpy.Environment()
+        timers = TimerService.forEnvironment(env)
+        callback = Mock()
+
+        timer = timers.scheduleOnce(5, callback)
+        timer.cancel()
+        env.run(until = 10)
+
+        callback.assert_not_called()
+
+    def test_givenTimerServicesOfFinishedEnvironmentsWhenTheEnvironmentsAreDeletedThenTheServicesAreFreed(self):
+        """Given timer services of finished environments - when the environments are deleted - then the services are freed"""
+        gc.collect()
+        servicesBefore = len(TimerService.services)
+        envs = [simpy.Environment() for i in range(0, 5)]
+        for env in envs:
+            TimerService.forEnvironment(env).schedulePeriodic(2, Mock())
+            env.run(until = 10)
+        references = [weakref.ref(env) for env in envs]
+
+        del env, envs
+        gc.collect()
+
+        self.assertTrue(all(reference() is None for reference in references))
+        self.assertEqual(len(TimerService.services), servicesBefore)
+
+
+if __name__ == '__main__':
+    unittest.main()
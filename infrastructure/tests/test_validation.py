@@ -0,0 +1,51 @@
+import unittest
+from unittest.mock import Mock, MagicMock
+from infrastructure import validation
+from infrastructure.aws import *
+
+class TestValidation(unittest.TestCase):
+
+    def tearDown(self):
+        validation.setMode(validation.STRICT)
+
+    def test_givenStrictModeWhenCreatingAMessageWithoutIdentifiersThenExceptionIsThrown(self):
+        """Given strict mode - when creating a message without identifiers - then exception is thrown"""
+        with self.assertRaises(AWSError):
+            AWSMessage('sender', 'receiver', 'test')
+
+    def test_givenTrustedModeWhenCreatingAMessageWithoutIdentifiersThenNoCheckIsDone(self):
+        """Given trusted mode - when creating a message without identifiers - then no check is done"""
+        validation.setMode(validation.TRUSTED)
+
+        message = AWSMessage('sender', 'receiver', 'test')
+
+        self.assertEqual(message.payload, 'test')
+        self.assertFalse('__init__' in vars(AWSMessage))
+
+    def test_givenTrustedModeWhenSendingThenRegionsRouteWithoutChecks(self):
+        """Given trusted mode - when sending - then regions route through the unchecked methods"""
+        validation.setMode(validation.TRUSTED)
+        r1 = AWSRegion(Mock(), 'region1')
+        r2 = AWSRegion(Mock(), 'region2')
+        r1ToR2 = Mock()
+        r1.connectRegion(r2, r1ToR2)
+
+        message = AWSMessage(AWSIdentifier('region1', 'Sender'), AWSIdentifier('region2', 'Receiver'), 'test')
+        r1.send(message)
+
+        r1ToR2.send.assert_called_with(message, None)
+        self.assertEqual(AWSRegion.send, Region.trustedSend)
+        self.assertEqual(AWSRemoteKinesis.checkMessageIntegrity, validation.skip)
+
+    def test_givenTrustedModeWhenSwitchingBackToStrictThenChecksAreRestored(self):
+        """Given trusted mode - when switching back to strict - then checks are restored"""
+        validation.setMode(validation.TRUSTED)
+        validation.setMode(validation.STRICT)
+
+        with self.assertRaises(AWSError):
+            AWSRegion(Mock(), 'region1').send('test')
+
+    def test_givenAnUnknownModeWhenSettingItThenExceptionIsThrown(self):
+        """Given an unknown mode - when setting it - then exception is thrown"""
+        with self.assertRaises(validation.ValidationModeError):
+            validation.setMode('sloppy')
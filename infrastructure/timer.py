@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+#
+# Shared timer service for SIM simulator
+
+import weakref
+
+class Timer(object):
+    """A one-shot or periodic callback registered with a TimerService"""
+
+    def __init__(self, callback, at, interval = None):
+        self.callback = callback
+        self.at = at
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerService(object):
+    """Timer wheel shared by all components of a simpy environment
+
+    Timers are kept in slots keyed by the tick they are due at. Only the
+    first timer of a slot schedules a simpy event, so all callbacks due in
+    the same tick fire from a single event.
+
+    The service only holds a weak reference to its environment, so an
+    environment and everything its timers refer to are freed once the
+    environment is no longer used."""
+
+    services = weakref.WeakKeyDictionary()
+
+    def __init__(self, env):
+        self.envRef = weakref.ref(env)
+        self.slots = {}
+
+    @property
+    def env(self):
+        return self.envRef()
+
+    @classmethod
+    def forEnvironment(cls, env):
+        if env not in cls.services:
+            cls.services[env] = cls(env)
+        return cls.services[env]
+
+    def scheduleOnce(self, delay, callback):
+        timer = Timer(callback, self.env.now + delay)
+        self.add(timer, delay)
+        return timer
+
+    def schedulePeriodic(self, interval, callback, delay = None):
+        """Call callback every interval ticks, the first time after delay
+        (defaults to interval) ticks"""
+        if delay is None:
+            delay = interval
+        timer = Timer(callback, self.env.now + delay, interval)
+        self.add(timer, delay)
+        return timer
+
+    def add(self, timer, delay):
+        slot = self.slots.get(timer.at)
+        if slot is None:
+            slot = self.slots[timer.at] = []
+            at = timer.at
+            self.env.timeout(delay).callbacks.append(lambda event: self.fire(at))
+        slot.append(timer)
+
+    def fire(self, at):
+        for timer in self.slots.pop(at):
+            if timer.cancelled:
+                continue
+
+            if timer.interval is not None:
+                timer.at += timer.interval
+                self.add(timer, timer.interval)
+
+            timer.callback()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+#
+# Validation modes of SIM simulator
+#
+# In strict mode (the default) regions, messages and Kinesis services check
+# the types and addresses of every message. In trusted mode these checks
+# are left out. The mode is selected once - from the SIM_VALIDATION
+# environment variable at import or by calling setMode before a run - by
+# installing the matching variant of each checked method on its class, so
+# no call has to branch on the mode.
+
+import os
+
+STRICT = 'strict'
+TRUSTED = 'trusted'
+
+## Trusted variant of methods which fall back to the base class method
+INHERIT = object()
+
+class ValidationModeError(Exception):
+    pass
+
+def skip(self, *args):
+    """Trusted variant of methods which only perform checks"""
+    pass
+
+class CheckedMethod(object):
+    """Placeholder for a checked method, replaced by the variant of the
+    current mode as soon as its class is created"""
+
+    def __init__(self, strict, trusted):
+        self.strict = strict
+        self.trusted = trusted
+
+    def __set_name__(self, owner, name):
+        self.owner = owner
+        self.name = name
+        checkedMethods.append(self)
+        self.install(mode)
+
+    def install(self, newMode):
+        variant = self.strict if newMode == STRICT else self.trusted
+        if variant is INHERIT:
+            if self.name in vars(self.owner):
+                delattr(self.owner, self.name)
+        else:
+            setattr(self.owner, self.name, variant)
+
+def checked(trusted):
+    """Decorator for methods with checks - trusted is the variant used in
+    trusted mode, INHERIT to use the base class method"""
+    def decorate(strict):
+        return CheckedMethod(strict, trusted)
+    return decorate
+
+def setMode(newMode):
+    global mode
+    if newMode not in (STRICT, TRUSTED):
+        raise ValidationModeError("Unknown validation mode %s" % newMode)
+
+    mode = newMode
+    for method in checkedMethods:
+        method.install(mode)
+
+checkedMethods = []
+mode = os.environ.get('SIM_VALIDATION', STRICT)
+if mode not in (STRICT, TRUSTED):
+    raise ValidationModeError("Unknown validation mode %s" % mode)
@@ -4,7 +4,7 @@ sys.path.append(".")
 from unittest.mock import Mock, MagicMock
 from infrastructure.aws import *
 from infrastructure.network import *
-import simpy
+import simpy, os, tempfile
 from util.builder import awsbuilder
 
 class TestKinesisIntegration(unittest.TestCase):
@@ -39,6 +39,32 @@ class TestKinesisIntegration(unittest.TestCase):
         env.run(until=11)
         self.assertFalse(TEST_MESSAGE in kinesis.consume(STREAM_NAME))
 
+    def test_givenAKinesisWithATTLWhenPublishingMessagesOverTimeThenEachMessageIsDeletedWhenItExpires(self):
+        """Given a kinesis with a TTL - when publishing messages over time - then each message is deleted exactly when it expires"""
+        env = simpy.Environment()
+        STREAM_NAME = 'test-stream'
+        TTL = 10
+
+        r1 = awsbuilder.b.buildRegion(env, 'us-east-1')
+        kinesis = AWSKinesis(r1, env, TTL)
+        kinesis.createStream(STREAM_NAME)
+
+        messages = []
+        for i in range(0, 30):
+            env.run(until = i + 1)
+            message = AWSKinesisPayload(env.now, Mock(), 'test-message')
+            kinesis.publish(STREAM_NAME, message)
+            messages.append(message)
+
+            for m in messages:
+                # Expiries due at env.now are processed once the clock moves past it
+                self.assertEqual(m in kinesis.consume(STREAM_NAME), m.timestamp + TTL >= env.now)
+
+        self.assertEqual(len(kinesis.streams[STREAM_NAME]), TTL + 1)
+        env.run(until = 100)
+        self.assertEqual(len(kinesis.streams[STREAM_NAME]), 0)
+        self.assertEqual(kinesis.getNextSequence(STREAM_NAME), len(messages))
+
     def test_givenAKinesisWithoutATTLForMessagesWhenPublishingAMessageThenMessageIsNotDeleted(self):
         """Given a kinesis without a TTL for messages - when publishing a message - then message is not deleted"""
         env = simpy.Environment()
@@ -121,6 +147,23 @@ class TestKinesisIntegration(unittest.TestCase):
         env.run(until=11)
         self.assertTrue(TEST_MESSAGE in kinesis.consume(STREAM_NAME))
 
+    def test_givenAKinesisAndARemoteKinesisWhenPuttingRecordsOnTheRemoteKinesisThenBatchShowsUpInRealKinesis(self):
+        """Given a kinesis and a remote kinesis - when putting records on the remote kinesis - then the batch shows up in real kinesis"""
+        env = simpy.Environment()
+        STREAM_NAME = 'test-stream'
+        LATENCY = 10
+        MESSAGES = [AWSKinesisPayload(0, Mock(), i) for i in range(0, 5)]
+
+        r1, r2 = awsbuilder.b.buildTwoConnectedRegions(env, 'us-east-1', 'us-west-2', LATENCY, LATENCY)
+        kinesis = AWSKinesis(r2, env)
+        kinesis.createStream(STREAM_NAME)
+        remoteKinesis = AWSRemoteKinesis(r1, r2.regionName)
+
+        remoteKinesis.putRecords(STREAM_NAME, MESSAGES)
+
+        env.run(until = LATENCY + 1)
+        self.assertEqual(kinesis.consume(STREAM_NAME), MESSAGES)
+
     def test_givenAKinesisAndARemoteKinesisHavingASubscriberWhenPublishingAMessageThenSubscriberIsNotifiedAnCanFetchMessage(self):
         """Given a kinesis and a remote kinesis having a subscriber - when publishing a message - then subscriber is notified and can fetch message"""
         env = simpy.Environment()
@@ -153,6 +196,183 @@ class TestKinesisIntegration(unittest.TestCase):
 
         self.assertTrue(TEST_MESSAGE in remoteKinesis.consume(STREAM_NAME))
 
+    def test_givenAKinesisAndARemoteKinesisWhenPublishingRepeatedlyThenRemoteBufferMirrorsStreamAndRepliesOnlyCarryNewRecords(self):
+        """Given a kinesis and a remote kinesis - when publishing repeatedly - then the remote buffer mirrors the stream and replies only carry new records"""
+        env = simpy.Environment()
+        STREAM_NAME = 'test-stream'
+        LATENCY = 10
+
+        r1, r2 = awsbuilder.b.buildTwoConnectedRegions(env, 'us-east-1', 'us-west-2', LATENCY, LATENCY)
+        kinesis = AWSKinesis(r2, env)
+        kinesis.createStream(STREAM_NAME)
+        remoteKinesis = AWSRemoteKinesis(r1, r2.regionName)
+        subscriber = AWSService(r1, 'test-subscriber')
+        subscriber.receive = Mock()
+        remoteKinesis.subscribe(STREAM_NAME, subscriber)
+        env.run(until = 11)
+
+        replies = []
+        appendDelta = remoteKinesis.appendDelta
+        remoteKinesis.appendDelta = lambda name, records, nextSequence: replies.append(records) or appendDelta(name, records, nextSequence)
+
+        messages = [AWSKinesisPayload(i, Mock(), i) for i in range(0, 5)]
+        for message in messages:
+            kinesis.publish(STREAM_NAME, message)
+            env.run(until = env.now + 5 * LATENCY)
+
+        self.assertEqual(remoteKinesis.consume(STREAM_NAME), messages)
+        self.assertEqual([len(records) for records in replies], [1, 1, 1, 1, 1])
+
+    def test_givenAKinesisAndARemoteKinesisWithAStorageDirectoryWhenPublishingThenBothKeepTheStreamOnDiskUntilClosed(self):
+        """Given a kinesis and a remote kinesis with a storage directory - when publishing - then both keep the stream on disk until closed"""
+        env = simpy.Environment()
+        STREAM_NAME = 'test-stream'
+        LATENCY = 10
+        directory = tempfile.mkdtemp()
+
+        r1, r2 = awsbuilder.b.buildTwoConnectedRegions(env, 'us-east-1', 'us-west-2', LATENCY, LATENCY)
+        kinesis = AWSKinesis(r2, env, storageDirectory = directory)
+        kinesis.createStream(STREAM_NAME)
+        remoteKinesis = AWSRemoteKinesis(r1, r2.regionName, storageDirectory = directory)
+        subscriber = AWSService(r1, 'test-subscriber')
+        subscriber.receive = Mock()
+        remoteKinesis.subscribe(STREAM_NAME, subscriber)
+        env.run(until = 11)
+
+        sender = AWSIdentifier(r2.regionName, 'SIM_0')
+        messages = [AWSKinesisPayload(i, sender, i) for i in range(0, 5)]
+        for message in messages:
+            kinesis.publish(STREAM_NAME, message)
+            env.run(until = env.now + 5 * LATENCY)
+
+        self.assertTrue(isinstance(remoteKinesis.bufferedStreams[STREAM_NAME], AWSKinesisDiskStream))
+        self.assertEqual([record.payload for record in remoteKinesis.consume(STREAM_NAME)], list(range(0, 5)))
+
+        kinesis.close()
+        remoteKinesis.close()
+        self.assertEqual(os.listdir(directory), [])
+        os.rmdir(directory)
+
+    def test_givenARemoteKinesisWithALeaseWhenRecordsArePublishedRegularlyThenDeltaRequestsRenewTheLease(self):
+        """Given a remote kinesis with a lease - when records are published regularly - then delta requests renew the lease"""
+        env = simpy.Environment()
+        STREAM_NAME = 'test-stream'
+        LATENCY = 10
+        LEASE = 100
+
+        r1, r2 = awsbuilder.b.buildTwoConnectedRegions(env, 'us-east-1', 'us-west-2', LATENCY, LATENCY)
+        kinesis = AWSKinesis(r2, env)
+        kinesis.createStream(STREAM_NAME)
+        remoteKinesis = AWSRemoteKinesis(r1, r2.regionName, leaseDuration = LEASE)
+        subscriber = AWSService(r1, 'test-subscriber')
+        subscriber.receive = Mock()
+
+        subscribes = []
+        receive = kinesis.receive
+        kinesis.receive = lambda message: (message.payload[0] == 'subscribe' and subscribes.append(env.now)) or receive(message)
+
+        remoteKinesis.subscribe(STREAM_NAME, subscriber)
+        for i in range(1, 50):
+            env.run(until = i * 20)
+            kinesis.publish(STREAM_NAME, AWSKinesisPayload(env.now, Mock(), i))
+
+        self.assertEqual(subscribes, [LATENCY])
+        self.assertTrue(remoteKinesis.getAWSIdentifier() in kinesis.subscriptions[STREAM_NAME])
+        self.assertEqual(len(remoteKinesis.consume(STREAM_NAME)), 48)
+
+    def test_givenARemoteKinesisWithALeaseWhenTheStreamIsIdleThenLeaseIsRenewedBeforeItExpires(self):
+        """Given a remote kinesis with a lease - when the stream is idle - then the lease is renewed before it expires"""
+        env = simpy.Environment()
+        STREAM_NAME = 'test-stream'
+        LATENCY = 10
+        LEASE = 100
+
+        r1, r2 = awsbuilder.b.buildTwoConnectedRegions(env, 'us-east-1', 'us-west-2', LATENCY, LATENCY)
+        kinesis = AWSKinesis(r2, env)
+        kinesis.createStream(STREAM_NAME)
+        remoteKinesis = AWSRemoteKinesis(r1, r2.regionName, leaseDuration = LEASE)
+        subscriber = AWSService(r1, 'test-subscriber')
+        remoteKinesis.subscribe(STREAM_NAME, subscriber)
+        identifier = remoteKinesis.getAWSIdentifier()
+
+        for i in range(LATENCY + 1, 1000):
+            env.run(until = i)
+            lease, expiry = kinesis.subscriptions[STREAM_NAME][identifier]
+            self.assertGreaterEqual(expiry, env.now)
+
+        ## One renewal every three quarters of a lease
+        self.assertEqual(remoteKinesis.upstreamSubscriptions[STREAM_NAME], 975)
+
+    def test_givenAKinesisWithALeasedSubscriptionWhenTheLeaseLapsesThenSubscriberIsNoLongerNotified(self):
+        """Given a kinesis with a leased subscription - when the lease lapses - then the subscriber is no longer notified"""
+        env = simpy.Environment()
+        STREAM_NAME = 'test-stream'
+        LATENCY = 10
+
+        r1, r2 = awsbuilder.b.buildTwoConnectedRegions(env, 'us-east-1', 'us-west-2', LATENCY, LATENCY)
+        kinesis = AWSKinesis(r2, env)
+        kinesis.createStream(STREAM_NAME)
+        identifier = AWSIdentifier(r1.regionName, 'RemoteKinesis_%s' % r2.regionName)
+        kinesis.subscribeIdentifier(STREAM_NAME, identifier, 50)
+        r2.sendToRegion = Mock()
+
+        env.run(until = 50)
+        kinesis.publish(STREAM_NAME, AWSKinesisPayload(env.now, Mock(), 'in time'))
+        self.assertEqual(r2.sendToRegion.call_count, 1)
+
+        env.run(until = 51)
+        kinesis.publish(STREAM_NAME, AWSKinesisPayload(env.now, Mock(), 'too late'))
+        self.assertEqual(r2.sendToRegion.call_count, 1)
+        self.assertFalse(identifier in kinesis.subscriptions[STREAM_NAME])
+
+    def test_givenAKinesisInPushModeAndARemoteKinesisHavingASubscriberWhenPublishingAMessageThenSubscriberIsNotifiedAfterOneLatency(self):
+        """Given a kinesis in push mode and a remote kinesis having a subscriber - when publishing a message - then subscriber is notified after one latency"""
+        env = simpy.Environment()
+        STREAM_NAME = 'test-stream'
+        LATENCY = 10
+        TEST_MESSAGE = AWSKinesisPayload(0, Mock(), 'test-message')
+
+        r1, r2 = awsbuilder.b.buildTwoConnectedRegions(env, 'us-east-1', 'us-west-2', LATENCY, LATENCY)
+        kinesis = AWSKinesis(r2, env, pushReplication = True)
+        kinesis.createStream(STREAM_NAME)
+        remoteKinesis = AWSRemoteKinesis(r1, r2.regionName)
+        subscriber = AWSService(r1, 'test-subscriber')
+        subscriber.receive = Mock()
+        remoteKinesis.subscribe(STREAM_NAME, subscriber)
+
+        env.run(until = 11)
+        kinesis.publish(STREAM_NAME, TEST_MESSAGE)
+
+        env.run(until = 22)
+        self.assertTrue(subscriber.receive.called)
+        self.assertEqual(remoteKinesis.consume(STREAM_NAME), [TEST_MESSAGE])
+
+    def test_givenAKinesisStreamWithACoalescingWindowWhenPublishingSeveralMessagesInTheWindowThenSubscriberIsNotifiedOnce(self):
+        """Given a kinesis stream with a coalescing window - when publishing several messages within the window - then the subscriber is notified once"""
+        env = simpy.Environment()
+        STREAM_NAME = 'test-stream'
+        LATENCY = 10
+        WINDOW = 5
+
+        r1, r2 = awsbuilder.b.buildTwoConnectedRegions(env, 'us-east-1', 'us-west-2', LATENCY, LATENCY)
+        kinesis = AWSKinesis(r2, env)
+        kinesis.createStream(STREAM_NAME, WINDOW)
+        subscriber = AWSRemoteKinesis(r1, r2.regionName)
+        subscriber.receive = Mock()
+        kinesis.subscribe(STREAM_NAME, subscriber)
+
+        for i in range(0, 3):
+            kinesis.publish(STREAM_NAME, AWSKinesisPayload(i, Mock(), i))
+            env.run(until = i + 1)
+
+        env.run(until = WINDOW + LATENCY)
+        subscriber.receive.assert_not_called()
+
+        env.run(until = WINDOW + LATENCY + 1)
+        self.assertEqual(subscriber.receive.call_count, 1)
+        self.assertEqual(kinesis.streams[STREAM_NAME].notificationsSent, 1)
+        self.assertEqual(kinesis.streams[STREAM_NAME].notificationsSaved, 2)
+
     def test_givenAKinesisAndARemoteKinesisWhenCreatingAStreamOnRemoteKinesisThenStreamInRealKinesisIsBeingCreated(self):
         """Given a kinesis and a remote kinesis - when creating a stream on remote kinesis - then stream on real kinesis is being created"""
 
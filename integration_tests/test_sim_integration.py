@@ -103,6 +103,264 @@ class TestSIMIntegration(unittest.TestCase):
                         ht = sim.lastHeartbeat[heartbeatRegion]
                         self.assertNotEqual(ht[0], ht[1])
 
+    def test_givenFullyMeshedSIMWithTemporarilySlowRegionWhenRunningThenIncrementalStatusMatchesHeartbeatAges(self):
+        """Given fully meshed sim with temporarily slow region - when running - then incremental status matches heartbeat ages"""
+        env = simpy.Environment()
+
+        regionsToBuild = [
+                {'regionName' : 'us-west-1', 'latency' : 10},
+                {'regionName' : 'us-east-1', 'latency' : 10},
+                {'regionName' : 'eu-central-1', 'latency' : 50}
+        ]
+
+        regions = awsbuilder.b.buildFullyMeshedRegionsWithKinesis(env, regionsToBuild)
+
+        sims = []
+        for region in regions:
+            sims.append(Sim(env, region, 0, KinesisBasedSimPersistencyStrategy(region.getServiceByName('Kinesis'))))
+
+        for sim in sims:
+            sim.attachRemoteRegions(regions)
+            sim.startBehaviour()
+
+        ## Cut off one region for a while
+        for region in regions[1:]:
+            region.connectedRegions['us-west-1'][1].latency = 400
+
+        for i in range(1, 1500, 7):
+            env.run(until = i)
+
+            if i > 600:
+                for region in regions[1:]:
+                    region.connectedRegions['us-west-1'][1].latency = 10
+
+            for sim in sims:
+                expected = 0
+                for region in sim.attachedRegions:
+                    heartbeat = sim.lastHeartbeat.get(region.regionName)
+                    if heartbeat is not None and heartbeat[0] + sim.maxHeartbeatAge >= env.now:
+                        expected += 1
+                self.assertEqual(sim.regionsInSync, expected)
+
+        for sim in sims:
+            self.assertTrue(sim.persistencyStrategy.getSystemStatus().startswith('IN SYNC'))
+            self.assertGreater(sim.persistencyStrategy.statusTransitions, 0)
+
+    def test_givenTwoRegionsWithSIMWhenHeartbeatsShareATimestampThenEveryEventIsHandledOnce(self):
+        """Given two regions with sim - when heartbeats share a timestamp - then every event is handled once"""
+        env = simpy.Environment()
+
+        regionsToBuild = [
+                {'regionName' : 'us-west-1', 'latency' : 10},
+                {'regionName' : 'us-east-1', 'latency' : 10}
+        ]
+
+        regions = awsbuilder.b.buildFullyMeshedRegionsWithKinesis(env, regionsToBuild)
+
+        sims = []
+        for region in regions:
+            for instance in range(2):
+                sims.append(Sim(env, region, instance, KinesisBasedSimPersistencyStrategy(region.getServiceByName('Kinesis'))))
+
+        handled = []
+        for sim in sims:
+            strategy = sim.persistencyStrategy
+            strategy.handleEvent = Mock(side_effect = lambda kinesisName, sourceRegion, event, sim = sim: handled.append((sim, event)))
+            sim.attachRemoteRegions(regions)
+            sim.startBehaviour()
+
+        env.run(until = 501)
+
+        ## Every SIM sees the two local and two remote heartbeats of each round exactly once
+        self.assertEqual(len(handled), len(set((id(sim), id(event)) for sim, event in handled)))
+        for sim in sims:
+            events = [event for s, event in handled if s is sim]
+            self.assertEqual(len(events), 4 * 10 - 2)
+
+    def test_givenManySIMPerRegionStartingAtDifferentTicksWhenRunningThenEachRegionPairHoldsOneUpstreamSubscription(self):
+        """Given many sim per region starting at different ticks - when running - then each region pair holds one upstream subscription"""
+        env = simpy.Environment()
+
+        regionsToBuild = [
+                {'regionName' : 'us-west-1', 'latency' : 10},
+                {'regionName' : 'us-east-1', 'latency' : 10},
+                {'regionName' : 'eu-central-1', 'latency' : 50}
+        ]
+
+        regions = awsbuilder.b.buildFullyMeshedRegionsWithKinesis(env, regionsToBuild)
+
+        upstreamSubscribes = []
+        for region in regions:
+            sendToRegion = region.sendToRegion
+            def countingSendToRegion(regionName, service, message, onCongestion = None, sendToRegion = sendToRegion):
+                if message.payload == ('subscribe', 'sim_control'):
+                    upstreamSubscribes.append(regionName)
+                sendToRegion(regionName, service, message, onCongestion)
+            region.sendToRegion = countingSendToRegion
+
+        sims = []
+        for region in regions:
+            for instance in range(20):
+                sims.append(Sim(env, region, instance, KinesisBasedSimPersistencyStrategy(region.getServiceByName('Kinesis'))))
+
+        timers = TimerService.forEnvironment(env)
+        for i, sim in enumerate(sims):
+            timers.scheduleOnce(i, lambda sim = sim: sim.attachRemoteRegions(regions) or sim.startBehaviour())
+
+        env.run(until = 2500)
+
+        ## Initial subscription plus two resubscription rounds of the proxy per region pair
+        self.assertEqual(len(upstreamSubscribes), 3 * 2 * 3)
+        for region in regions:
+            kinesis = region.getServiceByName('Kinesis')
+            remoteSubscribers = [s for s in kinesis.subscriptions['sim_control'] if s.regionName != region.regionName]
+            self.assertEqual(len(remoteSubscribers), 2)
+
+        for sim in sims:
+            self.assertTrue(sim.persistencyStrategy.getSystemStatus().startswith('IN SYNC'))
+
+    def test_givenSIMWhoseUpstreamSubscriptionIsLostWhenThePathRecoversThenTheRegionGetsBackInSync(self):
+        """Given sim whose upstream subscription is lost - when the path recovers - then the region gets back in sync"""
+        env = simpy.Environment()
+
+        regionsToBuild = [
+                {'regionName' : 'a', 'latency' : 10},
+                {'regionName' : 'b', 'latency' : 10}
+        ]
+
+        regions = awsbuilder.AWSBuilderWithLossyNetwork().buildFullyMeshedRegionsWithKinesis(env, regionsToBuild)
+
+        ## Everything region a sends to region b is lost for the first ticks
+        lossyPath = regions[0].connectedRegions['b'][1]
+        lossyPath.lossProbability = 1.0
+
+        sims = []
+        for region in regions:
+            sims.append(Sim(env, region, 0, KinesisBasedSimPersistencyStrategy(region.getServiceByName('Kinesis'))))
+
+        for sim in sims:
+            sim.attachRemoteRegions(regions)
+            sim.startBehaviour()
+
+        env.run(until = 50)
+        lossyPath.lossProbability = 0
+        env.run(until = 1500)
+
+        for sim in sims:
+            self.assertTrue(sim.persistencyStrategy.getSystemStatus().startswith('IN SYNC'))
+
+    def test_givenManyRegionsWithGossipingSIMWhenRunningThenAllSIMAreInSyncWithoutKinesis(self):
+        """Given many regions with gossiping sim - when running - then all sim are in sync without kinesis"""
+        env = simpy.Environment()
+
+        regionsToBuild = [{'regionName' : 'region-%i' % i, 'latency' : 2} for i in range(20)]
+        regions = awsbuilder.b.buildFullyMeshedRegions(env, regionsToBuild)
+
+        sims = []
+        for i, region in enumerate(regions):
+            for instance in range(2):
+                sims.append(Sim(env, region, instance, GossipBasedSimPersistencyStrategy(fanout = 2, seed = i * 2 + instance), 10))
+
+        for sim in sims:
+            sim.attachRemoteRegions(regions)
+            sim.startBehaviour()
+
+        env.run(until = 1000)
+
+        for sim in sims:
+            self.assertEqual(sim.persistencyStrategy.getSystemStatus(), 'IN SYNC (19/19)')
+            self.assertEqual(len(sim.persistencyStrategy.peers), 38)
+            for region in regions:
+                self.assertGreater(sim.lastHeartbeat[region.regionName][0], 1000 - sim.maxHeartbeatAge)
+
+        ## One push per peer and round, answered by at most one pull
+        rounds = 1000 // 10
+        messagesSent = sum(sim.persistencyStrategy.messagesSent for sim in sims)
+        self.assertLessEqual(messagesSent, len(sims) * 2 * 2 * rounds)
+
+    def test_givenAdaptiveSIMOnStablePathsWhenRunningThenFewerHeartbeatsKeepAllInSyncAndSilentRegionBecomesSuspected(self):
+        """Given adaptive sim on stable paths - when running - then fewer heartbeats keep all in sync and a silent region becomes suspected"""
+        env = simpy.Environment()
+
+        regionsToBuild = [
+                {'regionName' : 'us-west-1', 'latency' : 10},
+                {'regionName' : 'us-east-1', 'latency' : 10},
+                {'regionName' : 'eu-central-1', 'latency' : 50}
+        ]
+
+        regions = awsbuilder.b.buildFullyMeshedRegionsWithKinesis(env, regionsToBuild)
+
+        sims = []
+        for region in regions:
+            for instance in range(2):
+                sims.append(Sim(env, region, instance, AdaptiveKinesisBasedSimPersistencyStrategy(region.getServiceByName('Kinesis')), 10))
+
+        for sim in sims:
+            sim.attachRemoteRegions(regions)
+            sim.startBehaviour()
+
+        for i in range(300, 5000, 25):
+            env.run(until = i)
+            for sim in sims:
+                self.assertTrue(sim.persistencyStrategy.getSystemStatus().startswith('IN SYNC'))
+
+        ## A fixed interval would have taken 500 heartbeats per SIM
+        for sim in sims:
+            self.assertLess(sim.persistencyStrategy.heartbeatsSent, 250)
+            self.assertGreater(sim.persistencyStrategy.interval, sim.update_interval)
+            self.assertLess(sim.persistencyStrategy.getSuspicionLevel('eu-central-1' if sim.region != regions[2] else 'us-west-1'), 3)
+
+        for sim in sims[4:]:
+            sim.persistencyStrategy.heartbeatTimer.cancel()
+
+        env.run(until = 5300)
+
+        for sim in sims[:4]:
+            self.assertGreater(sim.persistencyStrategy.getSuspicionLevel('eu-central-1'), 8)
+            otherRegion = 'us-east-1' if sim.region == regions[0] else 'us-west-1'
+            self.assertLess(sim.persistencyStrategy.getSuspicionLevel(otherRegion), 3)
+            self.assertTrue(sim.persistencyStrategy.getSystemStatus().startswith('OUT OF SYNC'))
+
+    def test_givenLeaderAggregatedSIMWhenTheLeaderFailsThenStandbyTakesOverAndRegionsStayInSync(self):
+        """Given leader aggregated sim - when the leader fails - then the standby takes over and regions stay in sync"""
+        env = simpy.Environment()
+
+        regionsToBuild = [
+                {'regionName' : 'us-west-1', 'latency' : 10},
+                {'regionName' : 'us-east-1', 'latency' : 10},
+                {'regionName' : 'eu-central-1', 'latency' : 50}
+        ]
+
+        regions = awsbuilder.b.buildFullyMeshedRegionsWithKinesis(env, regionsToBuild)
+
+        sims = []
+        for region in regions:
+            for instance in range(3):
+                sims.append(Sim(env, region, instance, LeaderAggregatedKinesisBasedSimPersistencyStrategy(region.getServiceByName('Kinesis')), 10))
+
+        for sim in sims:
+            sim.attachRemoteRegions(regions)
+            sim.startBehaviour()
+
+        env.run(until = 1001)
+
+        ## One heartbeat per region and interval, whatever the number of SIMs
+        for region in regions:
+            self.assertEqual(region.getServiceByName('Kinesis').getNextSequence('sim_control'), 1000 // 10)
+        self.assertEqual([sim.persistencyStrategy.isLeader() for sim in sims[:3]], [True, False, False])
+
+        sims[0].persistencyStrategy.heartbeatTimer.cancel()
+
+        for i in range(1011, 2011, 10):
+            env.run(until = i)
+            for sim in sims[1:]:
+                self.assertTrue(sim.persistencyStrategy.getSystemStatus().startswith('IN SYNC'))
+
+        self.assertTrue(sims[1].persistencyStrategy.isLeader())
+        ## The leader's last heartbeat was at 1000, so the standby leads from 1040 on
+        self.assertEqual(sims[1].persistencyStrategy.heartbeatsPublished, 97)
+        for sim in sims[3:]:
+            self.assertEqual(sim.persistencyStrategy.regionMembers['us-west-1'], [1, 2])
 
 
 if __name__ == '__main__':
@@ -4,13 +4,15 @@
 
 
 from simulations.simulation import Simulation
-from infrastructure.aws import AWSRegion, AWSService, AWSMessage
-from infrastructure.network import NetworkPath, LossyNetworkPath
+from infrastructure.aws import AWSRegion, AWSService, AWSMessage, AWSKinesis, AWSRemoteKinesis
+from infrastructure.network import *
+from infrastructure.networkmodels import *
+from infrastructure import validation
 from components.sim import *
 from util.builder import awsbuilder
 from util.helper import sort
 from util.printer import p
-import simpy, os, time
+import simpy, os, time, zlib
 
 class KinesisBasedSIMSimulation(Simulation):
 
@@ -26,21 +28,49 @@ class KinesisBasedSIMSimulation(Simulation):
         TTL                  = 1000    ## TTL for messages in Kinesis
         maxstep              = 1000000 ## When does simulation end?
         packetLoss           = 0.0     ## Percentage of packets to loose
+        randomSeed           = None    ## Seed for reproducible losses per network path (None = random)
+        latencyModel         = None    ## Per path latency model from nominal latency and seed, e.g. lambda latency, seed: ShiftedLognormalLatencyModel(latency, 0, 1, seed)
+        allowReordering      = False   ## Let messages with lower latency overtake others on a path
+        bandwidth            = None    ## Bytes per tick of each path - limited paths don't lose packets (None = unlimited)
+        pathCapacity         = None    ## Messages in flight per path before the drop policy kicks in (None = unbounded)
+        dropPolicy           = lambda seed: TailDropPolicy() ## Per path drop policy from seed, e.g. lambda seed: RandomEarlyDropPolicy(0.5, seed = seed) or DropOldestPolicy()
+        validationMode       = validation.TRUSTED ## Skip per message checks (validation.STRICT to check every message)
+        egressWindow         = None    ## Bundle messages to each remote region sent within this many ticks (0 = same tick, None = off)
         sleepTime            = 0.0     ## how long to sleep between each XX steps
         step                 = 1000     ## How big are the steps between outputs?
         simHeartbeatInterval = 10      ## How often does SIM sends its heartbeats
         badNetworkInAPAC     = True    ## Really bad network between APAC and us-west-1 during start up
         waitForReturn        = False   ## Wait for return after each XX steps
-
-        ## Which SIM strategy to test:
-        #strategy = KinesisBasedSimPersistencyStrategy
-        strategy = ResubscribingKinesisBasedSimPersistencyStrategy
+        pushReplication      = False   ## Push new records to remote Kinesis instead of notify/request/reply
+        notificationWindow   = 0       ## Coalesce Kinesis notifications within this many ticks (0 = off)
+        compactStreams       = False   ## Only retain the latest heartbeat per SIM in Kinesis streams
+        storageDirectory     = None    ## Keep Kinesis streams in memory-mapped files below this directory (None = in memory)
+        subscriptionLease    = 0       ## Remote Kinesis subscriptions lapse unless renewed within this many ticks (0 = permanent)
+        resubscriptionInterval = 1000  ## Remote Kinesis resend permanent subscriptions this often, covering lost ones (0 = never)
+
+        gossipFanout         = 2       ## Peers each SIM gossips with per heartbeat (gossip strategy only)
+
+        ## Which SIM strategy to test (remote Kinesis resubscribe on behalf of all SIMs):
+        #strategy = lambda region: GossipBasedSimPersistencyStrategy(gossipFanout)
+        #strategy = lambda region: AdaptiveKinesisBasedSimPersistencyStrategy(region.getServiceByName('Kinesis'), notificationWindow, compactStreams)
+        #strategy = lambda region: LeaderAggregatedKinesisBasedSimPersistencyStrategy(region.getServiceByName('Kinesis'), notificationWindow, compactStreams)
+        strategy = lambda region: KinesisBasedSimPersistencyStrategy(region.getServiceByName('Kinesis'), notificationWindow, compactStreams)
         ################################# END OF Scenario 
 
+        validation.setMode(validationMode)
         env = simpy.Environment()
         b = awsbuilder.AWSBuilder()
-        b.getNetworkPathInstance = lambda env, name, latency: LossyNetworkPath(env, name, latency, packetLoss)
-        self.regions = b.buildFullyMeshedRegionsWithKinesis(env, regionsToBuild, TTL)
+        pathSeed = lambda name: None if randomSeed is None else [randomSeed, zlib.crc32(name.encode())]
+        pathLatencyModel = lambda name, latency: None if latencyModel is None else latencyModel(latency, pathSeed(name))
+        b.getNetworkPathInstance = lambda env, name, latency: LossyNetworkPath(env, name, latency, packetLoss, seed = pathSeed(name),
+                latencyModel = pathLatencyModel(name, latency), reorder = allowReordering, capacity = pathCapacity, dropPolicy = dropPolicy(pathSeed(name)))
+        if bandwidth is not None:
+            b.getNetworkPathInstance = lambda env, name, latency: BandwidthLimitedNetworkPath(env, name, latency, bandwidth,
+                    latencyModel = pathLatencyModel(name, latency), capacity = pathCapacity, dropPolicy = dropPolicy(pathSeed(name)))
+        self.regions = b.buildFullyMeshedRegionsWithKinesis(env, regionsToBuild, TTL, pushReplication, storageDirectory, subscriptionLease, resubscriptionInterval)
+        if egressWindow is not None:
+            for region in self.regions:
+                region.enableEgressBundling(egressWindow)
 
         if badNetworkInAPAC:
             self.regions[3].connectedRegions['us-west-1'][1].lossProbability = 0.9 # Network connectivity in ASIA is lossy
@@ -48,8 +78,8 @@ class KinesisBasedSIMSimulation(Simulation):
         ## Create SIM pair in each Region
         self.sims = []
         for region in self.regions:
-            self.sims.append(Sim(env, region, 0, strategy(region.getServiceByName('Kinesis')), simHeartbeatInterval))
-            self.sims.append(Sim(env, region, 1, strategy(region.getServiceByName('Kinesis')), simHeartbeatInterval))
+            self.sims.append(Sim(env, region, 0, strategy(region), simHeartbeatInterval))
+            self.sims.append(Sim(env, region, 1, strategy(region), simHeartbeatInterval))
 
         for sim in self.sims:
             sim.attachRemoteRegions(self.regions)
@@ -65,22 +95,34 @@ class KinesisBasedSIMSimulation(Simulation):
         env.run(until = (curtime - 1))
         self.regions[3].connectedRegions['us-west-1'][1].lossProbability = packetLoss # Network magically improved 
 
-        while curtime < maxstep:
-            env.run(until = curtime) 
-            if sleepTime > 0:
-                time.sleep(sleepTime)
-            if waitForReturn:
-                input("Press [ENTER] to continue")
-
-            os.system("clear")
-            progress = curtime*100/maxstep
-            p.printHeader("+++++++++++++++++++++++++++++ Simulation Step ++++++++++++++++++++++++++++++")
-            p.print("Current time: %i - Step width: %i - Simulation ends at: %i (%i%% completed)" % (curtime, step, maxstep, progress))
-            p.print()
-
-            self.printSIMS()
-            curtime += step 
-
+        try:
+            while curtime < maxstep:
+                env.run(until = curtime) 
+                if sleepTime > 0:
+                    time.sleep(sleepTime)
+                if waitForReturn:
+                    input("Press [ENTER] to continue")
+
+                os.system("clear")
+                progress = curtime*100/maxstep
+                p.printHeader("+++++++++++++++++++++++++++++ Simulation Step ++++++++++++++++++++++++++++++")
+                p.print("Current time: %i - Step width: %i - Simulation ends at: %i (%i%% completed)" % (curtime, step, maxstep, progress))
+                p.print()
+
+                self.printSIMS()
+                p.printKinesisMetrics(self.regions)
+                if bandwidth is not None:
+                    p.printNetworkMetrics(self.regions)
+                curtime += step 
+        finally:
+            self.closeKinesis()
+
+    def closeKinesis(self):
+        ## Delete the stream files of disk backed Kinesis services
+        for region in self.regions:
+            for service in region.services.values():
+                if isinstance(service, (AWSKinesis, AWSRemoteKinesis)):
+                    service.close()
 
     def printRegions(self):
         for region in self.regions:
@@ -18,18 +18,21 @@ class AWSBuilder(object):
         return self.regionBuilder.connectTwoRegions(env, region1, region2, latency1, latency2)
 
 
-    def buildFullyMeshedRegionsWithKinesis(self, env, regionNamesAndLatencies, TTL = 0):
+    def buildFullyMeshedRegionsWithKinesis(self, env, regionNamesAndLatencies, TTL = 0, pushReplication = False, storageDirectory = None, leaseDuration = 0, resubscriptionInterval = AWSRemoteKinesis.defaultResubscriptionInterval):
         """Build fully meshed regions with kinesis services in each
 
-        Each region will have one primary kinesis and remote kinesis to each other region"""
+        Each region will have one primary kinesis and remote kinesis to each other region,
+        subscribing with leases of leaseDuration ticks (0 = permanent subscriptions). With
+        a storageDirectory both keep their streams in files below it. Permanent subscriptions
+        of remote kinesis are resent every resubscriptionInterval ticks (0 = never)"""
 
         regions = self.buildFullyMeshedRegions(env, regionNamesAndLatencies)
 
         for region in regions:
-            kinesis = AWSKinesis(region, env, TTL)
+            kinesis = AWSKinesis(region, env, TTL, pushReplication, storageDirectory)
             for otherRegion in regions:
                 if otherRegion != region:
-                    AWSRemoteKinesis(region, otherRegion.regionName)
+                    AWSRemoteKinesis(region, otherRegion.regionName, TTL, leaseDuration, storageDirectory, resubscriptionInterval)
 
         return regions
 
@@ -51,10 +54,10 @@ class AWSBuilder(object):
             localRegion = self.buildRegion(regionName = 'localRegion')
         return AWSRemoteService(localRegion, remoteRegionName, remoteServiceName)
 
-    def buildRemoteKinesis(self, localRegion = None, remoteRegionName = 'remote-region'):
+    def buildRemoteKinesis(self, localRegion = None, remoteRegionName = 'remote-region', resubscriptionInterval = 0):
         if localRegion == None:
             localRegion = self.buildRegion(regionName = 'localRegion')
-        return AWSRemoteKinesis(localRegion, remoteRegionName)
+        return AWSRemoteKinesis(localRegion, remoteRegionName, resubscriptionInterval = resubscriptionInterval)
 
     def buildLocalService(self, localRegion = None, serviceName = 'localService'):
         if localRegion == None:
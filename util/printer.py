@@ -22,6 +22,25 @@ class Printer(object):
 
         self.print()
 
+    def printKinesisMetrics(self, regions):
+        self.printBold("+ Kinesis notifications (sent/saved): ", end = '')
+        for region in regions:
+            kinesis = region.getServiceByName('Kinesis')
+            for streamName in sort(kinesis.streams):
+                stream = kinesis.streams[streamName]
+                self.print("[%s/%s: %i/%i]" % (region.regionName, streamName, stream.notificationsSent, stream.notificationsSaved), end = ' ')
+        self.print()
+
+    def printNetworkMetrics(self, regions):
+        """Queue depth and utilisation of bandwidth limited paths"""
+        self.printBold("+ Network paths (queue/max queue/utilisation): ", end = '')
+        for region in regions:
+            for connectedRegion in sort(region.connectedRegions):
+                path = region.connectedRegions[connectedRegion][1]
+                if hasattr(path, 'utilisation'):
+                    self.print("[%s: %i/%i/%i%%]" % (path.name, path.queueDepth(), path.maxQueueDepth, path.utilisation() * 100), end = ' ')
+        self.print()
+
     def printSIMS(self, sims):
         lastRegion = None
         for sim in sims: